@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+WebSocket broadcast engine for Medical Cabinet Management System
+Per-connection bounded send queues drained by their own task, so one slow
+client never delays the others
+"""
+
+import asyncio
+import itertools
+from collections import OrderedDict
+
+
+class OutboundConnection:
+    """Bounded send queue of one WebSocket, drained by a writer task"""
+
+    def __init__(self, websocket, hub, max_queue: int, send_timeout: float):
+        self.websocket = websocket
+        self.hub = hub
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.pending = OrderedDict()  # key -> message text
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.writer = asyncio.create_task(self.drain())
+
+    def enqueue(self, text: str, key) -> bool:
+        """Queue a message, replacing a pending one with the same key. False if evicted"""
+        if self.closed:
+            return False
+        if key in self.pending:
+            # Latest state wins, keeping the place in the queue
+            self.pending[key] = text
+            self.coalesced += 1
+            return True
+        if len(self.pending) >= self.max_queue:
+            self.close("send queue full")
+            return False
+        self.pending[key] = text
+        self.ready.set()
+        return True
+
+    async def drain(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                while self.pending:
+                    _, text = self.pending.popitem(last=False)
+                    await asyncio.wait_for(self.websocket.send_text(text), self.send_timeout)
+                    self.sent += 1
+                self.ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.close(f"send failed: {e.__class__.__name__}")
+
+    def close(self, reason: str):
+        """Stop sending and drop the connection from its hub"""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        self.hub.evicted(self, reason)
+
+
+class BroadcastHub:
+    """Set of WebSocket connections with non-blocking fan-out"""
+
+    def __init__(self, name: str, max_queue: int = 100, send_timeout: float = 5.0):
+        self.name = name
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.connections = {}  # websocket -> OutboundConnection
+        self.message_ids = itertools.count()
+        self.evictions = 0
+
+    @property
+    def active_connections(self):
+        return list(self.connections)
+
+    def register(self, websocket):
+        self.connections[websocket] = OutboundConnection(websocket, self, self.max_queue, self.send_timeout)
+
+    def unregister(self, websocket):
+        outbound = self.connections.pop(websocket, None)
+        if outbound and not outbound.closed:
+            outbound.closed = True
+            outbound.writer.cancel()
+
+    def evicted(self, outbound: OutboundConnection, reason: str):
+        if self.connections.get(outbound.websocket) is outbound:
+            del self.connections[outbound.websocket]
+            self.evictions += 1
+            print(f"🔌 {self.name}: connection dropped ({reason})")
+            asyncio.ensure_future(self._close_socket(outbound.websocket))
+
+    async def _close_socket(self, websocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+    def fan_out(self, text: str, websockets=None, coalesce_key: str = None) -> int:
+        """Queue text on every (or the given) connection without waiting, returns the number queued"""
+        targets = list(self.connections.values()) if websockets is None else [
+            self.connections[ws] for ws in websockets if ws in self.connections
+        ]
+        key = coalesce_key if coalesce_key is not None else next(self.message_ids)
+        return sum(1 for outbound in targets if outbound.enqueue(text, key))
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "queued_messages": sum(len(o.pending) for o in self.connections.values()),
+            "sent_messages": sum(o.sent for o in self.connections.values()),
+            "coalesced_messages": sum(o.coalesced for o in self.connections.values()),
+            "evictions": self.evictions
+        }
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Declarative MongoDB index registry for Medical Cabinet Management System
+Applied at startup by server.py and manually by optimize_db.py
+"""
+
+ASCENDING = 1
+DESCENDING = -1
+
+# Index specs per collection: "keys" plus any create_index option (unique, sparse...)
+INDEX_SPECS = {
+    "patients": [
+        {"keys": [("id", ASCENDING)]},                                  # Point lookups
+        {"keys": [("nom", ASCENDING), ("prenom", ASCENDING)]},          # Sort by name
+        {"keys": [("search_keys", ASCENDING)]},                         # Accent-folded prefix search
+        {"keys": [("nom", ASCENDING), ("id", ASCENDING)]},              # Keyset pagination
+        {"keys": [("date_naissance", ASCENDING)]},                      # Birthday reminders
+        {"keys": [("last_consultation_date", ASCENDING)]},              # Inactive patients
+        {"keys": [("numero_whatsapp", ASCENDING)]},                     # WhatsApp queries
+    ],
+    "appointments": [
+        {"keys": [("id", ASCENDING)]},
+        {"keys": [("date", DESCENDING)]},                               # Calendar views
+        {"keys": [("date", ASCENDING), ("statut", ASCENDING)]},         # Day views, delay sweeper
+        {"keys": [("date", ASCENDING), ("version", ASCENDING)]},        # Day changes since a version
+        {"keys": [("retard_sweep", ASCENDING)], "sparse": True},        # Appointments of a delay sweep
+        {"keys": [("patient_id", ASCENDING), ("date", DESCENDING)]},
+        {"keys": [("statut", ASCENDING)]},
+        {"keys": [("paye", ASCENDING)]},
+    ],
+    "consultations": [
+        {"keys": [("id", ASCENDING)]},
+        {"keys": [("patient_id", ASCENDING), ("date", DESCENDING)]},
+        {"keys": [("appointment_id", ASCENDING)]},
+        {"keys": [("relance_date", ASCENDING)]},                        # Phone reminders
+        {"keys": [("rappel_vaccin", ASCENDING), ("date_vaccin", ASCENDING)]},
+    ],
+    "payments": [
+        {"keys": [("id", ASCENDING)]},
+        {"keys": [("appointment_id", ASCENDING)]},                      # Payment of an appointment
+        {"keys": [("date", DESCENDING)]},                               # Billing reports
+        {"keys": [("date", DESCENDING), ("id", DESCENDING)]},           # Keyset pagination
+        {"keys": [("patient_id", ASCENDING), ("date", DESCENDING)]},
+        {"keys": [("statut", ASCENDING)]},
+        {"keys": [("assure", ASCENDING)]},
+    ],
+    "users": [
+        {"keys": [("username", ASCENDING)], "unique": True},            # Login
+        {"keys": [("role", ASCENDING)]},
+    ],
+    "messages": [
+        {"keys": [("id", ASCENDING)]},
+    ],
+    "phone_messages": [
+        {"keys": [("id", ASCENDING)]},
+        {"keys": [("date", DESCENDING)]},
+        {"keys": [("call_date", DESCENDING), ("call_time", DESCENDING), ("id", DESCENDING)]},  # Keyset pagination
+        {"keys": [("direction", ASCENDING), ("recipient_role", ASCENDING)]},
+        {"keys": [("priority", DESCENDING)]},
+    ],
+    "cash_movements": [
+        {"keys": [("date", DESCENDING)]},
+    ],
+    "daily_rollups": [
+        {"keys": [("date", ASCENDING)], "unique": True},
+    ],
+    "patient_stats": [
+        {"keys": [("patient_id", ASCENDING)], "unique": True},
+        {"keys": [("revenue", DESCENDING)]},                            # Lifetime revenue ranking
+    ],
+    "patient_stats_monthly": [
+        {"keys": [("month", ASCENDING), ("patient_id", ASCENDING)], "unique": True},  # Period rankings
+        {"keys": [("patient_id", ASCENDING)]},                          # Refresh of a patient
+    ],
+    "rdv_versions": [
+        {"keys": [("date", ASCENDING)], "unique": True},
+    ],
+    "data_versions": [
+        {"keys": [("name", ASCENDING)], "unique": True},                # ETag version counters
+    ],
+    "report_jobs": [
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("key", ASCENDING), ("created_at", DESCENDING)]},     # Cached result lookup
+        {"keys": [("status", ASCENDING), ("created_at", ASCENDING)]},   # Worker claims
+        {"keys": [("expires_at", ASCENDING)], "expireAfterSeconds": 0}, # Finished jobs expire
+    ],
+}
+
+
+def index_name(keys):
+    """Default MongoDB name of an index (e.g. date_1_statut_1)"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def index_options(spec):
+    """create_index options of a spec"""
+    return {key: value for key, value in spec.items() if key != "keys"}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Per-request database profiling for Medical Cabinet Management System
+A pymongo command listener adds every query to the stats of the request
+that issued it: query count, documents returned, reply bytes and DB time.
+A pool listener measures connection check-out waits
+"""
+
+import contextvars
+import threading
+import time
+from collections import Counter
+
+import bson
+from pymongo import monitoring
+
+# Commands that are not application queries
+IGNORED_COMMANDS = {"isMaster", "ismaster", "hello", "ping", "saslStart", "saslContinue", "endSessions", "killCursors"}
+
+
+class RequestDbStats:
+    """Database work done while serving one request"""
+
+    def __init__(self):
+        self.queries = 0
+        self.documents = 0
+        self.bytes = 0
+        self.db_time_ms = 0.0
+        self.failures = 0
+        self.calls = Counter()  # (collection, command) -> count, for N+1 detection
+        self.lock = threading.Lock()  # Motor runs commands on executor threads
+
+    def record(self, command: str, collection: str, duration_ms: float, documents: int = 0,
+               size: int = 0, failed: bool = False):
+        with self.lock:
+            self.queries += 1
+            self.documents += documents
+            self.bytes += size
+            self.db_time_ms += duration_ms
+            self.failures += failed
+            self.calls[(collection, command)] += 1
+
+    def repeated_calls(self, threshold: int) -> list:
+        """(collection, command, count) issued at least threshold times, most frequent first"""
+        return [(collection, command, count) for (collection, command), count in self.calls.most_common()
+                if count >= threshold]
+
+    def server_timing(self) -> str:
+        """Server-Timing header value"""
+        return (f'db;dur={self.db_time_ms:.1f};desc="MongoDB", '
+                f'db-queries;desc="{self.queries}", '
+                f'db-docs;desc="{self.documents}", '
+                f'db-bytes;desc="{self.bytes}"')
+
+    def to_dict(self) -> dict:
+        return {
+            "queries": self.queries,
+            "documents": self.documents,
+            "bytes": self.bytes,
+            "db_time_ms": round(self.db_time_ms, 2),
+            "failures": self.failures
+        }
+
+
+current_db_stats = contextvars.ContextVar("current_db_stats", default=None)
+
+
+def reply_documents(reply: dict) -> int:
+    """Number of documents in a command reply (cursor batch or count)"""
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if "values" in reply:  # distinct
+        return len(reply["values"])
+    return 0
+
+
+class DbCommandListener(monitoring.CommandListener):
+    """Routes command events to the stats of the current request (if any)"""
+
+    def __init__(self, measure_bytes: bool = True):
+        self.measure_bytes = measure_bytes
+        self.collections = {}  # request_id -> collection, started events only carry the command
+
+    def started(self, event):
+        if current_db_stats.get() is None or event.command_name in IGNORED_COMMANDS:
+            return
+        # The command value is the collection name, except for getMore (cursor id)
+        key = "collection" if event.command_name == "getMore" else event.command_name
+        target = event.command.get(key)
+        self.collections[event.request_id] = target if isinstance(target, str) else event.database_name
+
+    def succeeded(self, event):
+        self._record(event, reply=event.reply)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def _record(self, event, reply=None, failed=False):
+        collection = self.collections.pop(event.request_id, None)
+        stats = current_db_stats.get()
+        if stats is None or collection is None:
+            return
+        documents = reply_documents(reply) if reply else 0
+        size = len(bson.encode(reply)) if reply and self.measure_bytes else 0
+        stats.record(event.command_name, collection, event.duration_micros / 1000,
+                     documents=documents, size=size, failed=failed)
+
+
+class PoolCheckoutListener(monitoring.ConnectionPoolListener):
+    """Measures how long operations wait for a pooled connection, observe(seconds)"""
+
+    def __init__(self, observe, on_failure=None):
+        self.observe = observe
+        self.on_failure = on_failure
+        self.local = threading.local()  # Check-outs start and end on the same thread
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self.local, "started", None)
+        if started is not None:
+            self.observe(time.perf_counter() - started)
+            self.local.started = None
+
+    def connection_check_out_failed(self, event):
+        self.local.started = None
+        if self.on_failure:
+            self.on_failure(event.reason)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
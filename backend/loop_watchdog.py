@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Event-loop watchdog for Medical Cabinet Management System
+A heartbeat task measures loop lag; a watchdog thread captures the stack of
+the event loop thread (and the request being served) when the heartbeat stalls
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def blocking_call(frames: list) -> str:
+    """Innermost application frame of a stack ("file:line in function")"""
+    for frame in reversed(frames):
+        if frame.filename.startswith(APP_DIR) and frame.filename != os.path.abspath(__file__):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    last = frames[-1] if frames else None
+    return f"{last.filename}:{last.lineno} in {last.name}" if last else "unknown"
+
+
+def request_of(frame) -> str:
+    """Request ("METHOD /route") whose ASGI scope is in the calling frames, None outside requests"""
+    while frame is not None:
+        scope = frame.f_locals.get("scope")
+        if isinstance(scope, dict) and scope.get("type") in ("http", "websocket"):
+            route = scope.get("route")
+            path = getattr(route, "path", None) or scope.get("path")
+            return f"{scope.get('method', 'WS')} {path}"
+        frame = frame.f_back
+    return None
+
+
+class LoopWatchdog:
+    """Loop lag monitor recording the route and call that blocked the loop"""
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.2, max_events: int = 50, on_lag=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.on_lag = on_lag  # Called with every lag measurement (seconds)
+        self.events = deque(maxlen=max_events)
+        self.last_beat = time.monotonic()
+        self.beats = 0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.stalls = 0
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.captured_beat = -1
+        self.pending_event = None  # Stall being measured, closed by the next heartbeat
+
+    def start(self):
+        """Start the heartbeat (in the running loop) and the watchdog thread"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopped.clear()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        return self.heartbeat_task
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self.last_beat = time.monotonic()
+            self.beats += 1
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_lag:
+                self.on_lag(lag)
+            event = self.pending_event
+            if event is not None:
+                event["blocked_ms"] = round(lag * 1000, 1)
+                self.pending_event = None
+
+    def watch(self):
+        """Watchdog thread: capture the loop thread stack once per stalled heartbeat"""
+        check_every = max(self.threshold / 4, 0.01)
+        while not self.stopped.wait(check_every):
+            stalled_for = time.monotonic() - self.last_beat - self.interval
+            if stalled_for > self.threshold and self.captured_beat != self.beats:
+                self.captured_beat = self.beats
+                try:
+                    self.capture(stalled_for)
+                except Exception as e:
+                    print(f"⚠️  Loop watchdog capture error: {e}")
+
+    def capture(self, stalled_for: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        frames = traceback.extract_stack(frame) if frame else []
+        task = asyncio.current_task(self.loop)
+        # Outer frames are suspended in calls, reading their locals is safe
+        request = request_of(frame.f_back) if frame else None
+        event = {
+            "detected_at": datetime.now().isoformat(),
+            "stalled_ms": round(stalled_for * 1000, 1),
+            "blocked_ms": None,  # Filled in when the loop runs again
+            "request": request,
+            "task": task.get_name() if task is not None else None,
+            "call": blocking_call(frames),
+            "stack": traceback.format_list(frames[-15:])
+        }
+        self.stalls += 1
+        self.events.append(event)
+        self.pending_event = event
+        print(f"🐢 Event loop blocked for {event['stalled_ms']} ms+ by {event['call']}"
+              + (f" ({request})" if request else ""))
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalls": self.stalls,
+            "running": self.thread is not None and self.thread.is_alive()
+        }
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Keyset (cursor) pagination helpers for Medical Cabinet Management System
+Opaque "after" tokens carry the sort values of the last item of a page
+"""
+
+import base64
+import json
+
+
+class InvalidCursor(ValueError):
+    """Raised when an "after" token cannot be decoded"""
+
+
+def encode_cursor(item: dict, sort: list) -> str:
+    """Opaque token of the position right after item for the given sort"""
+    values = [item.get(field) for field, _ in sort]
+    raw = json.dumps(values, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str, sort: list) -> list:
+    """Sort values carried by a token produced by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise InvalidCursor("Invalid cursor: sort mismatch")
+    return values
+
+
+def keyset_filter(sort: list, values: list) -> dict:
+    """Query matching documents strictly after values for the given sort
+
+    For sort [(a, 1), (b, -1)] and values [x, y]:
+    {"$or": [{a: {"$gt": x}}, {a: x, b: {"$lt": y}}]}
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {sort[j][0]: values[j] for j in range(i)}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+def after_query(query: dict, sort: list, after: str = None) -> dict:
+    """Combine a base query with the keyset filter of an "after" token"""
+    if not after:
+        return query
+    position = keyset_filter(sort, decode_cursor(after, sort))
+    return {"$and": [query, position]} if query else position
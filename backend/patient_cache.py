@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Patient summary cache for Medical Cabinet Management System
+Bounded LRU + TTL map of patient identity records (name, WhatsApp, birth date),
+kept fresh by the patient write paths
+"""
+
+import time
+from collections import OrderedDict
+
+
+class PatientSummaryCache:
+    """LRU cache of patient summaries with a time-to-live, filled by an async loader"""
+
+    def __init__(self, loader, max_size: int = 5000, ttl_seconds: float = 300):
+        self.loader = loader  # async loader(ids) -> {id: summary}
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # id -> (expires_at, summary or None when the patient does not exist)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # Bumped on invalidation so in-flight loads do not store stale records
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, patient_id: str):
+        """(found, summary) from memory only, refreshing the LRU position"""
+        entry = self.entries.get(patient_id)
+        if entry is None:
+            return False, None
+        expires_at, summary = entry
+        if expires_at < time.monotonic():
+            del self.entries[patient_id]
+            return False, None
+        self.entries.move_to_end(patient_id)
+        return True, summary
+
+    def put(self, patient_id: str, summary):
+        """Store a summary (None records a missing patient)"""
+        if self.max_size <= 0:
+            return
+        self.entries[patient_id] = (time.monotonic() + self.ttl_seconds, summary)
+        self.entries.move_to_end(patient_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *patient_ids):
+        self.generation += 1
+        for patient_id in patient_ids:
+            if self.entries.pop(patient_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    async def get_many(self, patient_ids) -> dict:
+        """Summaries of existing patients keyed by id, loading the misses in one call"""
+        found = {}
+        missing = []
+        for patient_id in dict.fromkeys(pid for pid in patient_ids if pid):
+            cached, summary = self.lookup(patient_id)
+            if cached:
+                self.hits += 1
+                if summary is not None:
+                    found[patient_id] = summary
+            else:
+                self.misses += 1
+                missing.append(patient_id)
+        if missing:
+            generation = self.generation
+            loaded = await self.loader(missing)
+            for patient_id in missing:
+                summary = loaded.get(patient_id)
+                if generation == self.generation:
+                    self.put(patient_id, summary)
+                if summary is not None:
+                    found[patient_id] = summary
+        return found
+
+    async def get(self, patient_id: str):
+        """Summary of one patient, None if it does not exist"""
+        return (await self.get_many([patient_id])).get(patient_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Patient search helpers for Medical Cabinet Management System
+Accent-folded name keys stored on patients and an optional in-memory typeahead trie
+"""
+
+import heapq
+import re
+import unicodedata
+
+DATE_SEARCH_PATTERN = re.compile(r"^[0-9][0-9/-]*$")
+TOKEN_SEPARATOR = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_search_text(value) -> str:
+    """Lowercase and strip accents (e.g. "Hélène" -> "helene")"""
+    if not value:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(value))
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return folded.lower().strip()
+
+
+def search_tokens(value) -> list:
+    """Normalized words of a text ("Ben-Salah Hélène" -> ["ben", "salah", "helene"])"""
+    return [token for token in TOKEN_SEPARATOR.split(normalize_search_text(value)) if token]
+
+
+def patient_search_keys(patient: dict) -> list:
+    """Search keys stored on a patient: every normalized word of nom and prenom"""
+    keys = search_tokens(patient.get("nom")) + search_tokens(patient.get("prenom"))
+    return sorted(set(keys))
+
+
+def build_patient_search_query(q: str) -> dict:
+    """Anchored prefix query served by the search_keys / date_naissance indexes"""
+    q = (q or "").strip()
+    if DATE_SEARCH_PATTERN.match(q):
+        return {"date_naissance": {"$regex": f"^{re.escape(q)}"}}
+
+    tokens = search_tokens(q)
+    if not tokens:
+        return {}
+    # Every typed word must prefix one of the patient's words
+    clauses = [{"search_keys": {"$regex": f"^{re.escape(token)}"}} for token in tokens]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class PatientNameTrie:
+    """Prefix trie over patient search keys, each node holding the ids below it"""
+
+    def __init__(self):
+        self.root = {"children": {}, "ids": set()}
+        self.keys_by_id = {}
+        self.sort_keys = {}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.keys_by_id)
+
+    def add(self, patient: dict):
+        """Index (or re-index) a patient"""
+        patient_id = patient.get("id")
+        if not patient_id:
+            return
+        self.remove(patient_id)
+        keys = patient.get("search_keys") or patient_search_keys(patient)
+        for key in keys:
+            node = self.root
+            for char in key:
+                node = node["children"].setdefault(char, {"children": {}, "ids": set()})
+                node["ids"].add(patient_id)
+        self.keys_by_id[patient_id] = keys
+        self.sort_keys[patient_id] = (normalize_search_text(patient.get("nom")),
+                                      normalize_search_text(patient.get("prenom")))
+
+    def remove(self, patient_id: str):
+        """Drop a patient from the trie, pruning empty branches"""
+        self.sort_keys.pop(patient_id, None)
+        for key in self.keys_by_id.pop(patient_id, []):
+            node = self.root
+            path = []
+            for char in key:
+                child = node["children"].get(char)
+                if child is None:
+                    break
+                child["ids"].discard(patient_id)
+                path.append((node, char, child))
+                node = child
+            for parent, char, child in reversed(path):
+                if child["ids"]:
+                    break
+                del parent["children"][char]
+
+    def prefix_ids(self, prefix: str) -> set:
+        """Ids of patients having a word starting with prefix"""
+        node = self.root
+        for char in prefix:
+            node = node["children"].get(char)
+            if node is None:
+                return set()
+        return node["ids"]
+
+    def search(self, q: str, limit: int = 20) -> list:
+        """Ids of patients matching every word of q, ordered by nom/prenom"""
+        tokens = search_tokens(q)
+        if not tokens:
+            return []
+        candidates = sorted((self.prefix_ids(token) for token in tokens), key=len)
+        ids = candidates[0].intersection(*candidates[1:]) if len(candidates) > 1 else candidates[0]
+        return heapq.nsmallest(limit, ids, key=lambda patient_id: self.sort_keys.get(patient_id, ("", "")))
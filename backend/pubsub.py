@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Cross-worker publish/subscribe for Medical Cabinet Management System
+Lets several uvicorn workers share WebSocket broadcasts and in-memory settings
+
+Backends:
+- memory: single process (default)
+- mongo: capped "events" collection, read with a change stream
+  (or a tailable cursor when the server is not a replica set)
+- redis: Redis PUBLISH/PSUBSCRIBE (needs the redis package)
+"""
+
+import abc
+import asyncio
+import json
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+
+class PubSub:
+    """In-process bus: handlers are called directly on publish"""
+
+    name = "memory"
+
+    def __init__(self):
+        self.handlers = defaultdict(list)
+        self.origin = uuid.uuid4().hex  # Identifies this worker
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, channel: str, handler):
+        """Register an async handler(payload) for a channel"""
+        self.handlers[channel].append(handler)
+
+    async def dispatch(self, channel: str, payload: dict):
+        for handler in self.handlers.get(channel, []):
+            try:
+                await handler(payload)
+            except Exception as e:
+                print(f"⚠️  Event handler error on {channel}: {e}")
+
+    async def publish(self, channel: str, payload: dict):
+        """Deliver payload to the handlers of channel in every worker"""
+        self.published += 1
+        await self.dispatch(channel, payload)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "origin": self.origin, "published": self.published, "received": self.received}
+
+
+class ListeningPubSub(PubSub, abc.ABC):
+    """Bus delivering locally at once and to other workers through a listener task"""
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    async def publish(self, channel: str, payload: dict):
+        await super().publish(channel, payload)
+        try:
+            await self.send(channel, payload)
+        except Exception as e:
+            print(f"⚠️  Event not shared with other workers ({channel}): {e}")
+
+    async def receive(self, channel: str, payload: dict, origin: str):
+        if origin == self.origin:
+            return  # Already delivered locally
+        self.received += 1
+        await self.dispatch(channel, payload)
+
+    async def start(self):
+        await self.connect()
+        self.listener = asyncio.create_task(self.listen_forever())
+        print(f"📡 Event bus started ({self.name})")
+
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+
+    async def listen_forever(self):
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Event bus listener error ({self.name}): {e}")
+                await asyncio.sleep(1)
+
+    async def connect(self):
+        pass
+
+    @abc.abstractmethod
+    async def send(self, channel: str, payload: dict):
+        """Share an event with the other workers"""
+
+    @abc.abstractmethod
+    async def listen(self):
+        """Receive the events of the other workers until the connection drops"""
+
+
+class MongoPubSub(ListeningPubSub):
+    """Events stored in a capped collection and followed by every worker"""
+
+    name = "mongo"
+
+    def __init__(self, db, collection_name: str = "events", size_bytes: int = 16 * 1024 * 1024):
+        super().__init__()
+        self.db = db
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.collection = db[collection_name]
+        self.use_change_stream = True
+
+    async def connect(self):
+        if self.collection_name not in await self.db.list_collection_names():
+            try:
+                await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            except Exception as e:
+                # Another worker created it first
+                print(f"ℹ️  Events collection: {e}")
+
+    async def send(self, channel: str, payload: dict):
+        await self.collection.insert_one({
+            "channel": channel,
+            "payload": payload,
+            "origin": self.origin,
+            "created_at": datetime.now()
+        })
+
+    async def listen(self):
+        if self.use_change_stream:
+            try:
+                async with self.collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        event = change["fullDocument"]
+                        await self.receive(event["channel"], event["payload"], event["origin"])
+            except Exception as e:
+                if "replica set" not in str(e) and "$changeStream" not in str(e):
+                    raise
+                print("ℹ️  Change streams unavailable, tailing the events collection")
+                self.use_change_stream = False
+        await self.tail()
+
+    async def tail(self):
+        """Tailable cursor on the capped collection (standalone MongoDB)"""
+        from pymongo import CursorType
+
+        last = await self.collection.find_one({}, sort=[("$natural", -1)], projection={"_id": 1})
+        query = {"_id": {"$gt": last["_id"]}} if last else {}
+        while True:
+            cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for event in cursor:
+                    query = {"_id": {"$gt": event["_id"]}}
+                    await self.receive(event["channel"], event["payload"], event["origin"])
+            await asyncio.sleep(0.5)
+
+
+class RedisPubSub(ListeningPubSub):
+    """Events sent with Redis PUBLISH on <prefix><channel>"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "cabinet:"):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.redis = None
+
+    async def connect(self):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("PUBSUB_BACKEND=redis needs the redis package (pip install redis)")
+        self.redis = aioredis.from_url(self.url)
+
+    async def send(self, channel: str, payload: dict):
+        message = json.dumps({"origin": self.origin, "payload": payload}, default=str)
+        await self.redis.publish(f"{self.prefix}{channel}", message)
+
+    async def listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.psubscribe(f"{self.prefix}*")
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") != "pmessage":
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                event = json.loads(message["data"])
+                await self.receive(channel[len(self.prefix):], event["payload"], event["origin"])
+        finally:
+            await pubsub.close()
+
+    async def stop(self):
+        await super().stop()
+        if self.redis:
+            await self.redis.close()
+
+
+def create_pubsub(backend: str, db=None, redis_url: str = None) -> PubSub:
+    """Event bus for the PUBSUB_BACKEND setting"""
+    backend = (backend or "memory").lower()
+    if backend == "mongo":
+        return MongoPubSub(db)
+    if backend == "redis":
+        return RedisPubSub(redis_url or "redis://localhost:6379/0")
+    if backend != "memory":
+        print(f"⚠️  Unknown PUBSUB_BACKEND '{backend}', using memory")
+    return PubSub()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Background report jobs for Medical Cabinet Management System
+Reports are submitted to the report_jobs collection and computed by a pool of
+in-process workers; finished results are reused for the same report type,
+parameters and data versions until they expire
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+# Fields of a job returned by status queries (the result is fetched separately)
+JOB_SUMMARY_PROJECTION = {"_id": 0, "result": 0, "key": 0}
+
+
+class ReportJobRunner:
+    """Queue of report jobs stored in MongoDB, claimed atomically by the workers of every process"""
+
+    def __init__(self, collection, workers: int = 2, poll_interval: float = 5, result_ttl: float = 3600,
+                 timeout: float = 600, stale_after: float = 60, max_attempts: int = 3,
+                 cache_parts=None, on_update=None):
+        self.collection = collection
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl  # Seconds a finished job (and its cached result) is kept
+        self.timeout = timeout
+        self.stale_after = stale_after  # Running jobs without heartbeat for this long are requeued
+        self.max_attempts = max_attempts
+        self.cache_parts = cache_parts  # async cache_parts() -> values the results depend on (data versions)
+        self.on_update = on_update  # async on_update(job summary), called on every status change
+        self.reports = {}  # report type -> (func, {param: type}, required params)
+        self.tasks = []
+        self.wakeup = asyncio.Event()
+        self.running_jobs = 0
+
+    def register(self, report_type: str, func, params: dict = None, required=()):
+        """Declare a report computed by await func(**params), params maps each name to its type"""
+        self.reports[report_type] = (func, dict(params or {}), tuple(required))
+
+    def normalize_params(self, report_type: str, params: dict) -> dict:
+        """Every allowed parameter of the report (None when missing), ValueError on invalid input"""
+        if report_type not in self.reports:
+            raise ValueError(f"Unknown report type '{report_type}'. Use: {', '.join(sorted(self.reports))}")
+        _, allowed, required = self.reports[report_type]
+        params = params or {}
+        unknown = sorted(set(params) - set(allowed))
+        if unknown:
+            raise ValueError(f"Unknown parameter(s) for '{report_type}': {', '.join(unknown)}")
+        missing = [name for name in required if params.get(name) in (None, "")]
+        if missing:
+            raise ValueError(f"Missing parameter(s) for '{report_type}': {', '.join(missing)}")
+        normalized = {}
+        for name, kind in allowed.items():
+            value = params.get(name)
+            if value in (None, ""):
+                normalized[name] = None
+                continue
+            try:
+                normalized[name] = kind(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for '{name}': {value!r}")
+        return normalized
+
+    async def cache_key(self, report_type: str, params: dict) -> str:
+        parts = await self.cache_parts() if self.cache_parts else None
+        payload = json.dumps([report_type, params, parts], default=str, sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    async def submit(self, report_type: str, params: dict = None, force: bool = False,
+                     requested_by: str = None) -> dict:
+        """Queue a report, or return the pending/finished job computing the same result"""
+        params = self.normalize_params(report_type, params)
+        key = await self.cache_key(report_type, params)
+        now = datetime.now()
+        if not force:
+            existing = await self.collection.find_one(
+                {"key": key, "$or": [
+                    {"status": "queued"},
+                    {"status": "running", "heartbeat_at": {"$gte": now - timedelta(seconds=self.stale_after)}},
+                    {"status": "done", "expires_at": {"$gt": now}}
+                ]},
+                JOB_SUMMARY_PROJECTION,
+                sort=[("created_at", -1)]
+            )
+            if existing:
+                return {**existing, "cached": True}
+        job = {
+            "id": str(uuid.uuid4()),
+            "report_type": report_type,
+            "params": params,
+            "key": key,
+            "status": "queued",
+            "progress": 0,
+            "message": "En attente",
+            "attempts": 0,
+            "error": None,
+            "requested_by": requested_by,
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "heartbeat_at": None,
+            "duration_ms": None,
+            "expires_at": None,
+            "result": None
+        }
+        await self.collection.insert_one(job)
+        self.wakeup.set()
+        summary = {k: v for k, v in job.items() if k not in ("_id", "result", "key")}
+        await self.notify(summary)
+        return {**summary, "cached": False}
+
+    async def get(self, job_id: str, with_result: bool = False):
+        projection = {"_id": 0, "key": 0} if with_result else JOB_SUMMARY_PROJECTION
+        return await self.collection.find_one({"id": job_id}, projection)
+
+    async def claim(self):
+        """Atomically take the oldest queued job (or a running job whose worker died)"""
+        now = datetime.now()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running",
+                 "heartbeat_at": {"$lt": now - timedelta(seconds=self.stale_after)},
+                 "attempts": {"$lt": self.max_attempts}}
+            ]},
+            {"$set": {"status": "running", "progress": 10, "message": "Calcul en cours",
+                      "started_at": now, "heartbeat_at": now, "updated_at": now},
+             "$inc": {"attempts": 1}},
+            projection={"_id": 0, "result": 0},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def fail_abandoned(self) -> int:
+        """Mark failed the stale running jobs that already used all their attempts"""
+        failed = 0
+        while True:
+            now = datetime.now()
+            job = await self.collection.find_one_and_update(
+                {"status": "running",
+                 "heartbeat_at": {"$lt": now - timedelta(seconds=self.stale_after)},
+                 "attempts": {"$gte": self.max_attempts}},
+                {"$set": {"status": "failed", "message": "Échec du rapport",
+                          "error": f"Worker stopped responding after {self.max_attempts} attempt(s)",
+                          "finished_at": now, "updated_at": now,
+                          "expires_at": now + timedelta(seconds=self.result_ttl)}},
+                projection=JOB_SUMMARY_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            if job is None:
+                return failed
+            failed += 1
+            print(f"❌ Report job {job['id']} ({job['report_type']}) failed: {job['error']}")
+            await self.notify(job)
+
+    async def keep_alive(self, job_id: str):
+        """Refresh the heartbeat of a running job so other workers do not requeue it"""
+        while True:
+            await asyncio.sleep(max(self.stale_after / 4, 1))
+            await self.collection.update_one(
+                {"id": job_id, "status": "running"}, {"$set": {"heartbeat_at": datetime.now()}}
+            )
+
+    async def run(self, job: dict):
+        func, _, _ = self.reports.get(job["report_type"], (None, {}, ()))
+        job.pop("key", None)
+        await self.notify(job)
+        started = time.perf_counter()
+        heartbeat = asyncio.create_task(self.keep_alive(job["id"]))
+        self.running_jobs += 1
+        try:
+            if func is None:
+                raise ValueError(f"Unknown report type '{job['report_type']}'")
+            result = await asyncio.wait_for(func(**job["params"]), self.timeout)
+            # Round-trip through JSON: reports may hold int keys or values BSON cannot store
+            update = {"status": "done", "progress": 100, "message": "Rapport prêt", "error": None,
+                      "result": json.loads(json.dumps(result, default=str))}
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            update = {"status": "failed", "message": "Délai dépassé",
+                      "error": f"Report did not finish within {self.timeout:.0f}s"}
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)  # HTTPException raised by the report
+            update = {"status": "failed", "message": "Échec du rapport", "error": str(detail)}
+        finally:
+            self.running_jobs -= 1
+            heartbeat.cancel()
+        now = datetime.now()
+        update.update({
+            "finished_at": now,
+            "updated_at": now,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            "expires_at": now + timedelta(seconds=self.result_ttl)
+        })
+        await self.collection.update_one({"id": job["id"]}, {"$set": update})
+        job.update(update)
+        job.pop("result", None)
+        await self.notify(job)
+        if update["status"] == "failed":
+            print(f"❌ Report job {job['id']} ({job['report_type']}) failed: {update['error']}")
+
+    async def worker(self, number: int):
+        while True:
+            self.wakeup.clear()
+            try:
+                job = await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Report worker {number} error: {e}")
+                job = None
+            if job is None:
+                try:
+                    await self.fail_abandoned()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️  Report worker {number} error: {e}")
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Report job {job.get('id')} error: {e}")
+
+    async def notify(self, job: dict):
+        if self.on_update:
+            try:
+                await self.on_update(job)
+            except Exception as e:
+                print(f"⚠️  Report job notification error: {e}")
+
+    def start(self) -> list:
+        self.tasks = [asyncio.create_task(self.worker(number), name=f"report-worker-{number}")
+                      for number in range(self.workers)]
+        return self.tasks
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running_jobs,
+            "report_types": sorted(self.reports)
+        }
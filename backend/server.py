@@ -1,18 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from pydantic import BaseModel, Field
 import os
 from dotenv import load_dotenv
 import uuid
 import json
+import re
+import hashlib
+import time
+import csv
+import io
+import zlib
 import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import bcrypt
 import jwt
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+from db_indexes import INDEX_SPECS, index_name, index_options
+from patient_search import DATE_SEARCH_PATTERN, PatientNameTrie, build_patient_search_query, patient_search_keys
+from pagination import InvalidCursor, after_query, encode_cursor
+from broadcast import BroadcastHub
+from pubsub import create_pubsub
+from patient_cache import PatientSummaryCache
+from db_profiler import DbCommandListener, PoolCheckoutListener, RequestDbStats, current_db_stats
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry
+from loop_watchdog import LoopWatchdog
+from report_jobs import ReportJobRunner
 
 # Load environment variables
 load_dotenv()
@@ -29,16 +49,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Long-running background tasks started with the application
+background_tasks: List[asyncio.Task] = []
+
 # Application startup event
 @app.on_event("startup")
 async def startup_event():
     """Initialize the application with demo data and default users"""
     print("🚀 Starting Medical Cabinet Backend...")
     
+    # Test the MongoDB connection
+    try:
+        await client.admin.command('ping')
+        print("✅ MongoDB connection successful")
+    except Exception as e:
+        print(f"❌ MongoDB connection failed: {e}")
+    
+    # Cross-worker events and shared settings
+    try:
+        await event_bus.start()
+        await load_shared_settings()
+    except Exception as e:
+        print(f"⚠️  Event bus startup error: {e}")
+    
     # Force create default users for deployment
     try:
         # Check if users exist
-        users_count = users_collection.count_documents({})
+        users_count = await users_collection.count_documents({})
         if users_count == 0:
             print("👤 Creating default users for deployment...")
             
@@ -48,7 +85,7 @@ async def startup_event():
                 "username": "medecin",
                 "full_name": "Dr Heni Dridi",
                 "role": "medecin",
-                "hashed_password": bcrypt.hashpw("medecin123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+                "hashed_password": await hash_password("medecin123"),
                 "is_active": True,
                 "permissions": {
                     "administration": True,
@@ -69,7 +106,7 @@ async def startup_event():
                 "username": "secretaire",
                 "full_name": "Secrétaire Médicale",
                 "role": "secretaire",
-                "hashed_password": bcrypt.hashpw("secretaire123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+                "hashed_password": await hash_password("secretaire123"),
                 "is_active": True,
                 "permissions": {
                     "administration": False,
@@ -85,7 +122,7 @@ async def startup_event():
             }
             
             # Insert users
-            users_collection.insert_many([medecin_user, secretaire_user])
+            await users_collection.insert_many([medecin_user, secretaire_user])
             print("✅ Default users created successfully")
         
         else:
@@ -96,10 +133,10 @@ async def startup_event():
     
     # Create demo data if needed
     try:
-        patients_count = patients_collection.count_documents({})
+        patients_count = await patients_collection.count_documents({})
         if patients_count == 0:
             print("📊 Creating minimal demo data...")
-            create_demo_data()
+            await create_demo_data()
             print("✅ Demo data created successfully")
         else:
             print(f"📊 Found {patients_count} existing patients")
@@ -107,43 +144,157 @@ async def startup_event():
     except Exception as e:
         print(f"⚠️  Demo data creation error: {e}")
     
+    # Build the daily rollups on first start
+    try:
+        if await daily_rollups_collection.count_documents({}) == 0:
+            days = await rebuild_daily_rollups()
+            print(f"📈 Daily rollups built for {days} days")
+    except Exception as e:
+        print(f"⚠️  Daily rollups error: {e}")
+    
+    # Build the patient stats on first start
+    try:
+        if await patient_stats_collection.count_documents({}) == 0:
+            patients = await rebuild_patient_stats()
+            print(f"🏅 Patient stats built for {patients} patients")
+    except Exception as e:
+        print(f"⚠️  Patient stats error: {e}")
+    
+    # Last consultation dates of patients created before they were maintained
+    try:
+        updated = await backfill_last_consultation_dates()
+        if updated:
+            print(f"🩺 Last consultation date set on {updated} patient(s)")
+    except Exception as e:
+        print(f"⚠️  Last consultation dates error: {e}")
+    
     # Create default WhatsApp templates
     try:
-        create_default_whatsapp_templates()
+        await create_default_whatsapp_templates()
         print("📱 WhatsApp templates initialized")
     except Exception as e:
         print(f"⚠️  WhatsApp templates error: {e}")
     
+    # Start background jobs
+    background_tasks.append(asyncio.create_task(ensure_indexes()))
+    background_tasks.append(asyncio.create_task(prepare_patient_search()))
+    background_tasks.append(asyncio.create_task(appointment_delay_sweeper()))
+    background_tasks.append(loop_watchdog.start())
+    background_tasks.extend(report_job_runner.start())
+    print(f"⏰ Delay sweeper started (every {DELAY_SWEEP_INTERVAL_SECONDS}s)")
+    
     print("🎉 Application started successfully!")
     return {"message": "Application initialized successfully"}
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background jobs and close the MongoDB client"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    loop_watchdog.stop()
+    password_hash_executor.shutdown(wait=False)
+    await event_bus.stop()
+    client.close()
+
+# ==================== METRICS ====================
+
+# Prometheus metrics served on /metrics (per worker process)
+metrics_registry = Registry()
+http_requests_total = metrics_registry.counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+http_request_duration = metrics_registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route"))
+http_requests_in_flight = metrics_registry.gauge(
+    "http_requests_in_flight", "HTTP requests being served")
+event_loop_lag = metrics_registry.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+mongo_pool_checkout_wait = metrics_registry.histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting for a MongoDB pool connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+mongo_pool_checkout_failures = metrics_registry.counter(
+    "mongo_pool_checkout_failures_total", "MongoDB pool check-outs that failed", ("reason",))
+metrics_registry.gauge(
+    "websocket_connections", "Open WebSocket connections per manager", ("manager",),
+    callback=lambda: {(hub.name,): len(hub.connections) for hub in (manager, ai_manager)})
+metrics_registry.gauge(
+    "websocket_evictions", "Slow WebSocket clients disconnected per manager", ("manager",),
+    callback=lambda: {(hub.name,): hub.evictions for hub in (manager, ai_manager)})
+gemini_request_duration = metrics_registry.histogram(
+    "gemini_request_duration_seconds", "Gemini call latency by service method", ("method",),
+    buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 30, 60))
+gemini_errors_total = metrics_registry.counter(
+    "gemini_errors_total", "Failed Gemini calls by service method", ("method",))
+report_jobs_total = metrics_registry.counter(
+    "report_jobs_total", "Report jobs by type and outcome (done, failed, cached)", ("report_type", "status"))
+report_job_duration = metrics_registry.histogram(
+    "report_job_duration_seconds", "Time spent computing a report job", ("report_type",),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+
+pool_checkout_listener = PoolCheckoutListener(
+    mongo_pool_checkout_wait.observe,
+    on_failure=lambda reason: mongo_pool_checkout_failures.inc(str(reason))
+)
+
+# Event-loop watchdog: lag sampled every interval, stack of the blocking call
+# captured when the loop stalls longer than the threshold (GET /api/admin/diagnostics)
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get('EVENT_LOOP_LAG_INTERVAL_SECONDS', '0.5'))
+LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', '200'))
+loop_watchdog = LoopWatchdog(EVENT_LOOP_LAG_INTERVAL_SECONDS, LOOP_BLOCK_THRESHOLD_MS / 1000,
+                             on_lag=event_loop_lag.observe)
+metrics_registry.gauge(
+    "event_loop_stalls", "Event loop stalls longer than the watchdog threshold",
+    callback=lambda: loop_watchdog.stalls)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Count requests and their latency per route template"""
+    http_requests_in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_requests_in_flight.dec()
+        route = request.scope.get("route")
+        path = route.path if route else "unmatched"
+        http_requests_total.inc(request.method, path, str(status))
+        http_request_duration.observe(time.perf_counter() - started, request.method, path)
+
 # MongoDB connection with Atlas support
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/cabinet_medical')
 print(f"🔧 Connecting to MongoDB: {MONGO_URL[:30]}...")
 
-try:
-    # Create MongoDB client with Atlas-optimized settings
-    client = MongoClient(
-        MONGO_URL,
-        serverSelectionTimeoutMS=10000,  # 10 seconds timeout
-        connectTimeoutMS=10000,
-        maxPoolSize=10,
-        retryWrites=True
-    )
-    
-    # Test the connection
-    client.admin.command('ping')
-    print("✅ MongoDB connection successful")
-    
-except Exception as e:
-    print(f"❌ MongoDB connection failed: {e}")
-    print("🔄 Falling back to local connection for development")
-    client = MongoClient('mongodb://localhost:27017/cabinet_medical')
-    print("📊 MongoDB client created successfully")
-except Exception as e:
-    print(f"❌ MongoDB connection error: {e}")
-    # Create a fallback for deployment testing
-    client = MongoClient('mongodb://localhost:27017/cabinet_medical')
+# Connection pool sizing (configurable per deployment)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '5'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+
+# Per-request query profiling: Server-Timing header, warning above the query budget
+REQUEST_PROFILING = os.environ.get('REQUEST_PROFILING', 'true').lower() == 'true'
+QUERY_BUDGET_PER_REQUEST = int(os.environ.get('QUERY_BUDGET_PER_REQUEST', '50'))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '10'))  # Same command on the same collection
+db_command_listener = DbCommandListener()
+
+# Async MongoDB client (motor): queries no longer block the event loop.
+# The client connects lazily, the connection itself is checked at startup.
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    serverSelectionTimeoutMS=10000,  # 10 seconds timeout
+    connectTimeoutMS=10000,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    retryWrites=True,
+    event_listeners=([db_command_listener] if REQUEST_PROFILING else []) + [pool_checkout_listener]
+)
+print(f"📊 MongoDB client created (pool {MONGO_MIN_POOL_SIZE}-{MONGO_MAX_POOL_SIZE})")
 
 # Extract database name from MongoDB URL for Atlas compatibility
 if "mongodb+srv://" in MONGO_URL or "mongodb://" in MONGO_URL:
@@ -175,6 +326,39 @@ users_collection = db.users
 messages_collection = db.messages
 phone_messages_collection = db.phone_messages
 cash_movements_collection = db.cash_movements
+daily_rollups_collection = db.daily_rollups
+app_settings_collection = db.app_settings
+rdv_versions_collection = db.rdv_versions
+data_versions_collection = db.data_versions
+report_jobs_collection = db.report_jobs
+patient_stats_collection = db.patient_stats
+patient_stats_monthly_collection = db.patient_stats_monthly
+
+# ==================== REQUEST PROFILING ====================
+
+@app.middleware("http")
+async def profile_database_usage(request: Request, call_next):
+    """Count the queries of each request, report them in Server-Timing and warn over budget"""
+    if not REQUEST_PROFILING:
+        return await call_next(request)
+    stats = RequestDbStats()
+    token = current_db_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_db_stats.reset(token)
+    total_ms = (time.perf_counter() - started) * 1000
+    response.headers["Server-Timing"] = f"{stats.server_timing()}, app;dur={total_ms:.1f}"
+    if stats.queries > QUERY_BUDGET_PER_REQUEST:
+        route = request.scope.get("route")
+        path = route.path if route else request.url.path
+        repeated = ", ".join(f"{command} {collection} x{count}"
+                             for collection, command, count in stats.repeated_calls(N_PLUS_ONE_THRESHOLD)[:3])
+        print(f"⚠️  Query budget exceeded: {request.method} {path} ran {stats.queries} queries "
+              f"({stats.documents} docs, {stats.bytes} bytes, {stats.db_time_ms:.0f} ms DB)"
+              + (f" - repeated: {repeated}" if repeated else ""))
+    return response
 
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
@@ -184,31 +368,228 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 # Security
 security = HTTPBearer()
 
+# Event bus shared by all workers (WebSocket broadcasts, settings, search trie).
+# memory only works with a single worker, use mongo or redis with --workers N
+PUBSUB_BACKEND = os.environ.get('PUBSUB_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+event_bus = create_pubsub(PUBSUB_BACKEND, db=db, redis_url=REDIS_URL)
+
+# WebSocket send queues: a client falling this many messages behind, or blocking a
+# send for this long, is disconnected instead of slowing down everyone else
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '100'))
+WS_SEND_TIMEOUT_SECONDS = float(os.environ.get('WS_SEND_TIMEOUT_SECONDS', '5'))
+
+# Per-worker patient summary cache (0 disables it), entries also expire after the TTL
+PATIENT_CACHE_SIZE = int(os.environ.get('PATIENT_CACHE_SIZE', '5000'))
+PATIENT_CACHE_TTL_SECONDS = float(os.environ.get('PATIENT_CACHE_TTL_SECONDS', '300'))
+
 # WebSocket connection manager
-class ConnectionManager:
+# Connections without subscriptions receive every broadcast (legacy clients).
+# Subscribed connections only receive their topics: "rdv:<YYYY-MM-DD>", "dashboard",
+# "phone_messages", "messages", "cash", "reports".
+class ConnectionManager(BroadcastHub):
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        super().__init__("ws", WS_SEND_QUEUE_SIZE, WS_SEND_TIMEOUT_SECONDS)
+        self.subscriptions: Dict[WebSocket, set] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.register(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.unregister(websocket)
+        self.subscriptions.pop(websocket, None)
+
+    def evicted(self, outbound, reason: str):
+        super().evicted(outbound, reason)
+        self.subscriptions.pop(outbound.websocket, None)
+
+    def subscribe(self, websocket: WebSocket, topics: List[str]) -> List[str]:
+        topics_set = self.subscriptions.setdefault(websocket, set())
+        topics_set.update(t for t in topics if t)
+        return sorted(topics_set)
+
+    def unsubscribe(self, websocket: WebSocket, topics: List[str]) -> List[str]:
+        topics_set = self.subscriptions.get(websocket, set())
+        topics_set.difference_update(topics)
+        return sorted(topics_set)
+
+    def wants(self, websocket: WebSocket, topic: Optional[str], subscribers_only: bool = False) -> bool:
+        topics = self.subscriptions.get(websocket)
+        if topics is None:
+            return topic is None or not subscribers_only
+        return topic in topics
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        # Through the connection queue, to stay ordered with broadcasts
+        self.fan_out(message, [websocket])
+
+    async def broadcast(self, message: dict, topic: Optional[str] = None, coalesce_key: Optional[str] = None):
+        """Send to all legacy connections and to the subscribers of topic (every worker)"""
+        await self._send(message, topic, False, coalesce_key)
+
+    async def publish(self, topic: str, message: dict, coalesce_key: Optional[str] = None):
+        """Send to the subscribers of topic only (every worker)"""
+        await self._send({**message, "topic": topic}, topic, True, coalesce_key)
+
+    async def _send(self, message: dict, topic: Optional[str], subscribers_only: bool, coalesce_key: Optional[str]):
+        await event_bus.publish("ws", {
+            "text": json.dumps(message, default=str),
+            "topic": topic,
+            "subscribers_only": subscribers_only,
+            "coalesce_key": coalesce_key
+        })
 
-    async def broadcast(self, message: dict):
-        message_json = json.dumps(message, default=str)
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message_json)
-            except:
-                # Remove disconnected connections
-                self.active_connections.remove(connection)
+    async def deliver_event(self, event: dict):
+        """Fan-out to this worker's connections of a message sent by any worker"""
+        targets = [ws for ws in self.active_connections
+                   if self.wants(ws, event.get("topic"), event.get("subscribers_only", False))]
+        if targets:
+            self.fan_out(event["text"], targets, event.get("coalesce_key"))
 
 manager = ConnectionManager()
+event_bus.subscribe("ws", manager.deliver_event)
+
+# Per-day appointment versions (rdv_versions): every appointment write bumps the
+# version of its day and stamps it on the appointment, deletions leave a tombstone.
+# reset_version marks bulk rewrites after which clients must reload the whole day.
+# A version is reserved (pending) until its appointments are stamped: readers only
+# see the versions below the oldest pending one, so no change can be skipped.
+
+# Reservations older than this are ignored (writer died before releasing them)
+DAY_VERSION_PENDING_SECONDS = 60
+
+def stable_day_version(day: dict) -> int:
+    """Highest version of a day whose appointment stamps are all written"""
+    cutoff = datetime.now() - timedelta(seconds=DAY_VERSION_PENDING_SECONDS)
+    pending = [p["version"] for p in day.get("pending", []) if p["at"] >= cutoff]
+    return min(pending) - 1 if pending else day["version"]
+
+async def get_day_version(date: str) -> dict:
+    """Version document of a day ({"version": 0} when the day was never written)
+
+    version is the stable version readers may rely on, latest_version the last reserved one.
+    """
+    day = await rdv_versions_collection.find_one({"date": date}, {"_id": 0})
+    if not day:
+        return {"date": date, "version": 0, "latest_version": 0, "reset_version": 0, "deleted": []}
+    return {**day, "version": stable_day_version(day), "latest_version": day["version"]}
+
+async def bump_day_version(date: str, deleted_id: Optional[str] = None) -> int:
+    """Increment the version of a day, recording a tombstone for a deleted appointment
+    or a pending reservation (released by release_day_version once the stamps are written)"""
+    now = datetime.now()
+    if deleted_id:
+        entry = {"deleted": {"$concatArrays": [
+            {"$ifNull": ["$deleted", []]}, [{"id": deleted_id, "version": "$version"}]
+        ]}}
+    else:
+        entry = {"pending": {"$concatArrays": [
+            {"$ifNull": ["$pending", []]}, [{"version": "$version", "at": now}]
+        ]}}
+    # Version and tombstone/reservation in one atomic update
+    day = await rdv_versions_collection.find_one_and_update(
+        {"date": date},
+        [
+            {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}, "updated_at": now}},
+            {"$set": entry}
+        ],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"_id": 0, "version": 1}
+    )
+    return day["version"]
+
+async def release_day_version(date: str, version: int):
+    """Make a reserved version visible to readers"""
+    await rdv_versions_collection.update_one({"date": date}, {"$pull": {"pending": {"version": version}}})
+
+async def reset_day_versions(dates=()):
+    """After bulk appointment changes: bump every day and force clients to reload"""
+    await bump_data_version("appointments")
+    await rdv_versions_collection.update_many({}, [{"$set": {
+        "version": {"$add": ["$version", 1]},
+        "reset_version": {"$add": ["$version", 1]},
+        "deleted": [],
+        "updated_at": datetime.now()
+    }}])
+    for date in set(dates):
+        await rdv_versions_collection.update_one(
+            {"date": date},
+            {"$setOnInsert": {"version": 1, "reset_version": 1, "deleted": [], "updated_at": datetime.now()}},
+            upsert=True
+        )
+
+async def record_appointment_change(action: str, appointment_id: str, changes: Optional[dict] = None,
+                                    date: Optional[str] = None):
+    """Bump the day version, stamp it on the appointment(s) and publish the delta
+
+    Called after every write to appointments_collection. Publishes an
+    appointment_delta on rdv:<date> and a refresh hint on dashboard.
+    """
+    try:
+        if date is None:
+            appointment = await appointments_collection.find_one({"id": appointment_id}, {"_id": 0, "date": 1})
+            date = appointment.get("date") if appointment else None
+        if not date:
+            return
+        
+        await bump_data_version("appointments")
+        if action == "deleted":
+            version = await bump_day_version(date, deleted_id=appointment_id)
+        else:
+            version = await bump_day_version(date)
+            ids = list(changes["priorities"]) if action == "reordered" else [appointment_id]
+            try:
+                await appointments_collection.update_many(
+                    {"id": {"$in": ids}, "date": date}, {"$max": {"version": version}}
+                )
+            finally:
+                await release_day_version(date, version)
+        
+        await manager.publish(f"rdv:{date}", {
+            "type": "appointment_delta",
+            "action": action,  # created, updated, deleted, reordered
+            "date": date,
+            "version": version,
+            "appointment_id": appointment_id,
+            "changes": changes or {},
+            "timestamp": datetime.now().isoformat()
+        })
+        await manager.publish("dashboard", {"type": "dashboard_changed", "reason": "appointments", "date": date},
+                              coalesce_key="dashboard_changed")
+    except Exception as e:
+        print(f"⚠️  Appointment change not recorded: {e}")
+
+async def record_day_appointment_changes(date: str, appointment_ids: List[str], changes: dict):
+    """record_appointment_change for several appointments of one day, with a single version bump
+
+    The caller bumps the "appointments" data version.
+    """
+    try:
+        version = await bump_day_version(date)
+        try:
+            await appointments_collection.update_many(
+                {"id": {"$in": appointment_ids}, "date": date}, {"$max": {"version": version}}
+            )
+        finally:
+            await release_day_version(date, version)
+        
+        timestamp = datetime.now().isoformat()
+        for appointment_id in appointment_ids:
+            await manager.publish(f"rdv:{date}", {
+                "type": "appointment_delta",
+                "action": "updated",
+                "date": date,
+                "version": version,
+                "appointment_id": appointment_id,
+                "changes": changes,
+                "timestamp": timestamp
+            })
+        await manager.publish("dashboard", {"type": "dashboard_changed", "reason": "appointments", "date": date},
+                              coalesce_key="dashboard_changed")
+    except Exception as e:
+        print(f"⚠️  Appointment changes not recorded: {e}")
 
 # Models
 class ParentInfo(BaseModel):
@@ -461,14 +842,68 @@ class CashMovementCreate(BaseModel):
     motif: str
     date: str
 
+# Password hashing: bcrypt costs 100-300 ms of CPU, so it runs on a small dedicated
+# pool instead of the event loop. Callers beyond the pool size wait their turn.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_hash_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+password_hash_queue = metrics_registry.gauge(
+    "password_hash_queue_depth", "bcrypt jobs waiting for a free worker")
+password_hash_active = metrics_registry.gauge(
+    "password_hash_active", "bcrypt jobs running")
+password_hash_wait = metrics_registry.histogram(
+    "password_hash_wait_seconds", "Time bcrypt jobs waited for a worker",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+password_hash_duration = metrics_registry.histogram(
+    "password_hash_duration_seconds", "bcrypt job duration by operation", ("operation",),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1, 2))
+
+async def run_password_job(operation: str, func, *args):
+    """Run a bcrypt call on the password pool"""
+    queued = time.perf_counter()
+    password_hash_queue.inc()
+    try:
+        await password_hash_slots.acquire()
+    finally:
+        password_hash_queue.dec()
+    started = time.perf_counter()
+    password_hash_wait.observe(started - queued)
+    password_hash_active.inc()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_hash_executor, func, *args)
+    finally:
+        password_hash_active.dec()
+        password_hash_duration.observe(time.perf_counter() - started, operation)
+        password_hash_slots.release()
+
+def password_hash_stats() -> dict:
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "rounds": BCRYPT_ROUNDS,
+        "queued": password_hash_queue.values.get((), 0),
+        "active": password_hash_active.values.get((), 0)
+    }
+
 # Helper functions for authentication
-def hash_password(password: str) -> str:
+async def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    def hash_sync():
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+    return await run_password_job("hash", hash_sync)
 
-def verify_password(password: str, hashed_password: str) -> bool:
+async def verify_password(password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+    def verify_sync():
+        return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+    return await run_password_job("verify", verify_sync)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True when a hash was made with another work factor than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
 
 def create_access_token(data: dict) -> str:
     """Create JWT access token"""
@@ -477,7 +912,7 @@ def create_access_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     """Get current user from JWT token - WITH AUTO-LOGIN BYPASS"""
     try:
         # Check for auto-login mock token
@@ -517,7 +952,7 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
         
-        user = users_collection.find_one({"username": username}, {"_id": 0})
+        user = await users_collection.find_one({"username": username}, {"_id": 0})
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         
@@ -525,11 +960,11 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
-def create_default_users():
+async def create_default_users():
     """Create default users if they don't exist"""
     try:
         # Check if users exist
-        if users_collection.count_documents({}) == 0:
+        if await users_collection.count_documents({}) == 0:
             # Create default doctor
             doctor_permissions = UserPermissions(
                 administration=True,
@@ -544,7 +979,7 @@ def create_default_users():
                 username="medecin",
                 full_name="Dr Heni Dridi",
                 role="medecin",
-                hashed_password=hash_password("medecin123"),
+                hashed_password=await hash_password("medecin123"),
                 permissions=doctor_permissions
             )
             
@@ -563,13 +998,13 @@ def create_default_users():
                 username="secretaire",
                 full_name="Secrétaire",
                 role="secretaire",
-                hashed_password=hash_password("secretaire123"),
+                hashed_password=await hash_password("secretaire123"),
                 permissions=secretary_permissions
             )
             
             # Insert users
-            users_collection.insert_one(doctor.dict())
-            users_collection.insert_one(secretary.dict())
+            await users_collection.insert_one(doctor.dict())
+            await users_collection.insert_one(secretary.dict())
             print("Default users created successfully")
         
     except Exception as e:
@@ -636,6 +1071,10 @@ def generate_whatsapp_link(numero: str) -> str:
     
     return ""
 
+# Minutes after the scheduled time before a "programme" appointment becomes "retard"
+DELAY_THRESHOLD_MINUTES = 15
+DELAY_SWEEP_INTERVAL_SECONDS = int(os.environ.get('DELAY_SWEEP_INTERVAL_SECONDS', '60'))
+
 def check_appointment_delay(appointment: dict) -> str:
     """Check if appointment is delayed and return appropriate status"""
     if appointment["statut"] == "programme":
@@ -647,12 +1086,499 @@ def check_appointment_delay(appointment: dict) -> str:
             now = datetime.now()
             
             # If 15 minutes past appointment time, mark as delayed
-            if now > appointment_datetime + timedelta(minutes=15):
+            if now > appointment_datetime + timedelta(minutes=DELAY_THRESHOLD_MINUTES):
                 return "retard"
         except:
             pass
     return appointment["statut"]
 
+async def sweep_delayed_appointments() -> int:
+    """Mark the overdue "programme" appointments as "retard" in a single update
+
+    The update stamps a token unique to this sweep, so with several workers only
+    the appointments this worker switched are read back and recorded.
+    """
+    now = datetime.now()
+    cutoff = now - timedelta(minutes=DELAY_THRESHOLD_MINUTES)
+    cutoff_date = cutoff.strftime("%Y-%m-%d")
+    token = str(uuid.uuid4())
+    result = await appointments_collection.update_many(
+        {
+            "statut": "programme",
+            "$or": [
+                {"date": {"$lt": cutoff_date}},
+                {"date": cutoff_date, "heure": {"$lt": cutoff.strftime("%H:%M")}}
+            ]
+        },
+        {"$set": {"statut": "retard", "updated_at": now, "retard_sweep": token}}
+    )
+    if not result.modified_count:
+        return 0
+    
+    marked = await appointments_collection.find(
+        {"retard_sweep": token}, {"_id": 0, "id": 1, "date": 1}
+    ).to_list(length=None)
+    ids_by_date = defaultdict(list)
+    for appointment in marked:
+        ids_by_date[appointment["date"]].append(appointment["id"])
+    await bump_data_version("appointments")
+    for date, appointment_ids in ids_by_date.items():
+        await record_day_appointment_changes(date, appointment_ids, {"statut": "retard"})
+    return result.modified_count
+
+async def appointment_delay_sweeper():
+    """Background loop running the delay sweep once per interval"""
+    while True:
+        try:
+            updated = await sweep_delayed_appointments()
+            if updated:
+                print(f"⏰ {updated} appointment(s) marked as retard")
+        except Exception as e:
+            print(f"⚠️  Delay sweeper error: {e}")
+        await asyncio.sleep(DELAY_SWEEP_INTERVAL_SECONDS)
+
+# Fields of the cached patient summary
+PATIENT_SUMMARY_FIELDS = ("id", "nom", "prenom", "numero_whatsapp", "lien_whatsapp", "date_naissance")
+PATIENT_SUMMARY_PROJECTION = {"_id": 0, **{field: 1 for field in PATIENT_SUMMARY_FIELDS}}
+# Fields of the patient embedded in calendar appointments
+CALENDAR_PATIENT_FIELDS = ("id", "nom", "prenom", "numero_whatsapp", "lien_whatsapp")
+
+def build_patient_summary(patient: dict) -> dict:
+    """Build the cached patient summary"""
+    return {field: patient.get(field, "") for field in PATIENT_SUMMARY_FIELDS}
+
+def build_calendar_patient(summary: dict) -> dict:
+    """Patient embedded in calendar appointments (subset of the summary)"""
+    return {field: summary.get(field, "") for field in CALENDAR_PATIENT_FIELDS}
+
+async def load_patient_summaries(patient_ids) -> Dict[str, dict]:
+    """Load the summaries of several patients in a single $in query, keyed by patient id"""
+    patients = await patients_collection.find({"id": {"$in": list(patient_ids)}}, PATIENT_SUMMARY_PROJECTION).to_list(length=None)
+    return {patient["id"]: build_patient_summary(patient) for patient in patients}
+
+patient_cache = PatientSummaryCache(load_patient_summaries, PATIENT_CACHE_SIZE, PATIENT_CACHE_TTL_SECONDS)
+
+async def get_patient_summaries(patient_ids) -> Dict[str, dict]:
+    """Summaries of several patients keyed by id (cache first, one $in query for the misses)"""
+    summaries = await patient_cache.get_many(patient_ids)
+    # Copies: callers enrich the dicts they embed in responses
+    return {patient_id: dict(summary) for patient_id, summary in summaries.items()}
+
+async def get_patient_summary(patient_id: str) -> Optional[dict]:
+    """Summary of one patient, None if it does not exist"""
+    return (await get_patient_summaries([patient_id])).get(patient_id)
+
+async def apply_patient_cache_change(event: dict):
+    """Write-through on patient changes published by any worker"""
+    if event["action"] == "add":
+        patient = event["patient"]
+        patient_cache.invalidate(patient["id"])
+        patient_cache.put(patient["id"], build_patient_summary(patient))
+    elif event["action"] == "remove":
+        patient_cache.invalidate(event["patient_id"])
+    elif event["action"] == "reload":
+        patient_cache.clear()
+
+# ==================== PATIENT ACTIVITY ====================
+
+# last_consultation_date is kept on patients ("" when never consulted, which sorts
+# before any date) so inactive patients are one indexed range query
+INACTIVE_PATIENT_DAYS = 365
+
+def inactive_patients_query() -> dict:
+    """Patients without consultation in the last 12 months"""
+    cutoff = (datetime.now() - timedelta(days=INACTIVE_PATIENT_DAYS)).strftime("%Y-%m-%d")
+    return {"last_consultation_date": {"$lt": cutoff}}
+
+async def refresh_last_consultation_date(*patient_ids):
+    """Recompute last_consultation_date of patients whose consultations changed"""
+    patient_ids = {pid for pid in patient_ids if pid}
+    for patient_id in patient_ids:
+        latest = await consultations_collection.find_one(
+            {"patient_id": patient_id}, {"_id": 0, "date": 1}, sort=[("date", -1)]
+        )
+        await patients_collection.update_one(
+            {"id": patient_id},
+            {"$set": {"last_consultation_date": (latest or {}).get("date") or ""}}
+        )
+    if patient_ids:
+        await bump_data_version("patients")
+
+async def backfill_last_consultation_dates(only_missing: bool = True) -> int:
+    """Set last_consultation_date from the consultations (patients missing it, or all)"""
+    latest = {
+        doc["_id"]: doc["date"] or ""
+        async for doc in consultations_collection.aggregate([
+            {"$group": {"_id": "$patient_id", "date": {"$max": "$date"}}}
+        ])
+    }
+    query = {"last_consultation_date": {"$exists": False}} if only_missing else {}
+    updated = 0
+    updates = []
+    async for patient in patients_collection.find(query, {"_id": 0, "id": 1}):
+        updates.append(UpdateOne(
+            {"id": patient["id"]},
+            {"$set": {"last_consultation_date": latest.get(patient["id"], "")}}
+        ))
+        if len(updates) >= 500:
+            await patients_collection.bulk_write(updates, ordered=False)
+            updated += len(updates)
+            updates = []
+    if updates:
+        await patients_collection.bulk_write(updates, ordered=False)
+        updated += len(updates)
+    if updated:
+        await bump_data_version("patients")
+    return updated
+
+# ==================== PATIENT STATS ====================
+
+# Materialized per-patient statistics for the patient rankings. patient_stats holds the
+# lifetime figures of each patient: revenue (paid payments), consultations by type,
+# first/last visit, average interval and appointment counts. patient_stats_monthly
+# holds the same revenue and consultation figures per calendar month, summed over the
+# months of a period by the period rankings. Both are recomputed for the patients
+# touched by each payment, consultation or appointment write, and rebuilt after bulk changes.
+
+# Month (YYYY-MM) of a date stored as a string or a datetime
+MONTH_OF_DATE = {"$substrBytes": [{"$toString": "$date"}, 0, 7]}
+
+def patient_stats_doc(patient_id: str, payments: dict = None, consultations: dict = None,
+                      appointments: dict = None) -> dict:
+    """patient_stats document from the grouped payments, consultations and appointments of a patient"""
+    payments, consultations, appointments = payments or {}, consultations or {}, appointments or {}
+    first_visit = str(consultations["first_visit"])[:10] if consultations.get("first_visit") else None
+    last_visit = str(consultations["last_visit"])[:10] if consultations.get("last_visit") else None
+    count = consultations.get("consultations", 0)
+    span_days = 0
+    if first_visit and last_visit:
+        span_days = (datetime.strptime(last_visit, "%Y-%m-%d") - datetime.strptime(first_visit, "%Y-%m-%d")).days
+    return {
+        "patient_id": patient_id,
+        "revenue": round(payments.get("revenue", 0), 2),
+        "nb_payments": payments.get("nb_payments", 0),
+        "consultations": count,
+        "visites": consultations.get("visites", 0),
+        "controles": consultations.get("controles", 0),
+        "first_visit": first_visit,
+        "last_visit": last_visit,
+        "avg_interval_days": round(span_days / (count - 1), 1) if count > 1 else None,
+        "visits_per_month": round(count / max(1, span_days / 30), 2),
+        "rdv_total": appointments.get("rdv_total", 0),
+        "absences": appointments.get("absences", 0),
+        "updated_at": datetime.now()
+    }
+
+def sum_patient_months(months: List[dict]) -> dict:
+    """Revenue and consultation figures of several monthly buckets"""
+    totals = {key: sum(m[key] for m in months)
+              for key in ("revenue", "nb_payments", "consultations", "visites", "controles")}
+    visits = [m for m in months if m["first_visit"]]
+    totals["first_visit"] = min((m["first_visit"] for m in visits), default=None)
+    totals["last_visit"] = max((m["last_visit"] for m in visits), default=None)
+    return totals
+
+async def compute_patient_stats(patient_ids: Optional[List[str]] = None) -> Tuple[Dict[str, dict], List[dict]]:
+    """Lifetime stats keyed by patient id and monthly buckets of the given patients (all when None)"""
+    match = {"patient_id": {"$in": patient_ids}} if patient_ids is not None else {}
+    payments, consultations, appointments = await asyncio.gather(
+        payments_collection.aggregate([
+            {"$match": {**match, "statut": "paye"}},
+            {"$group": {"_id": {"patient_id": "$patient_id", "month": MONTH_OF_DATE},
+                        "revenue": {"$sum": "$montant"}, "nb_payments": {"$sum": 1}}}
+        ]).to_list(length=None),
+        consultations_collection.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": {"patient_id": "$patient_id", "month": MONTH_OF_DATE},
+                "consultations": {"$sum": 1},
+                "visites": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "visite"]}, 1, 0]}},
+                "controles": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "controle"]}, 1, 0]}},
+                "first_visit": {"$min": "$date"},
+                "last_visit": {"$max": "$date"}
+            }}
+        ]).to_list(length=None),
+        appointments_collection.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": "$patient_id",
+                "rdv_total": {"$sum": 1},
+                "absences": {"$sum": {"$cond": [{"$eq": ["$statut", "absent"]}, 1, 0]}}
+            }}
+        ]).to_list(length=None)
+    )
+    now = datetime.now()
+    buckets = {}  # (patient id, month) -> bucket
+    for row in payments + consultations:
+        patient_id, month = row["_id"].get("patient_id"), row["_id"].get("month")
+        if not patient_id or not month:
+            continue
+        bucket = buckets.setdefault((patient_id, month), {
+            "patient_id": patient_id, "month": month, "revenue": 0, "nb_payments": 0,
+            "consultations": 0, "visites": 0, "controles": 0, "first_visit": None, "last_visit": None,
+            "updated_at": now
+        })
+        for key in ("revenue", "nb_payments", "consultations", "visites", "controles"):
+            bucket[key] += row.get(key, 0)
+        if row.get("first_visit"):
+            bucket["first_visit"] = str(row["first_visit"])[:10]
+            bucket["last_visit"] = str(row["last_visit"])[:10]
+    by_patient = defaultdict(list)
+    for bucket in buckets.values():
+        bucket["revenue"] = round(bucket["revenue"], 2)
+        by_patient[bucket["patient_id"]].append(bucket)
+    appointments_by_patient = {row["_id"]: row for row in appointments if row["_id"]}
+    stats = {}
+    for patient_id in set(by_patient) | set(appointments_by_patient):
+        totals = sum_patient_months(by_patient.get(patient_id, []))
+        stats[patient_id] = patient_stats_doc(
+            patient_id, totals, totals, appointments_by_patient.get(patient_id)
+        )
+    return stats, list(buckets.values())
+
+async def refresh_patient_stats(*patient_ids):
+    """Recompute the patient stats of patients whose payments, consultations or appointments changed"""
+    patient_ids = sorted({pid for pid in patient_ids if pid})
+    if not patient_ids:
+        return
+    try:
+        existing = set(await patients_collection.distinct("id", {"id": {"$in": patient_ids}}))
+        stats, months = await compute_patient_stats(patient_ids)
+        for patient_id in patient_ids:
+            if patient_id in existing and patient_id in stats:
+                await patient_stats_collection.replace_one({"patient_id": patient_id}, stats[patient_id], upsert=True)
+                patient_months = [m for m in months if m["patient_id"] == patient_id]
+                await patient_stats_monthly_collection.delete_many(
+                    {"patient_id": patient_id, "month": {"$nin": [m["month"] for m in patient_months]}}
+                )
+                for month in patient_months:
+                    await patient_stats_monthly_collection.replace_one(
+                        {"patient_id": patient_id, "month": month["month"]}, month, upsert=True
+                    )
+            else:
+                await patient_stats_collection.delete_one({"patient_id": patient_id})
+                await patient_stats_monthly_collection.delete_many({"patient_id": patient_id})
+    except Exception as e:
+        print(f"⚠️  Patient stats refresh error for {patient_ids}: {e}")
+
+async def rebuild_patient_stats() -> int:
+    """Rebuild every patient stats document from the source collections"""
+    existing = set(await patients_collection.distinct("id"))
+    stats, months = await compute_patient_stats()
+    docs = [doc for patient_id, doc in stats.items() if patient_id in existing]
+    months = [m for m in months if m["patient_id"] in existing]
+    await patient_stats_collection.delete_many({})
+    await patient_stats_monthly_collection.delete_many({})
+    if docs:
+        await patient_stats_collection.insert_many(docs)
+    if months:
+        await patient_stats_monthly_collection.insert_many(months)
+    return len(docs)
+
+async def rank_patients_in_period(start_date: str, end_date: str, sort_field: str = "revenue",
+                                  limit: int = 10) -> Tuple[List[dict], dict]:
+    """Patients consulted during the calendar months of a period, ranked on their figures
+    summed over those months, and the totals of all of them"""
+    result = await patient_stats_monthly_collection.aggregate([
+        {"$match": {"month": {"$gte": start_date[:7], "$lte": end_date[:7]}}},
+        {"$group": {
+            "_id": "$patient_id",
+            "revenue": {"$sum": "$revenue"},
+            "nb_payments": {"$sum": "$nb_payments"},
+            "consultations": {"$sum": "$consultations"},
+            "visites": {"$sum": "$visites"},
+            "controles": {"$sum": "$controles"},
+            "first_visit": {"$min": "$first_visit"},
+            "last_visit": {"$max": "$last_visit"}
+        }},
+        {"$match": {"consultations": {"$gt": 0}}},
+        {"$addFields": {
+            "patient_id": "$_id",
+            "span_days": {"$divide": [{"$subtract": [
+                {"$dateFromString": {"dateString": "$last_visit"}},
+                {"$dateFromString": {"dateString": "$first_visit"}}
+            ]}, 86400000]}
+        }},
+        {"$addFields": {"visits_per_month": {"$round": [
+            {"$divide": ["$consultations", {"$max": [1, {"$divide": ["$span_days", 30]}]}]}, 2
+        ]}}},
+        {"$project": {"_id": 0}},
+        {"$facet": {
+            "ranked": [{"$sort": {sort_field: -1, "patient_id": 1}}, {"$limit": limit}],
+            "totals": [{"$group": {"_id": None, "patients": {"$sum": 1}, "revenue": {"$sum": "$revenue"},
+                                   "consultations": {"$sum": "$consultations"}}}]
+        }}
+    ]).to_list(length=1)
+    facets = result[0] if result else {"ranked": [], "totals": []}
+    totals = facets["totals"][0] if facets["totals"] else {"patients": 0, "revenue": 0, "consultations": 0}
+    totals.pop("_id", None)
+    return facets["ranked"], totals
+
+@app.post("/api/admin/patient-stats/rebuild")
+async def rebuild_patient_stats_endpoint():
+    """Rebuild the patient stats from payments, consultations and appointments"""
+    try:
+        patients = await rebuild_patient_stats()
+        return {"message": "Patient stats rebuilt successfully", "patients": patients}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding patient stats: {str(e)}")
+
+# ==================== PATIENT SEARCH ====================
+
+# Optional in-memory typeahead trie (per worker), the indexed prefix query is used otherwise
+PATIENT_SEARCH_TRIE = os.environ.get('PATIENT_SEARCH_TRIE', 'false').lower() == 'true'
+patient_name_trie = PatientNameTrie()
+
+async def backfill_patient_search_keys() -> int:
+    """Store search_keys on patients created before accent-folded search existed"""
+    updated = 0
+    async for patient in patients_collection.find({"search_keys": {"$exists": False}}, {"_id": 0, "id": 1, "nom": 1, "prenom": 1}):
+        await patients_collection.update_one({"id": patient["id"]}, {"$set": {"search_keys": patient_search_keys(patient)}})
+        updated += 1
+    return updated
+
+async def load_patient_name_trie():
+    """(Re)build the typeahead trie from the patients collection"""
+    trie = PatientNameTrie()
+    async for patient in patients_collection.find({}, {"_id": 0, "id": 1, "nom": 1, "prenom": 1, "search_keys": 1}):
+        trie.add(patient)
+    trie.loaded = True
+    global patient_name_trie
+    patient_name_trie = trie
+    print(f"🔎 Patient typeahead trie loaded: {len(trie)} patients")
+
+async def publish_patient_search_change(action: str, patient: Optional[dict] = None, patient_id: Optional[str] = None):
+    """Keep the typeahead trie and patient cache of every worker in sync (add, remove, reload)"""
+    event = {"action": action}
+    if patient:
+        event["patient"] = {key: patient.get(key, "") for key in PATIENT_SUMMARY_FIELDS + ("search_keys",)}
+    if patient_id:
+        event["patient_id"] = patient_id
+    await event_bus.publish("patient_search", event)
+
+async def apply_patient_search_change(event: dict):
+    if not patient_name_trie.loaded:
+        return
+    if event["action"] == "add":
+        patient_name_trie.add(event["patient"])
+    elif event["action"] == "remove":
+        patient_name_trie.remove(event["patient_id"])
+    elif event["action"] == "reload":
+        await load_patient_name_trie()
+
+event_bus.subscribe("patient_search", apply_patient_search_change)
+event_bus.subscribe("patient_search", apply_patient_cache_change)
+
+async def prepare_patient_search():
+    """Startup job: backfill search keys then load the trie if enabled"""
+    try:
+        updated = await backfill_patient_search_keys()
+        if updated:
+            await bump_data_version("patients")
+            print(f"🔎 Search keys added to {updated} patient(s)")
+        if PATIENT_SEARCH_TRIE:
+            await load_patient_name_trie()
+    except Exception as e:
+        print(f"⚠️  Patient search preparation error: {e}")
+
+# ==================== PAGINATION ====================
+
+PATIENTS_SORT = [("nom", 1), ("id", 1)]
+PAYMENTS_SORT = [("date", -1), ("id", -1)]
+PHONE_MESSAGES_SORT = [("call_date", -1), ("call_time", -1), ("id", -1)]
+
+def cursor_query(query: dict, sort: list, after: Optional[str]) -> dict:
+    """Query restricted to documents after the cursor, 400 on malformed cursors"""
+    try:
+        return after_query(query, sort, after)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def fetch_keyset_page(collection, query: dict, sort: list, limit: int,
+                            after: Optional[str] = None, skip: int = 0, projection: dict = None):
+    """One page in sort order and the cursor of the next page (None on the last page)"""
+    items = await (collection.find(cursor_query(query, sort, after), projection or {"_id": 0})
+                   .sort(sort)
+                   .skip(0 if after else skip)
+                   .limit(limit + 1)
+                   .to_list(length=None))
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(items[-1], sort)
+
+async def aggregate_keyset_page(collection, match: dict, sort: list, stages: list, limit: int,
+                                after: Optional[str] = None, skip: int = 0):
+    """One page of an aggregation: keyset match and sort first (indexed), then the other stages"""
+    pipeline = [{"$match": cursor_query(match, sort, after)}, {"$sort": dict(sort)}] + stages
+    if skip and not after:
+        pipeline.append({"$skip": skip})
+    pipeline.append({"$limit": limit + 1})
+    items = await collection.aggregate(pipeline).to_list(length=None)
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(items[-1], sort)
+
+async def aggregate_count(collection, match: dict, stages: list) -> int:
+    """Number of documents coming out of match + stages"""
+    result = await collection.aggregate([{"$match": match}] + stages + [{"$count": "count"}]).to_list(length=None)
+    return result[0]["count"] if result else 0
+
+# ==================== HTTP CACHING (ETAGS) ====================
+
+# Per-collection version counters (data_versions) bumped on write:
+# "patients", "daily_rollups" (payments, appointments, cash movements), "consultations",
+# "appointments" (any appointment write, e.g. status or room), "phone_messages",
+# "whatsapp_templates".
+# Appointment days use their own counter (rdv_versions).
+
+async def bump_data_version(*names):
+    """Increment the version counters of the given data sets"""
+    for name in names:
+        await data_versions_collection.update_one(
+            {"name": name},
+            {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now()}},
+            upsert=True
+        )
+
+async def get_data_versions(*names) -> Dict[str, int]:
+    """Current version counters of the given data sets (0 when never written)"""
+    docs = await data_versions_collection.find(
+        {"name": {"$in": list(names)}}, {"_id": 0, "name": 1, "version": 1}
+    ).to_list(length=None)
+    versions = {name: 0 for name in names}
+    versions.update({doc["name"]: doc["version"] for doc in docs})
+    return versions
+
+def make_etag(*parts) -> str:
+    """Strong ETag from the values a response depends on"""
+    digest = hashlib.sha1(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for this header)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip() in (etag, f"W/{etag}") for tag in header.split(","))
+
+def conditional_response(request: Request, response: Response, *parts) -> Optional[Response]:
+    """Set the ETag of the request URL + parts, or return a 304 when the client already has it"""
+    etag = make_etag(app.version, request.url.path, sorted(request.query_params.multi_items()), *parts)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+def today_clock(date: str) -> Optional[str]:
+    """Current minute when date is today (delayed statuses depend on the time), None otherwise"""
+    now = datetime.now()
+    return now.strftime("%H:%M") if date == now.strftime("%Y-%m-%d") else None
+
 def get_time_slots(start_hour: int = 9, end_hour: int = 18, interval_minutes: int = 15) -> List[str]:
     """Generate time slots for the day"""
     slots = []
@@ -704,6 +1630,9 @@ def update_patient_computed_fields(patient_dict: dict) -> dict:
             patient_dict['date_premiere_consultation'] = sorted_dates[0]
             patient_dict['date_derniere_consultation'] = sorted_dates[-1]
     
+    # Accent-folded name keys for indexed prefix search
+    patient_dict['search_keys'] = patient_search_keys(patient_dict)
+    
     return patient_dict
 
 # Helper function pour nettoyage automatique quotidien des messages
@@ -711,7 +1640,7 @@ async def cleanup_messages_daily():
     """Nettoyer les messages tous les jours à 8h"""
     try:
         # Supprimer tous les messages
-        result = messages_collection.delete_many({})
+        result = await messages_collection.delete_many({})
         print(f"Messages supprimés: {result.deleted_count}")
         return result.deleted_count
     except Exception as e:
@@ -723,20 +1652,21 @@ async def cleanup_phone_messages_daily():
     """Nettoyer les messages téléphoniques tous les jours à 8h"""
     try:
         # Supprimer tous les messages téléphoniques
-        result = phone_messages_collection.delete_many({})
+        result = await phone_messages_collection.delete_many({})
+        await bump_data_version("phone_messages")
         print(f"Messages téléphoniques supprimés: {result.deleted_count}")
         return result.deleted_count
     except Exception as e:
         print(f"Erreur lors du nettoyage des messages téléphoniques: {str(e)}")
         return 0
 
-def create_demo_data():
+async def create_demo_data():
     """Create demo data for testing - ONLY if data doesn't already exist"""
     # Create default users first - call the synchronous version (line 412)
-    create_default_users()
+    await create_default_users()
     
     # 🔄 CRITICAL FIX: Check if demo data already exists, don't overwrite existing data
-    existing_patients_count = patients_collection.count_documents({})
+    existing_patients_count = await patients_collection.count_documents({})
     if existing_patients_count > 0:
         print(f"✅ Demo data already exists ({existing_patients_count} patients), skipping recreation to preserve user changes")
         return
@@ -928,10 +1858,10 @@ def create_demo_data():
     ]
 
     # Clear existing data
-    patients_collection.delete_many({})
-    appointments_collection.delete_many({})
-    consultations_collection.delete_many({})
-    payments_collection.delete_many({})
+    await patients_collection.delete_many({})
+    await appointments_collection.delete_many({})
+    await consultations_collection.delete_many({})
+    await payments_collection.delete_many({})
 
     # Insert demo data
     for patient in demo_patients:
@@ -939,12 +1869,16 @@ def create_demo_data():
         patient['updated_at'] = datetime.now()
         # Apply computed fields
         patient = update_patient_computed_fields(patient)
-        patients_collection.insert_one(patient)
+        await patients_collection.insert_one(patient)
+
+    await bump_data_version("patients")
+    await publish_patient_search_change("reload")
 
     for appointment in demo_appointments:
         appointment['created_at'] = datetime.now()
         appointment['updated_at'] = datetime.now()
-        appointments_collection.insert_one(appointment)
+        await appointments_collection.insert_one(appointment)
+    await reset_day_versions(a["date"] for a in demo_appointments)
 
     # Demo consultations
     demo_consultations = [
@@ -1062,7 +1996,9 @@ def create_demo_data():
     ]
 
     for consultation in demo_consultations:
-        consultations_collection.insert_one(consultation)
+        await consultations_collection.insert_one(consultation)
+    await backfill_last_consultation_dates(only_missing=False)
+    await bump_data_version("consultations")
 
     # Demo payments
     demo_payments = [
@@ -1140,7 +2076,9 @@ def create_demo_data():
     ]
 
     for payment in demo_payments:
-        payments_collection.insert_one(payment)
+        await payments_collection.insert_one(payment)
+    await rebuild_daily_rollups()
+    await rebuild_patient_stats()
 
 # API Routes
 @app.get("/")
@@ -1152,7 +2090,7 @@ async def force_create_users():
     """Force create default users - for emergency login fix"""
     try:
         # Clear existing users first
-        users_collection.delete_many({})
+        await users_collection.delete_many({})
         
         # Create default doctor
         doctor_permissions = UserPermissions(
@@ -1168,7 +2106,7 @@ async def force_create_users():
             username="medecin",
             full_name="Dr Heni Dridi",
             role="medecin",
-            hashed_password=hash_password("medecin123"),
+            hashed_password=await hash_password("medecin123"),
             permissions=doctor_permissions
         )
         
@@ -1187,13 +2125,13 @@ async def force_create_users():
             username="secretaire",
             full_name="Secrétaire Médicale",
             role="secretaire",
-            hashed_password=hash_password("secretaire123"),
+            hashed_password=await hash_password("secretaire123"),
             permissions=secretary_permissions
         )
         
         # Insert users
-        users_collection.insert_one(doctor.dict())
-        users_collection.insert_one(secretary.dict())
+        await users_collection.insert_one(doctor.dict())
+        await users_collection.insert_one(secretary.dict())
         
         return {
             "message": "Default users created successfully",
@@ -1211,14 +2149,14 @@ async def reset_demo_data():
     """Force reset and recreate demo data - USE WITH CAUTION"""
     try:
         # Clear existing data
-        patients_collection.delete_many({})
-        appointments_collection.delete_many({})
-        consultations_collection.delete_many({})
-        users_collection.delete_many({})
-        messages_collection.delete_many({})
+        await patients_collection.delete_many({})
+        await appointments_collection.delete_many({})
+        await consultations_collection.delete_many({})
+        await users_collection.delete_many({})
+        await messages_collection.delete_many({})
         
         # Recreate demo data
-        create_demo_data()
+        await create_demo_data()
         
         return {
             "message": "Demo data reset and recreated successfully",
@@ -1233,8 +2171,8 @@ async def init_demo_data():
     """Initialize demo data including default users - Only if data doesn't exist"""
     try:
         # 🔄 CRITICAL FIX: Check if data already exists
-        existing_patients_count = patients_collection.count_documents({})
-        existing_appointments_count = appointments_collection.count_documents({})
+        existing_patients_count = await patients_collection.count_documents({})
+        existing_appointments_count = await appointments_collection.count_documents({})
         
         if existing_patients_count > 0 or existing_appointments_count > 0:
             return {
@@ -1244,7 +2182,7 @@ async def init_demo_data():
                 "action": "skipped"
             }
         
-        create_demo_data()
+        await create_demo_data()
         return {
             "message": "Demo data initialized successfully",
             "action": "created"
@@ -1261,7 +2199,7 @@ async def get_birthdays_today():
         today_str = today.strftime("%m-%d")  # Format MM-DD for comparison
         
         # Find patients with birthdays today
-        patients = list(patients_collection.find({}, {"_id": 0}))
+        patients = await patients_collection.find({}, {"_id": 0}).to_list(length=None)
         
         birthdays_today = []
         for patient in patients:
@@ -1301,17 +2239,19 @@ async def get_phone_reminders_today():
         today_str = datetime.now().strftime("%Y-%m-%d")
         
         # Find consultations with relance_date for today
-        consultations_with_relance = list(consultations_collection.find({
+        consultations_with_relance = await consultations_collection.find({
             "relance_date": today_str
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
+        
+        patients_by_id = await get_patient_summaries(c.get("patient_id") for c in consultations_with_relance)
         
         reminders = []
         for consultation in consultations_with_relance:
             # Get patient info
-            patient = patients_collection.find_one({"id": consultation["patient_id"]}, {"_id": 0})
+            patient = patients_by_id.get(consultation["patient_id"])
             if patient:
                 # Get the original appointment info
-                appointment = appointments_collection.find_one({
+                appointment = await appointments_collection.find_one({
                     "id": consultation["appointment_id"]
                 }, {"_id": 0})
                 
@@ -1344,15 +2284,17 @@ async def get_vaccine_reminders_today():
         today_str = datetime.now().strftime("%Y-%m-%d")
         
         # Find consultations with vaccine reminders for today
-        consultations_with_vaccine = list(consultations_collection.find({
+        consultations_with_vaccine = await consultations_collection.find({
             "rappel_vaccin": True,
             "date_vaccin": today_str
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
+        
+        patients_by_id = await get_patient_summaries(c.get("patient_id") for c in consultations_with_vaccine)
         
         vaccine_reminders = []
         for consultation in consultations_with_vaccine:
             # Get patient info
-            patient = patients_collection.find_one({"id": consultation["patient_id"]}, {"_id": 0})
+            patient = patients_by_id.get(consultation["patient_id"])
             if patient:
                 vaccine_reminders.append({
                     "id": consultation["id"],
@@ -1372,12 +2314,17 @@ async def get_vaccine_reminders_today():
         raise HTTPException(status_code=500, detail=f"Error fetching vaccine reminders: {str(e)}")
 
 @app.get("/api/dashboard")
-async def get_dashboard():
+async def get_dashboard(request: Request, response: Response):
     """Get dashboard statistics"""
     today = datetime.now().strftime("%Y-%m-%d")
     
+    day, versions = await asyncio.gather(get_day_version(today), get_data_versions("patients", "daily_rollups"))
+    not_modified = conditional_response(request, response, today, day["version"], versions)
+    if not_modified:
+        return not_modified
+    
     # Get today's appointments
-    today_appointments = list(appointments_collection.find({"date": today}))
+    today_appointments = await appointments_collection.find({"date": today}).to_list(length=None)
     total_rdv = len(today_appointments)
     
     # Count by status
@@ -1390,7 +2337,7 @@ async def get_dashboard():
     recette_jour = await get_daily_cash_balance()
     
     # Get patient count
-    total_patients = patients_collection.count_documents({})
+    total_patients = await patients_collection.count_documents({})
     
     # Calculate real average waiting time
     appointments_with_waiting_time = [a for a in today_appointments if a.get("duree_attente") is not None]
@@ -1413,49 +2360,52 @@ async def get_dashboard():
 
 @app.get("/api/patients")
 async def get_patients(
+    request: Request,
+    response: Response,
     page: int = Query(1, ge=1, description="Page number"),
     limit: int = Query(10, ge=1, le=100, description="Items per page"),
-    search: str = Query("", description="Search by name or birth date")
+    search: str = Query("", description="Search by name or birth date"),
+    after: Optional[str] = Query(None, description="Cursor of the next page (next_cursor of the previous response)"),
+    include_total: bool = Query(True, description="Also count all matching patients")
 ):
-    """Get patients with pagination and search"""
-    # Build search query
-    query = {}
-    if search:
-        search_regex = {"$regex": search, "$options": "i"}
-        query["$or"] = [
-            {"nom": search_regex},
-            {"prenom": search_regex},
-            {"date_naissance": search_regex}
-        ]
-    
-    # Count total documents
-    total_count = patients_collection.count_documents(query)
+    """Get patients with pagination and search (page numbers or keyset cursor)"""
+    # Ages are computed for today
+    today = datetime.now().strftime("%Y-%m-%d")
+    not_modified = conditional_response(request, response, today, await get_data_versions("patients"))
+    if not_modified:
+        return not_modified
     
-    # Calculate pagination
-    skip = (page - 1) * limit
+    # Build search query (anchored prefix on accent-folded names or birth date)
+    query = build_patient_search_query(search) if search else {}
     
-    # Get patients with pagination
-    patients = list(patients_collection.find(query, {"_id": 0})
-                   .skip(skip)
-                   .limit(limit)
-                   .sort("nom", 1))
+    # Get patients sorted by (nom, id), cursor pages cost the same at any depth
+    patients, next_cursor = await fetch_keyset_page(
+        patients_collection, query, PATIENTS_SORT, limit, after=after, skip=(page - 1) * limit
+    )
     
     # Update computed fields for each patient
     for patient in patients:
         patient = update_patient_computed_fields(patient)
     
+    # Count total documents (optional)
+    total_count = await patients_collection.count_documents(query) if include_total else None
+    
     return {
         "patients": patients,
         "total_count": total_count,
         "page": page,
         "limit": limit,
-        "total_pages": (total_count + limit - 1) // limit
+        "total_pages": (total_count + limit - 1) // limit if include_total else None,
+        "next_cursor": next_cursor
     }
 
 @app.get("/api/patients/count")
-async def get_patients_count():
+async def get_patients_count(
+    search: str = Query("", description="Count only patients matching this search")
+):
     """Get total number of patients"""
-    count = patients_collection.count_documents({})
+    query = build_patient_search_query(search) if search else {}
+    count = await patients_collection.count_documents(query)
     return {"count": count}
 
 @app.get("/api/patients/search")
@@ -1467,24 +2417,30 @@ async def search_patients(
         if not q:
             return {"patients": []}
         
-        # Search by name (case insensitive)
-        search_regex = {"$regex": q, "$options": "i"}
-        query = {
-            "$or": [
-                {"nom": search_regex},
-                {"prenom": search_regex}
-            ]
-        }
-        
-        # Get matching patients (limit to 20 results)
-        patients = list(patients_collection.find(query, {
+        projection = {
             "_id": 0,
             "id": 1,
             "nom": 1,
             "prenom": 1,
             "age": 1,
             "numero_whatsapp": 1
-        }).limit(20))
+        }
+        
+        # Typeahead from the in-memory trie when loaded (names only, birth dates use the index)
+        if patient_name_trie.loaded and not DATE_SEARCH_PATTERN.match(q.strip()):
+            ids = patient_name_trie.search(q, limit=20)
+            patients = await patients_collection.find({"id": {"$in": ids}}, projection).to_list(length=None)
+            order = {patient_id: i for i, patient_id in enumerate(ids)}
+            patients.sort(key=lambda p: order.get(p["id"], len(order)))
+            return {"patients": patients}
+        
+        # Search by name prefix (case and accent insensitive, indexed)
+        query = build_patient_search_query(q)
+        if not query:
+            return {"patients": []}
+        
+        # Get matching patients (limit to 20 results)
+        patients = await patients_collection.find(query, projection).limit(20).to_list(length=None)
         
         return {"patients": patients}
         
@@ -1492,9 +2448,14 @@ async def search_patients(
         raise HTTPException(status_code=500, detail=f"Error searching patients: {str(e)}")
 
 @app.get("/api/patients/{patient_id}")
-async def get_patient(patient_id: str):
+async def get_patient(patient_id: str, request: Request, response: Response):
     """Get patient by ID"""
-    patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
+    today = datetime.now().strftime("%Y-%m-%d")
+    not_modified = conditional_response(request, response, today, await get_data_versions("patients"))
+    if not_modified:
+        return not_modified
+    
+    patient = await patients_collection.find_one({"id": patient_id}, {"_id": 0})
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -1506,15 +2467,15 @@ async def get_patient(patient_id: str):
 @app.get("/api/patients/{patient_id}/consultations")
 async def get_patient_consultations_full(patient_id: str):
     """Get full consultation details for a patient"""
-    patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
+    patient = await patients_collection.find_one({"id": patient_id}, {"_id": 0})
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     # Get consultations from consultations collection
-    consultations = list(consultations_collection.find({"patient_id": patient_id}, {"_id": 0}))
+    consultations = await consultations_collection.find({"patient_id": patient_id}, {"_id": 0}).to_list(length=None)
     
     # Get appointments to get type information
-    appointments = list(appointments_collection.find({"patient_id": patient_id}, {"_id": 0}))
+    appointments = await appointments_collection.find({"patient_id": patient_id}, {"_id": 0}).to_list(length=None)
     
     # Combine consultation and appointment data
     result = []
@@ -1544,7 +2505,11 @@ async def create_patient(patient: Patient):
     patient_dict = update_patient_computed_fields(patient_dict)
     
     # Insert into database
-    patients_collection.insert_one(patient_dict)
+    patient_dict["last_consultation_date"] = ""
+    await patients_collection.insert_one(patient_dict)
+    await bump_data_version("patients")
+    await publish_patient_search_change("add", patient_dict)
+    await manager.publish("dashboard", {"type": "dashboard_changed", "reason": "patients"}, coalesce_key="dashboard_changed")
     return {"message": "Patient created successfully", "patient_id": patient.id}
 
 @app.put("/api/patients/{patient_id}")
@@ -1556,71 +2521,118 @@ async def update_patient(patient_id: str, patient: Patient):
     # Update computed fields
     patient_dict = update_patient_computed_fields(patient_dict)
     
-    result = patients_collection.update_one(
+    result = await patients_collection.update_one(
         {"id": patient_id}, 
         {"$set": patient_dict}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Patient not found")
+    await bump_data_version("patients")
+    await publish_patient_search_change("add", {**patient_dict, "id": patient_id})
     return {"message": "Patient updated successfully"}
 
 @app.delete("/api/patients/{patient_id}")
 async def delete_patient(patient_id: str):
     """Delete patient"""
-    result = patients_collection.delete_one({"id": patient_id})
+    result = await patients_collection.delete_one({"id": patient_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Patient not found")
+    await refresh_patient_stats(patient_id)
+    await bump_data_version("patients")
+    await publish_patient_search_change("remove", patient_id=patient_id)
+    await manager.publish("dashboard", {"type": "dashboard_changed", "reason": "patients"}, coalesce_key="dashboard_changed")
     return {"message": "Patient deleted successfully"}
 
 @app.get("/api/rdv/jour/{date}")
-async def get_rdv_jour(date: str):
+async def get_rdv_jour(date: str, request: Request, response: Response):
     """Get appointments for a specific day with patient info and auto status check"""
-    appointments = list(appointments_collection.find({"date": date}, {"_id": 0}))
+    # Version read first: changes made while loading show up in the next /changes call
+    day, versions = await asyncio.gather(get_day_version(date), get_data_versions("patients"))
+    response.headers["X-Rdv-Version"] = str(day["version"])
+    not_modified = conditional_response(request, response, day["version"], versions, today_clock(date))
+    if not_modified:
+        not_modified.headers["X-Rdv-Version"] = str(day["version"])
+        return not_modified
+    
+    appointments = await appointments_collection.find({"date": date}, {"_id": 0}).to_list(length=None)
+    return sort_day_appointments(await enrich_day_appointments(appointments))
+
+@app.get("/api/rdv/jour/{date}/changes")
+async def get_rdv_jour_changes(
+    date: str,
+    since: int = Query(0, ge=0, description="Version of the day already known by the client (X-Rdv-Version)")
+):
+    """Appointments of a day modified since a version, 304 when nothing changed"""
+    day = await get_day_version(date)
+    version = day["version"]
+    if since == version:
+        return Response(status_code=304, headers={"X-Rdv-Version": str(version)})
+    
+    # Version beyond the stable one (e.g. learned from a websocket delta of a pending write)
+    # or bulk rewrite since then: the whole day, at the stable version
+    if since > version or since < day.get("reset_version", 0):
+        appointments = await appointments_collection.find({"date": date}, {"_id": 0}).to_list(length=None)
+        return {
+            "date": date,
+            "since": since,
+            "version": version,
+            "full_reload": True,
+            "changed": sort_day_appointments(await enrich_day_appointments(appointments)),
+            "deleted": []
+        }
+    
+    changed = await appointments_collection.find(
+        {"date": date, "version": {"$gt": since}}, {"_id": 0}
+    ).to_list(length=None)
+    changed_ids = {a["id"] for a in changed}
+    deleted = sorted({
+        t["id"] for t in day.get("deleted", [])
+        if t["version"] > since and t["id"] not in changed_ids
+    })
+    
+    return {
+        "date": date,
+        "since": since,
+        "version": version,
+        "full_reload": False,
+        "changed": sort_day_appointments(await enrich_day_appointments(changed)),
+        "deleted": deleted
+    }
+
+async def enrich_day_appointments(appointments: List[dict]) -> List[dict]:
+    """Delay status, duree_attente and patient summary of calendar appointments"""
+    # Get patient info in one query for all appointments of the day
+    patients_by_id = await get_patient_summaries(a.get("patient_id") for a in appointments)
     
-    # Get patient info and check delays for each appointment
+    # Check delays for each appointment
     for appointment in appointments:
-        # Check for delays and update status if needed
-        current_status = check_appointment_delay(appointment)
-        if current_status != appointment["statut"]:
-            appointment["statut"] = current_status
-            # Update in database
-            appointments_collection.update_one(
-                {"id": appointment["id"]},
-                {"$set": {"statut": current_status, "updated_at": datetime.now()}}
-            )
+        # Delayed status is persisted by the background sweeper, only reflect it here
+        appointment["statut"] = check_appointment_delay(appointment)
         
         # CORRECTION: Ensure duree_attente is always present in API response
         if "duree_attente" not in appointment:
             appointment["duree_attente"] = None  # Make sure field exists even if null
             print(f"DEBUG: Added missing duree_attente field for appointment {appointment.get('id', 'UNKNOWN')}")
         
-        # Get patient info
-        patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
+        # Attach patient info
+        patient = patients_by_id.get(appointment["patient_id"])
         if patient:
-            appointment["patient"] = {
-                "id": patient.get("id", ""),
-                "nom": patient.get("nom", ""),
-                "prenom": patient.get("prenom", ""),
-                "numero_whatsapp": patient.get("numero_whatsapp", ""),
-                "lien_whatsapp": patient.get("lien_whatsapp", "")
-            }
-    
-    # Sort appointments - by priority for waiting patients, by time for others
-    def sort_appointments(appointments):
-        def sort_key(apt):
-            if apt["statut"] == "attente":
-                # For waiting patients, sort by priority (lower number = higher priority)
-                return (0, apt.get("priority", 999))
-            else:
-                # For other statuses, sort by time
-                return (1, apt["heure"])
-        
-        return sorted(appointments, key=sort_key)
-    
-    appointments = sort_appointments(appointments)
+            appointment["patient"] = build_calendar_patient(patient)
     
     return appointments
 
+def sort_day_appointments(appointments: List[dict]) -> List[dict]:
+    """Sort appointments - by priority for waiting patients, by time for others"""
+    def sort_key(apt):
+        if apt["statut"] == "attente":
+            # For waiting patients, sort by priority (lower number = higher priority)
+            return (0, apt.get("priority", 999))
+        else:
+            # For other statuses, sort by time
+            return (1, apt["heure"])
+    
+    return sorted(appointments, key=sort_key)
+
 @app.get("/api/rdv/semaine/{date}")
 async def get_rdv_semaine(date: str):
     """Get appointments for the week containing the given date (Monday to Saturday)"""
@@ -1630,31 +2642,22 @@ async def get_rdv_semaine(date: str):
         raise HTTPException(status_code=400, detail="Invalid date format")
     
     # Get appointments for all days of the week
-    appointments = list(appointments_collection.find(
+    appointments = await appointments_collection.find(
         {"date": {"$in": week_dates}}, 
         {"_id": 0}
-    ))
+    ).to_list(length=None)
+    
+    # Get patient info in one query for the whole week
+    patients_by_id = await get_patient_summaries(a.get("patient_id") for a in appointments)
     
     # Add patient info for each appointment
     for appointment in appointments:
-        # Check for delays and update status if needed
-        current_status = check_appointment_delay(appointment)
-        if current_status != appointment["statut"]:
-            appointment["statut"] = current_status
-            appointments_collection.update_one(
-                {"id": appointment["id"]},
-                {"$set": {"statut": current_status, "updated_at": datetime.now()}}
-            )
+        # Delayed status is persisted by the background sweeper, only reflect it here
+        appointment["statut"] = check_appointment_delay(appointment)
         
-        patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
+        patient = patients_by_id.get(appointment["patient_id"])
         if patient:
-            appointment["patient"] = {
-                "id": patient.get("id", ""),
-                "nom": patient.get("nom", ""),
-                "prenom": patient.get("prenom", ""),
-                "numero_whatsapp": patient.get("numero_whatsapp", ""),
-                "lien_whatsapp": patient.get("lien_whatsapp", "")
-            }
+            appointment["patient"] = build_calendar_patient(patient)
     
     # Sort by date and time
     appointments.sort(key=lambda x: (x["date"], x["heure"]))
@@ -1703,8 +2706,11 @@ async def update_rdv(rdv_id: str, update_data: dict):
                 "date_paiement": None
             })
         
+        # Previous payment date, needed to refresh its daily rollup
+        previous_payment = await payments_collection.find_one({"appointment_id": rdv_id}, {"_id": 0, "date": 1})
+        
         # Update appointment
-        result = appointments_collection.update_one(
+        result = await appointments_collection.update_one(
             {"id": rdv_id},
             {"$set": update_fields}
         )
@@ -1727,19 +2733,29 @@ async def update_rdv(rdv_id: str, update_data: dict):
             }
             
             # Get patient_id from appointment
-            appointment = appointments_collection.find_one({"id": rdv_id})
+            appointment = await appointments_collection.find_one({"id": rdv_id})
             if appointment:
                 payment_record["patient_id"] = appointment.get("patient_id", "")
             
             # Insert or update payment record
-            payments_collection.update_one(
+            await payments_collection.update_one(
                 {"appointment_id": rdv_id},
                 {"$set": payment_record},
                 upsert=True
             )
         else:
             # Remove payment record for visite (will be unpaid by default)
-            payments_collection.delete_one({"appointment_id": rdv_id})
+            await payments_collection.delete_one({"appointment_id": rdv_id})
+        
+        appointment = await appointments_collection.find_one({"id": rdv_id}, {"_id": 0, "date": 1, "patient_id": 1})
+        await refresh_daily_rollups(
+            appointment.get("date") if appointment else None,
+            previous_payment.get("date") if previous_payment else None,
+            datetime.now().strftime("%Y-%m-%d")
+        )
+        if appointment:
+            await refresh_patient_stats(appointment.get("patient_id"))
+            await record_appointment_change("updated", rdv_id, update_fields, appointment.get("date"))
         
         return {
             "message": "Appointment updated successfully", 
@@ -1791,7 +2807,7 @@ async def update_rdv_statut(rdv_id: str, status_data: dict):
         print(f"DEBUG: Patient moved to attente - stored UTC heure_arrivee_attente: {update_data['heure_arrivee_attente']}")
     
     # Si on quitte l'attente vers n'importe quel autre statut, calculer et stocker duree_attente pour les statistiques
-    current_appointment = appointments_collection.find_one({"id": rdv_id}, {"_id": 0})
+    current_appointment = await appointments_collection.find_one({"id": rdv_id}, {"_id": 0})
     calculated_duree_attente = None  # Variable pour stocker la durée calculée
     
     if (current_appointment and 
@@ -1879,7 +2895,7 @@ async def update_rdv_statut(rdv_id: str, status_data: dict):
         if salle in valid_salles:
             update_data["salle"] = salle
     
-    result = appointments_collection.update_one(
+    result = await appointments_collection.update_one(
         {"id": rdv_id},
         {"$set": update_data}
     )
@@ -1887,6 +2903,12 @@ async def update_rdv_statut(rdv_id: str, status_data: dict):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    if current_appointment and current_appointment.get("statut") != statut:
+        await refresh_patient_stats(current_appointment.get("patient_id"))
+    await record_appointment_change(
+        "updated", rdv_id, update_data, current_appointment.get("date") if current_appointment else None
+    )
+    
     # Return the updated appointment data including calculated duree_attente
     response_data = {"message": "Status updated successfully", "statut": statut}
     
@@ -1907,7 +2929,7 @@ async def update_rdv_salle(rdv_id: str, salle: str):
     if salle not in valid_salles:
         raise HTTPException(status_code=400, detail=f"Invalid room. Must be one of: {valid_salles}")
     
-    result = appointments_collection.update_one(
+    result = await appointments_collection.update_one(
         {"id": rdv_id},
         {"$set": {"salle": salle, "updated_at": datetime.now()}}
     )
@@ -1915,6 +2937,8 @@ async def update_rdv_salle(rdv_id: str, salle: str):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    await record_appointment_change("updated", rdv_id, {"salle": salle})
+    
     return {"message": "Room assignment updated successfully", "salle": salle}
 
 @app.put("/api/rdv/{rdv_id}/paiement")
@@ -1922,7 +2946,7 @@ async def update_rdv_paiement(rdv_id: str, payment_data: PaymentUpdate):
     """Update appointment payment status with unified payment logic"""
     try:
         # Get appointment details
-        appointment = appointments_collection.find_one({"id": rdv_id})
+        appointment = await appointments_collection.find_one({"id": rdv_id})
         if not appointment:
             raise HTTPException(status_code=404, detail="Appointment not found")
         
@@ -1953,7 +2977,10 @@ async def update_rdv_paiement(rdv_id: str, payment_data: PaymentUpdate):
             "updated_at": datetime.now()
         }
         
-        result = appointments_collection.update_one(
+        # Previous payment date, needed to refresh its daily rollup
+        previous_payment = await payments_collection.find_one({"appointment_id": rdv_id}, {"_id": 0, "date": 1})
+        
+        result = await appointments_collection.update_one(
             {"id": rdv_id},
             {"$set": update_data}
         )
@@ -1980,14 +3007,22 @@ async def update_rdv_paiement(rdv_id: str, payment_data: PaymentUpdate):
             }
             
             # Upsert payment record (create or update)
-            payments_collection.update_one(
+            await payments_collection.update_one(
                 {"appointment_id": rdv_id},
                 {"$set": payment_record},
                 upsert=True
             )
         else:
             # Remove payment record if unpaid or refunded
-            payments_collection.delete_one({"appointment_id": rdv_id})
+            await payments_collection.delete_one({"appointment_id": rdv_id})
+        
+        await refresh_daily_rollups(
+            appointment.get("date"),
+            previous_payment.get("date") if previous_payment else None,
+            datetime.now().strftime("%Y-%m-%d")
+        )
+        await refresh_patient_stats(appointment.get("patient_id"))
+        await record_appointment_change("updated", rdv_id, update_data, appointment.get("date"))
         
         return {
             "message": "Payment and consultation type updated successfully", 
@@ -2006,10 +3041,10 @@ async def update_rdv_paiement(rdv_id: str, payment_data: PaymentUpdate):
 @app.get("/api/payments/appointment/{appointment_id}")
 async def get_payment_by_appointment(appointment_id: str):
     """Get payment details for a specific appointment"""
-    payment = payments_collection.find_one({"appointment_id": appointment_id}, {"_id": 0})
+    payment = await payments_collection.find_one({"appointment_id": appointment_id}, {"_id": 0})
     if not payment:
         # Check if appointment exists and is a controle (free)
-        appointment = appointments_collection.find_one({"id": appointment_id})
+        appointment = await appointments_collection.find_one({"id": appointment_id})
         if appointment and appointment.get("type_rdv") == "controle":
             return {
                 "appointment_id": appointment_id,
@@ -2035,7 +3070,7 @@ async def update_rdv_whatsapp(rdv_id: str, whatsapp_data: dict):
             "updated_at": datetime.now()
         }
         
-        result = appointments_collection.update_one(
+        result = await appointments_collection.update_one(
             {"id": rdv_id},
             {"$set": update_data}
         )
@@ -2043,6 +3078,8 @@ async def update_rdv_whatsapp(rdv_id: str, whatsapp_data: dict):
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Appointment not found")
         
+        await record_appointment_change("updated", rdv_id, update_data)
+        
         return {
             "message": "WhatsApp status updated successfully",
             "whatsapp_envoye": whatsapp_envoye,
@@ -2056,19 +3093,18 @@ async def update_rdv_whatsapp(rdv_id: str, whatsapp_data: dict):
         raise HTTPException(status_code=500, detail=f"Error updating WhatsApp status: {str(e)}")
 
 @app.get("/api/rdv/stats/{date}")
-async def get_rdv_stats(date: str):
+async def get_rdv_stats(date: str, request: Request, response: Response):
     """Get appointment statistics for a specific day"""
-    appointments = list(appointments_collection.find({"date": date}, {"_id": 0}))
+    day, versions = await asyncio.gather(get_day_version(date), get_data_versions("daily_rollups"))
+    not_modified = conditional_response(request, response, day["version"], versions, today_clock(date))
+    if not_modified:
+        return not_modified
     
-    # Update statuses for any delayed appointments
+    appointments = await appointments_collection.find({"date": date}, {"_id": 0}).to_list(length=None)
+    
+    # Reflect delayed statuses (persisted by the background sweeper)
     for appointment in appointments:
-        current_status = check_appointment_delay(appointment)
-        if current_status != appointment["statut"]:
-            appointments_collection.update_one(
-                {"id": appointment["id"]},
-                {"$set": {"statut": current_status, "updated_at": datetime.now()}}
-            )
-            appointment["statut"] = current_status
+        appointment["statut"] = check_appointment_delay(appointment)
     
     total_rdv = len(appointments)
     visites = len([a for a in appointments if a["type_rdv"] == "visite"])
@@ -2087,7 +3123,7 @@ async def get_rdv_stats(date: str):
     taux_presence = (presents / total_rdv * 100) if total_rdv > 0 else 0
     
     # Get payments for the day
-    payments = list(payments_collection.find({"date": date, "statut": "paye"}, {"_id": 0}))
+    payments = await payments_collection.find({"date": date, "statut": "paye"}, {"_id": 0}).to_list(length=None)
     ca_realise = sum([p["montant"] for p in payments])
     
     # Estimate CA based on paid/unpaid appointments
@@ -2126,7 +3162,7 @@ async def get_available_time_slots(date: str = Query(...), exclude_id: str = Que
     if exclude_id:
         query["id"] = {"$ne": exclude_id}
     
-    existing_appointments = list(appointments_collection.find(query, {"heure": 1, "_id": 0}))
+    existing_appointments = await appointments_collection.find(query, {"heure": 1, "_id": 0}).to_list(length=None)
     occupied_slots = [apt["heure"] for apt in existing_appointments]
     
     # Mark slots as available or occupied
@@ -2147,11 +3183,11 @@ async def get_appointments(date: Optional[str] = None):
     if date:
         query["date"] = date
     
-    appointments = list(appointments_collection.find(query, {"_id": 0}))
+    appointments = await appointments_collection.find(query, {"_id": 0}).to_list(length=None)
     
     # Get patient info for each appointment
     for appointment in appointments:
-        patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
+        patient = await patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
         if patient:
             appointment["patient"] = patient
     
@@ -2167,7 +3203,10 @@ async def get_today_appointments():
 async def create_appointment(appointment: Appointment):
     """Create new appointment"""
     appointment_dict = appointment.dict()
-    appointments_collection.insert_one(appointment_dict)
+    await appointments_collection.insert_one(appointment_dict)
+    await refresh_daily_rollups(appointment_dict.get("date"))
+    await refresh_patient_stats(appointment_dict.get("patient_id"))
+    await record_appointment_change("created", appointment.id, appointment_dict, appointment_dict.get("date"))
     return {"message": "Appointment created successfully", "appointment_id": appointment.id}
 
 @app.put("/api/appointments/{appointment_id}")
@@ -2175,20 +3214,32 @@ async def update_appointment(appointment_id: str, appointment: Appointment):
     """Update appointment"""
     appointment_dict = appointment.dict()
     appointment_dict["updated_at"] = datetime.now()
-    result = appointments_collection.update_one(
+    previous = await appointments_collection.find_one({"id": appointment_id}, {"_id": 0, "date": 1, "patient_id": 1})
+    result = await appointments_collection.update_one(
         {"id": appointment_id}, 
         {"$set": appointment_dict}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Appointment not found")
+    await refresh_daily_rollups(appointment_dict.get("date"), previous.get("date") if previous else None)
+    await refresh_patient_stats(appointment_dict.get("patient_id"), previous.get("patient_id") if previous else None)
+    if previous and previous.get("date") != appointment_dict.get("date"):
+        # Moved to another day: gone from the old day, new on the other one
+        await record_appointment_change("deleted", appointment_id, date=previous.get("date"))
+        await record_appointment_change("created", appointment_id, {**appointment_dict, "id": appointment_id}, appointment_dict.get("date"))
+    else:
+        await record_appointment_change("updated", appointment_id, appointment_dict, appointment_dict.get("date"))
     return {"message": "Appointment updated successfully"}
 
 @app.delete("/api/appointments/{appointment_id}")
 async def delete_appointment(appointment_id: str):
     """Delete appointment"""
-    result = appointments_collection.delete_one({"id": appointment_id})
-    if result.deleted_count == 0:
+    deleted = await appointments_collection.find_one_and_delete({"id": appointment_id}, {"_id": 0, "date": 1, "patient_id": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Appointment not found")
+    await refresh_daily_rollups(deleted.get("date"))
+    await refresh_patient_stats(deleted.get("patient_id"))
+    await record_appointment_change("deleted", appointment_id, date=deleted.get("date"))
     return {"message": "Appointment deleted successfully"}
 
 @app.get("/api/consultations/{consultation_id}")
@@ -2196,15 +3247,15 @@ async def get_consultation_details(consultation_id: str):
     """Get detailed consultation information"""
     try:
         # Get consultation
-        consultation = consultations_collection.find_one({"id": consultation_id}, {"_id": 0})
+        consultation = await consultations_collection.find_one({"id": consultation_id}, {"_id": 0})
         if not consultation:
             raise HTTPException(status_code=404, detail="Consultation not found")
         
         # Get patient information
-        patient = patients_collection.find_one({"id": consultation["patient_id"]}, {"_id": 0})
+        patient = await patients_collection.find_one({"id": consultation["patient_id"]}, {"_id": 0})
         
         # Get appointment information
-        appointment = appointments_collection.find_one({"id": consultation.get("appointment_id")}, {"_id": 0})
+        appointment = await appointments_collection.find_one({"id": consultation.get("appointment_id")}, {"_id": 0})
         
         # Enrich consultation with related data
         consultation_details = {
@@ -2236,18 +3287,18 @@ async def get_consultation_details(consultation_id: str):
 @app.get("/api/consultations")
 async def get_consultations():
     """Get all consultations"""
-    consultations = list(consultations_collection.find({}, {"_id": 0}))
+    consultations = await consultations_collection.find({}, {"_id": 0}).to_list(length=None)
     return consultations
 
 @app.get("/api/consultations/patient/{patient_id}")
 async def get_patient_consultations(patient_id: str):
     """Get consultations for a specific patient"""
     # Check if patient exists
-    patient = patients_collection.find_one({"id": patient_id})
+    patient = await patients_collection.find_one({"id": patient_id})
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
-    consultations = list(consultations_collection.find({"patient_id": patient_id}, {"_id": 0}))
+    consultations = await consultations_collection.find({"patient_id": patient_id}, {"_id": 0}).to_list(length=None)
     return consultations
 
 @app.post("/api/consultations")
@@ -2259,7 +3310,7 @@ async def create_consultation(consultation: Consultation):
     if consultation.appointment_id:
         try:
             # Récupérer l'appointment pour obtenir duree_attente et salle
-            appointment = appointments_collection.find_one({"id": consultation.appointment_id}, {"_id": 0})
+            appointment = await appointments_collection.find_one({"id": consultation.appointment_id}, {"_id": 0})
             if appointment:
                 # Ajouter duree_attente et salle à la consultation
                 consultation_dict["duree_attente"] = appointment.get("duree_attente")
@@ -2270,17 +3321,21 @@ async def create_consultation(consultation: Consultation):
         except Exception as e:
             print(f"❌ Erreur enrichissement consultation: {e}")
     
-    consultations_collection.insert_one(consultation_dict)
+    await consultations_collection.insert_one(consultation_dict)
+    await refresh_last_consultation_date(consultation_dict.get("patient_id"))
+    await refresh_patient_stats(consultation_dict.get("patient_id"))
+    await bump_data_version("consultations")
     
     # Mettre à jour le statut du rendez-vous à "terminé"
     if consultation.appointment_id:
         try:
-            result = appointments_collection.update_one(
+            result = await appointments_collection.update_one(
                 {"id": consultation.appointment_id},
                 {"$set": {"statut": "termine"}}
             )
             if result.modified_count > 0:
                 print(f"✅ Rendez-vous {consultation.appointment_id} marqué comme terminé")
+                await record_appointment_change("updated", consultation.appointment_id, {"statut": "termine"})
             else:
                 print(f"⚠️ Rendez-vous {consultation.appointment_id} non trouvé pour mise à jour")
         except Exception as e:
@@ -2292,18 +3347,22 @@ async def create_consultation(consultation: Consultation):
 async def update_consultation(consultation_id: str, consultation_data: dict):
     """Update existing consultation"""
     # Check if consultation exists
-    existing_consultation = consultations_collection.find_one({"id": consultation_id})
+    existing_consultation = await consultations_collection.find_one({"id": consultation_id})
     if not existing_consultation:
         raise HTTPException(status_code=404, detail="Consultation not found")
     
     # Update the consultation
-    result = consultations_collection.update_one(
+    result = await consultations_collection.update_one(
         {"id": consultation_id},
         {"$set": consultation_data}
     )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=400, detail="Failed to update consultation")
+    if "date" in consultation_data or "patient_id" in consultation_data:
+        await refresh_last_consultation_date(existing_consultation.get("patient_id"), consultation_data.get("patient_id"))
+    await refresh_patient_stats(existing_consultation.get("patient_id"), consultation_data.get("patient_id"))
+    await bump_data_version("consultations")
     
     return {"message": "Consultation updated successfully", "consultation_id": consultation_id}
 
@@ -2311,15 +3370,18 @@ async def update_consultation(consultation_id: str, consultation_data: dict):
 async def delete_consultation(consultation_id: str):
     """Delete existing consultation"""
     # Check if consultation exists
-    existing_consultation = consultations_collection.find_one({"id": consultation_id})
+    existing_consultation = await consultations_collection.find_one({"id": consultation_id})
     if not existing_consultation:
         raise HTTPException(status_code=404, detail="Consultation not found")
     
     # Delete the consultation
-    result = consultations_collection.delete_one({"id": consultation_id})
+    result = await consultations_collection.delete_one({"id": consultation_id})
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=400, detail="Failed to delete consultation")
+    await refresh_last_consultation_date(existing_consultation.get("patient_id"))
+    await refresh_patient_stats(existing_consultation.get("patient_id"))
+    await bump_data_version("consultations")
     
     return {"message": "Consultation deleted successfully", "consultation_id": consultation_id}
 
@@ -2327,19 +3389,19 @@ async def delete_consultation(consultation_id: str):
 async def get_payments():
     """Get all payments with enriched data"""
     try:
-        payments = list(payments_collection.find({}, {"_id": 0}))
+        payments = await payments_collection.find({}, {"_id": 0}).to_list(length=None)
         
         # Enrich each payment with appointment and patient data
         for payment in payments:
             # Get appointment data
-            appointment = appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
+            appointment = await appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
             if appointment:
                 payment["type_rdv"] = appointment.get("type_rdv", "visite")
                 payment["patient_id"] = appointment.get("patient_id", "")
                 
                 # Get patient data
                 if appointment.get("patient_id"):
-                    patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
+                    patient = await get_patient_summary(appointment["patient_id"])
                     if patient:
                         payment["patient"] = {
                             "nom": patient.get("nom", ""),
@@ -2348,14 +3410,14 @@ async def get_payments():
             
             # If no appointment found, try to get from consultation
             if not appointment:
-                consultation = consultations_collection.find_one({"appointment_id": payment["appointment_id"]}, {"_id": 0})
+                consultation = await consultations_collection.find_one({"appointment_id": payment["appointment_id"]}, {"_id": 0})
                 if consultation:
                     payment["type_rdv"] = consultation.get("type_rdv", "visite")
                     payment["patient_id"] = consultation.get("patient_id", "")
                     
                     # Get patient data
                     if consultation.get("patient_id"):
-                        patient = patients_collection.find_one({"id": consultation["patient_id"]}, {"_id": 0})
+                        patient = await get_patient_summary(consultation["patient_id"])
                         if patient:
                             payment["patient"] = {
                                 "nom": patient.get("nom", ""),
@@ -2396,259 +3458,52 @@ async def get_advanced_stats(
                 date_debut = today.replace(month=1, day=1).strftime("%Y-%m-%d")
                 date_fin = today.strftime("%Y-%m-%d")
         
-        # Get payments and appointments for the period
-        payment_query = {
-            "date": {"$gte": date_debut, "$lte": date_fin},
-            "statut": "paye"
-        }
-        appointment_query = {
-            "date": {"$gte": date_debut, "$lte": date_fin}
-        }
+        # Per-day rollups for the period (one small document per day)
+        rollups = await get_daily_rollups(date_debut, date_fin)
         
-        payments = list(payments_collection.find(payment_query, {"_id": 0}))
-        appointments = list(appointments_collection.find(appointment_query, {"_id": 0}))
+        def period_entry(day: str):
+            """Return the breakdown key and label of a day for the requested period"""
+            day_date = datetime.strptime(day, "%Y-%m-%d")
+            if period == "week":
+                week_start = day_date - timedelta(days=day_date.weekday())
+                week_key = f"Semaine du {week_start.strftime('%d/%m/%Y')}"
+                return week_key, {"periode": week_key}
+            if period == "month":
+                return day_date.strftime("%Y-%m"), {"periode": day_date.strftime("%B %Y")}
+            if period == "year":
+                year_key = day_date.strftime("%Y")
+                return year_key, {"periode": f"Année {year_key}"}
+            return day, {"date": day}
         
         # Group data by period
         period_stats = {}
-        
-        if period == "day":
-            # Group by day
-            for payment in payments:
-                day_key = payment["date"]
-                if day_key not in period_stats:
-                    period_stats[day_key] = {
-                        "date": day_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[day_key]["ca"] += payment.get("montant", 0)
-                period_stats[day_key]["nb_paiements"] += 1
-            
-            for appointment in appointments:
-                day_key = appointment["date"]
-                if day_key not in period_stats:
-                    period_stats[day_key] = {
-                        "date": day_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                if appointment.get("type_rdv") == "visite":
-                    period_stats[day_key]["nb_visites"] += 1
-                elif appointment.get("type_rdv") == "controle":
-                    period_stats[day_key]["nb_controles"] += 1
-                if appointment.get("assure", False):
-                    period_stats[day_key]["nb_assures"] += 1
-        
-        elif period == "week":
-            # Group by week
-            for payment in payments:
-                payment_date = datetime.strptime(payment["date"], "%Y-%m-%d")
-                week_start = payment_date - timedelta(days=payment_date.weekday())
-                week_key = f"Semaine du {week_start.strftime('%d/%m/%Y')}"
-                
-                if week_key not in period_stats:
-                    period_stats[week_key] = {
-                        "periode": week_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[week_key]["ca"] += payment.get("montant", 0)
-                period_stats[week_key]["nb_paiements"] += 1
-            
-            for appointment in appointments:
-                appointment_date = datetime.strptime(appointment["date"], "%Y-%m-%d")
-                week_start = appointment_date - timedelta(days=appointment_date.weekday())
-                week_key = f"Semaine du {week_start.strftime('%d/%m/%Y')}"
-                
-                if week_key not in period_stats:
-                    period_stats[week_key] = {
-                        "periode": week_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                if appointment.get("type_rdv") == "visite":
-                    period_stats[week_key]["nb_visites"] += 1
-                elif appointment.get("type_rdv") == "controle":
-                    period_stats[week_key]["nb_controles"] += 1
-                if appointment.get("assure", False):
-                    period_stats[week_key]["nb_assures"] += 1
-        
-        elif period == "month":
-            # Group by month
-            for payment in payments:
-                payment_date = datetime.strptime(payment["date"], "%Y-%m-%d")
-                month_key = payment_date.strftime("%Y-%m")
-                month_name = payment_date.strftime("%B %Y")
-                
-                if month_key not in period_stats:
-                    period_stats[month_key] = {
-                        "periode": month_name,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[month_key]["ca"] += payment.get("montant", 0)
-                period_stats[month_key]["nb_paiements"] += 1
-            
-            for appointment in appointments:
-                appointment_date = datetime.strptime(appointment["date"], "%Y-%m-%d")
-                month_key = appointment_date.strftime("%Y-%m")
-                month_name = appointment_date.strftime("%B %Y")
-                
-                if month_key not in period_stats:
-                    period_stats[month_key] = {
-                        "periode": month_name,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                if appointment.get("type_rdv") == "visite":
-                    period_stats[month_key]["nb_visites"] += 1
-                elif appointment.get("type_rdv") == "controle":
-                    period_stats[month_key]["nb_controles"] += 1
-                if appointment.get("assure", False):
-                    period_stats[month_key]["nb_assures"] += 1
-        
-        elif period == "year":
-            # Group by year
-            for payment in payments:
-                payment_date = datetime.strptime(payment["date"], "%Y-%m-%d")
-                year_key = payment_date.strftime("%Y")
-                
-                if year_key not in period_stats:
-                    period_stats[year_key] = {
-                        "periode": f"Année {year_key}",
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[year_key]["ca"] += payment.get("montant", 0)
-                period_stats[year_key]["nb_paiements"] += 1
-            
-            for appointment in appointments:
-                appointment_date = datetime.strptime(appointment["date"], "%Y-%m-%d")
-                year_key = appointment_date.strftime("%Y")
-                
-                if year_key not in period_stats:
-                    period_stats[year_key] = {
-                        "periode": f"Année {year_key}",
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                if appointment.get("type_rdv") == "visite":
-                    period_stats[year_key]["nb_visites"] += 1
-                elif appointment.get("type_rdv") == "controle":
-                    period_stats[year_key]["nb_controles"] += 1
-                if appointment.get("assure", False):
-                    period_stats[year_key]["nb_assures"] += 1
-        
-        # Calculate totals from payments
-        total_ca_payments = sum(p.get("montant", 0) for p in payments)
-        total_payments = len(payments)
-        total_visites = len([a for a in appointments if a.get("type_rdv") == "visite"])
-        total_controles = len([a for a in appointments if a.get("type_rdv") == "controle"])
-        total_assures = len([a for a in appointments if a.get("assure", False)])
-        
-        # Get cash movements for the period
-        cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": date_debut, "$lte": date_fin}
-        }, {"_id": 0}))
-        
-        # Add cash movements to the period breakdown
-        for movement in cash_movements:
-            movement_date = movement["date"]
-            movement_amount = movement["montant"] if movement["type_mouvement"] == "ajout" else -movement["montant"]
-            
-            if period == "day":
-                day_key = movement_date
-                if day_key not in period_stats:
-                    period_stats[day_key] = {
-                        "date": day_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[day_key]["ca"] += movement_amount
-                
-            elif period == "week":
-                movement_date_obj = datetime.strptime(movement_date, "%Y-%m-%d")
-                week_start = movement_date_obj - timedelta(days=movement_date_obj.weekday())
-                week_key = f"Semaine du {week_start.strftime('%d/%m/%Y')}"
-                
-                if week_key not in period_stats:
-                    period_stats[week_key] = {
-                        "periode": week_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[week_key]["ca"] += movement_amount
-                
-            elif period == "month":
-                movement_date_obj = datetime.strptime(movement_date, "%Y-%m-%d")
-                month_key = movement_date_obj.strftime("%B %Y")
-                
-                if month_key not in period_stats:
-                    period_stats[month_key] = {
-                        "periode": month_key,
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[month_key]["ca"] += movement_amount
-                
-            elif period == "year":
-                movement_date_obj = datetime.strptime(movement_date, "%Y-%m-%d")
-                year_key = movement_date_obj.strftime("%Y")
-                
-                if year_key not in period_stats:
-                    period_stats[year_key] = {
-                        "periode": f"Année {year_key}",
-                        "ca": 0,
-                        "nb_paiements": 0,
-                        "nb_visites": 0,
-                        "nb_controles": 0,
-                        "nb_assures": 0
-                    }
-                period_stats[year_key]["ca"] += movement_amount
-        
-        # Calculate total cash movements
-        total_cash_movements = 0
-        for movement in cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                total_cash_movements += movement["montant"]
-            else:
-                total_cash_movements -= movement["montant"]
-        
-        # Final totals including cash movements
-        total_ca = total_ca_payments + total_cash_movements
+        for rollup in rollups:
+            if not (rollup["nb_paiements"] or rollup["nb_rdv"] or rollup["mouvements_net"]):
+                continue
+            key, label = period_entry(rollup["date"])
+            if key not in period_stats:
+                period_stats[key] = {
+                    **label,
+                    "ca": 0,
+                    "nb_paiements": 0,
+                    "nb_visites": 0,
+                    "nb_controles": 0,
+                    "nb_assures": 0
+                }
+            stats = period_stats[key]
+            stats["ca"] += rollup["recette"] + rollup["mouvements_net"]
+            stats["nb_paiements"] += rollup["nb_paiements"]
+            stats["nb_visites"] += rollup["nb_visites"]
+            stats["nb_controles"] += rollup["nb_controles"]
+            stats["nb_assures"] += rollup["nb_assures"]
+        
+        # Totals including cash movements
+        totals = sum_daily_rollups(rollups)
+        total_ca = totals["recette"] + totals["mouvements_net"]
+        total_payments = totals["nb_paiements"]
+        total_visites = totals["nb_visites"]
+        total_controles = totals["nb_controles"]
+        total_assures = totals["nb_assures"]
         
         return {
             "period": period,
@@ -2688,15 +3543,15 @@ async def get_payments_stats(
             "statut": "paye"
         }
         
-        payments = list(payments_collection.find(query, {"_id": 0}))
+        payments = await payments_collection.find(query, {"_id": 0}).to_list(length=None)
         
         # Calculate statistics
         total_montant_payments = sum(p.get("montant", 0) for p in payments)
         
         # Add cash movements for the period
-        cash_movements = list(cash_movements_collection.find({
+        cash_movements = await cash_movements_collection.find({
             "date": {"$gte": date_debut, "$lte": date_fin}
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         mouvements_total = 0
         for movement in cash_movements:
@@ -2727,7 +3582,7 @@ async def get_payments_stats(
         ca_payments_jour = sum(p.get("montant", 0) for p in today_payments)
         
         # Add today's cash movements
-        today_cash_movements = list(cash_movements_collection.find({"date": today_str}, {"_id": 0}))
+        today_cash_movements = await cash_movements_collection.find({"date": today_str}, {"_id": 0}).to_list(length=None)
         today_mouvements_total = 0
         for movement in today_cash_movements:
             if movement["type_mouvement"] == "ajout":
@@ -2738,9 +3593,9 @@ async def get_payments_stats(
         ca_jour = ca_payments_jour + today_mouvements_total
         
         # Get appointments data for visit/control statistics
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": date_debut, "$lte": date_fin}
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         # Count visits and controls
         nb_visites = len([a for a in appointments if a.get("type_rdv") == "visite"])
@@ -2781,15 +3636,16 @@ async def get_unpaid_appointments():
     """Get list of unpaid appointments (visites only)"""
     try:
         # Get unpaid appointments that are visites
-        unpaid_appointments = list(appointments_collection.find({
+        unpaid_appointments = await appointments_collection.find({
             "type_rdv": "visite",
             "paye": False,
             "statut": {"$in": ["termine", "absent", "retard"]}  # Completed appointments only
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         # Add patient info for each appointment
+        patients_by_id = await get_patient_summaries(a.get("patient_id") for a in unpaid_appointments)
         for appointment in unpaid_appointments:
-            patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
+            patient = patients_by_id.get(appointment["patient_id"])
             if patient:
                 appointment["patient"] = {
                     "nom": patient.get("nom", ""),
@@ -2807,22 +3663,26 @@ async def delete_payment(payment_id: str):
     """Delete payment record"""
     try:
         # Check if payment exists
-        existing_payment = payments_collection.find_one({"id": payment_id})
+        existing_payment = await payments_collection.find_one({"id": payment_id})
         if not existing_payment:
             raise HTTPException(status_code=404, detail="Payment not found")
         
         # Delete payment record
-        result = payments_collection.delete_one({"id": payment_id})
+        result = await payments_collection.delete_one({"id": payment_id})
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Failed to delete payment")
         
         # Update appointment to unpaid status
-        appointments_collection.update_one(
+        await appointments_collection.update_one(
             {"id": existing_payment["appointment_id"]},
             {"$set": {"paye": False, "updated_at": datetime.now()}}
         )
         
+        await refresh_daily_rollups(existing_payment.get("date"))
+        await refresh_patient_stats(existing_payment.get("patient_id"))
+        await record_appointment_change("updated", existing_payment["appointment_id"], {"paye": False})
+        
         return {"message": "Payment deleted successfully"}
         
     except HTTPException:
@@ -2830,74 +3690,140 @@ async def delete_payment(payment_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting payment: {str(e)}")
 
+# ==================== DAILY ROLLUPS ====================
+
+# Pre-aggregated figures stored per day in daily_rollups:
+# recette = paid payments, counts = appointments of the day, mouvements_net = cash movements
+DAILY_ROLLUP_FIELDS = ["recette", "nb_paiements", "nb_rdv", "nb_visites", "nb_controles", "nb_assures", "mouvements_net"]
+
+def empty_daily_rollup(date: str) -> dict:
+    """Rollup of a day without any activity"""
+    return {"date": date, **{field: 0 for field in DAILY_ROLLUP_FIELDS}}
+
+async def compute_daily_rollups(date_filter: dict) -> Dict[str, dict]:
+    """Compute rollups from the source collections, grouped by date"""
+    payments_pipeline = [
+        {"$match": {**date_filter, "statut": "paye"}},
+        {"$group": {"_id": "$date", "recette": {"$sum": "$montant"}, "nb_paiements": {"$sum": 1}}}
+    ]
+    appointments_pipeline = [
+        {"$match": date_filter},
+        {"$group": {
+            "_id": "$date",
+            "nb_rdv": {"$sum": 1},
+            "nb_visites": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "visite"]}, 1, 0]}},
+            "nb_controles": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "controle"]}, 1, 0]}},
+            "nb_assures": {"$sum": {"$cond": [{"$eq": ["$assure", True]}, 1, 0]}}
+        }}
+    ]
+    cash_pipeline = [
+        {"$match": date_filter},
+        {"$group": {
+            "_id": "$date",
+            "mouvements_net": {"$sum": {"$cond": [
+                {"$eq": ["$type_mouvement", "ajout"]}, "$montant", {"$multiply": ["$montant", -1]}
+            ]}}
+        }}
+    ]
+    
+    results = await asyncio.gather(
+        payments_collection.aggregate(payments_pipeline).to_list(length=None),
+        appointments_collection.aggregate(appointments_pipeline).to_list(length=None),
+        cash_movements_collection.aggregate(cash_pipeline).to_list(length=None)
+    )
+    
+    rollups = {}
+    for rows in results:
+        for row in rows:
+            date = row.pop("_id")
+            if not date:
+                continue
+            rollups.setdefault(date, empty_daily_rollup(date)).update(row)
+    return rollups
+
+async def refresh_daily_rollups(*dates):
+    """Recompute the rollup of the given days after a write on payments, appointments or cash movements"""
+    dates = sorted({d for d in dates if d})
+    if not dates:
+        return
+    try:
+        rollups = await compute_daily_rollups({"date": {"$in": dates}})
+        for date in dates:
+            rollup = rollups.get(date) or empty_daily_rollup(date)
+            rollup["updated_at"] = datetime.now()
+            await daily_rollups_collection.replace_one({"date": date}, rollup, upsert=True)
+        await bump_data_version("daily_rollups")
+    except Exception as e:
+        print(f"⚠️  Daily rollup refresh error for {dates}: {e}")
+
+async def rebuild_daily_rollups() -> int:
+    """Rebuild every daily rollup from the source collections"""
+    rollups = await compute_daily_rollups({})
+    now = datetime.now()
+    await daily_rollups_collection.delete_many({})
+    if rollups:
+        await daily_rollups_collection.insert_many([{**r, "updated_at": now} for r in rollups.values()])
+    await bump_data_version("daily_rollups")
+    return len(rollups)
+
+async def get_daily_rollups(date_debut: str, date_fin: str) -> List[dict]:
+    """Get the rollups of a date range (inclusive), sorted by date"""
+    rollups = await daily_rollups_collection.find(
+        {"date": {"$gte": date_debut, "$lte": date_fin}},
+        {"_id": 0, "updated_at": 0}
+    ).sort("date", 1).to_list(length=None)
+    return [{**empty_daily_rollup(r["date"]), **r} for r in rollups]
+
+def sum_daily_rollups(rollups) -> dict:
+    """Sum the figures of several daily rollups"""
+    totals = {field: 0 for field in DAILY_ROLLUP_FIELDS}
+    for rollup in rollups:
+        for field in DAILY_ROLLUP_FIELDS:
+            totals[field] += rollup.get(field, 0)
+    return totals
+
+async def get_rollup_totals(date_debut: str, date_fin: str) -> dict:
+    """Get the summed figures of a date range from the daily rollups"""
+    return sum_daily_rollups(await get_daily_rollups(date_debut, date_fin))
+
+@app.post("/api/admin/rollups/rebuild")
+async def rebuild_daily_rollups_endpoint():
+    """Rebuild the daily rollups from payments, appointments and cash movements"""
+    try:
+        days = await rebuild_daily_rollups()
+        return {"message": "Daily rollups rebuilt successfully", "days": days}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding daily rollups: {str(e)}")
+
 # ==================== ENHANCED FACTURATION ENDPOINTS ====================
 
 @app.get("/api/facturation/enhanced-stats")
-async def get_enhanced_facturation_stats():
+async def get_enhanced_facturation_stats(request: Request, response: Response):
     """Get enhanced statistics for facturation page including daily, monthly, yearly revenue"""
+    not_modified = conditional_response(
+        request, response, datetime.now().strftime("%Y-%m-%d"), await get_data_versions("daily_rollups", "patients")
+    )
+    if not_modified:
+        return not_modified
+    
     try:
         today = datetime.now()
         
-        # Daily revenue (today)
         today_str = today.strftime("%Y-%m-%d")
-        daily_payments = list(payments_collection.find({
-            "date": today_str,
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        daily_cash_movements = list(cash_movements_collection.find({
-            "date": today_str
-        }, {"_id": 0}))
-        
-        recette_jour = sum(p.get("montant", 0) for p in daily_payments)
-        for movement in daily_cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                recette_jour += movement["montant"]
-            else:
-                recette_jour -= movement["montant"]
-        
-        # Monthly revenue (current month)
         month_start = today.replace(day=1).strftime("%Y-%m-%d")
-        month_end = today.strftime("%Y-%m-%d")
-        
-        monthly_payments = list(payments_collection.find({
-            "date": {"$gte": month_start, "$lte": month_end},
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        monthly_cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": month_start, "$lte": month_end}
-        }, {"_id": 0}))
-        
-        recette_mois = sum(p.get("montant", 0) for p in monthly_payments)
-        for movement in monthly_cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                recette_mois += movement["montant"]
-            else:
-                recette_mois -= movement["montant"]
-        
-        # Yearly revenue (current year)
         year_start = today.replace(month=1, day=1).strftime("%Y-%m-%d")
-        year_end = today.strftime("%Y-%m-%d")
-        
-        yearly_payments = list(payments_collection.find({
-            "date": {"$gte": year_start, "$lte": year_end},
-            "statut": "paye"
-        }, {"_id": 0}))
         
-        yearly_cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": year_start, "$lte": year_end}
-        }, {"_id": 0}))
-        
-        recette_annee = sum(p.get("montant", 0) for p in yearly_payments)
-        for movement in yearly_cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                recette_annee += movement["montant"]
-            else:
-                recette_annee -= movement["montant"]
+        # Daily, monthly and yearly revenue from the daily rollups (payments + cash movements)
+        year_rollups = await get_daily_rollups(year_start, today_str)
+        daily = sum_daily_rollups(r for r in year_rollups if r["date"] == today_str)
+        monthly = sum_daily_rollups(r for r in year_rollups if r["date"] >= month_start)
+        yearly = sum_daily_rollups(year_rollups)
+        recette_jour = daily["recette"] + daily["mouvements_net"]
+        recette_mois = monthly["recette"] + monthly["mouvements_net"]
+        recette_annee = yearly["recette"] + yearly["mouvements_net"]
         
         # New patients count since beginning of year
-        new_patients_count = patients_collection.count_documents({
+        new_patients_count = await patients_collection.count_documents({
             "created_at": {"$gte": year_start}
         })
         
@@ -2916,14 +3842,15 @@ async def get_daily_payments(date: str = Query(...)):
     """Get payments for a specific day with detailed breakdown"""
     try:
         # Get payments for the day
-        payments = list(payments_collection.find({
+        payments = await payments_collection.find({
             "date": date,
             "statut": "paye"
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         # Enrich with patient information
+        patients_by_id = await get_patient_summaries(p.get("patient_id") for p in payments)
         for payment in payments:
-            patient = patients_collection.find_one({"id": payment["patient_id"]}, {"_id": 0})
+            patient = patients_by_id.get(payment["patient_id"])
             if patient:
                 payment["patient"] = {
                     "nom": patient.get("nom", ""),
@@ -2932,15 +3859,15 @@ async def get_daily_payments(date: str = Query(...)):
                 }
             
             # Get appointment info for visit type
-            appointment = appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
+            appointment = await appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
             if appointment:
                 payment["type_visite"] = appointment.get("type_rdv", "visite")
         
         # Get unpaid payments for the same day
-        unpaid_payments = list(payments_collection.find({
+        unpaid_payments = await payments_collection.find({
             "date": date,
             "statut": "impaye"
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         # Calculate daily totals
         total_montant = sum(p.get("montant", 0) for p in payments)
@@ -2966,8 +3893,12 @@ async def get_daily_payments(date: str = Query(...)):
         raise HTTPException(status_code=500, detail=f"Error fetching daily payments: {str(e)}")
 
 @app.get("/api/facturation/monthly-stats-with-evolution")
-async def get_monthly_stats_with_evolution(year: int = Query(...), month: int = Query(...)):
+async def get_monthly_stats_with_evolution(request: Request, response: Response, year: int = Query(...), month: int = Query(...)):
     """Get monthly statistics with evolution percentage compared to previous month"""
+    not_modified = conditional_response(request, response, await get_data_versions("daily_rollups"))
+    if not_modified:
+        return not_modified
+    
     try:
         # Calculate current month boundaries
         current_month_start = datetime(year, month, 1).strftime("%Y-%m-%d")
@@ -2992,54 +3923,18 @@ async def get_monthly_stats_with_evolution(year: int = Query(...), month: int =
             prev_month_end = datetime(prev_year, prev_month + 1, 1) - timedelta(days=1)
         prev_month_end_str = prev_month_end.strftime("%Y-%m-%d")
         
-        # Get current month data
-        current_payments = list(payments_collection.find({
-            "date": {"$gte": current_month_start, "$lte": current_month_end_str},
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        current_appointments = list(appointments_collection.find({
-            "date": {"$gte": current_month_start, "$lte": current_month_end_str}
-        }, {"_id": 0}))
-        
-        current_cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": current_month_start, "$lte": current_month_end_str}
-        }, {"_id": 0}))
-        
-        # Get previous month data
-        prev_payments = list(payments_collection.find({
-            "date": {"$gte": prev_month_start, "$lte": prev_month_end_str},
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        prev_cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": prev_month_start, "$lte": prev_month_end_str}
-        }, {"_id": 0}))
-        
-        # Calculate current month totals
-        current_recette_payments = sum(p.get("montant", 0) for p in current_payments)
-        current_movements_total = 0
-        for movement in current_cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                current_movements_total += movement["montant"]
-            else:
-                current_movements_total -= movement["montant"]
-        
-        current_recette_mois = current_recette_payments + current_movements_total
-        current_nb_visites = len([a for a in current_appointments if a.get("type_rdv") == "visite"])
-        current_nb_controles = len([a for a in current_appointments if a.get("type_rdv") == "controle"])
-        current_nb_assures = len([a for a in current_appointments if a.get("assure", False)])
+        # Current and previous month figures from the daily rollups
+        current, previous = await asyncio.gather(
+            get_rollup_totals(current_month_start, current_month_end_str),
+            get_rollup_totals(prev_month_start, prev_month_end_str)
+        )
         
-        # Calculate previous month totals
-        prev_recette_payments = sum(p.get("montant", 0) for p in prev_payments)
-        prev_movements_total = 0
-        for movement in prev_cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                prev_movements_total += movement["montant"]
-            else:
-                prev_movements_total -= movement["montant"]
+        current_recette_mois = current["recette"] + current["mouvements_net"]
+        current_nb_visites = current["nb_visites"]
+        current_nb_controles = current["nb_controles"]
+        current_nb_assures = current["nb_assures"]
         
-        prev_recette_mois = prev_recette_payments + prev_movements_total
+        prev_recette_mois = previous["recette"] + previous["mouvements_net"]
         
         # Calculate evolution percentages
         recette_evolution = 0
@@ -3053,7 +3948,7 @@ async def get_monthly_stats_with_evolution(year: int = Query(...), month: int =
             "nb_visites": current_nb_visites,
             "nb_controles": current_nb_controles,
             "nb_assures": current_nb_assures,
-            "nb_total_rdv": len(current_appointments),
+            "nb_total_rdv": current["nb_rdv"],
             "evolution": {
                 "recette_precedente": prev_recette_mois,
                 "evolution_pourcentage": round(recette_evolution, 1),
@@ -3066,8 +3961,12 @@ async def get_monthly_stats_with_evolution(year: int = Query(...), month: int =
         raise HTTPException(status_code=500, detail=f"Error calculating monthly stats with evolution: {str(e)}")
 
 @app.get("/api/facturation/monthly-stats")
-async def get_monthly_stats(year: int = Query(...), month: int = Query(...)):
+async def get_monthly_stats(request: Request, response: Response, year: int = Query(...), month: int = Query(...)):
     """Get monthly statistics breakdown"""
+    not_modified = conditional_response(request, response, await get_data_versions("daily_rollups"))
+    if not_modified:
+        return not_modified
+    
     try:
         # Calculate month boundaries
         month_start = datetime(year, month, 1).strftime("%Y-%m-%d")
@@ -3077,35 +3976,13 @@ async def get_monthly_stats(year: int = Query(...), month: int = Query(...)):
             month_end = datetime(year, month + 1, 1) - timedelta(days=1)
         month_end_str = month_end.strftime("%Y-%m-%d")
         
-        # Get payments for the month
-        payments = list(payments_collection.find({
-            "date": {"$gte": month_start, "$lte": month_end_str},
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        # Get appointments for visit/control breakdown
-        appointments = list(appointments_collection.find({
-            "date": {"$gte": month_start, "$lte": month_end_str}
-        }, {"_id": 0}))
-        
-        # Get cash movements for the month
-        cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": month_start, "$lte": month_end_str}
-        }, {"_id": 0}))
+        # Month figures from the daily rollups
+        totals = await get_rollup_totals(month_start, month_end_str)
         
-        # Calculate totals
-        recette_payments = sum(p.get("montant", 0) for p in payments)
-        movements_total = 0
-        for movement in cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                movements_total += movement["montant"]
-            else:
-                movements_total -= movement["montant"]
-        
-        recette_mois = recette_payments + movements_total
-        nb_visites = len([a for a in appointments if a.get("type_rdv") == "visite"])
-        nb_controles = len([a for a in appointments if a.get("type_rdv") == "controle"])
-        nb_assures = len([a for a in appointments if a.get("assure", False)])
+        recette_mois = totals["recette"] + totals["mouvements_net"]
+        nb_visites = totals["nb_visites"]
+        nb_controles = totals["nb_controles"]
+        nb_assures = totals["nb_assures"]
         
         return {
             "year": year,
@@ -3114,48 +3991,30 @@ async def get_monthly_stats(year: int = Query(...), month: int = Query(...)):
             "nb_visites": nb_visites,
             "nb_controles": nb_controles,
             "nb_assures": nb_assures,
-            "nb_total_rdv": len(appointments)
+            "nb_total_rdv": totals["nb_rdv"]
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating monthly stats: {str(e)}")
 
 @app.get("/api/facturation/yearly-stats")
-async def get_yearly_stats(year: int = Query(...)):
+async def get_yearly_stats(request: Request, response: Response, year: int = Query(...)):
     """Get yearly statistics breakdown"""
+    not_modified = conditional_response(request, response, await get_data_versions("daily_rollups"))
+    if not_modified:
+        return not_modified
+    
     try:
         year_start = f"{year}-01-01"
         year_end = f"{year}-12-31"
         
-        # Get payments for the year
-        payments = list(payments_collection.find({
-            "date": {"$gte": year_start, "$lte": year_end},
-            "statut": "paye"
-        }, {"_id": 0}))
-        
-        # Get appointments for the year
-        appointments = list(appointments_collection.find({
-            "date": {"$gte": year_start, "$lte": year_end}
-        }, {"_id": 0}))
-        
-        # Get cash movements for the year
-        cash_movements = list(cash_movements_collection.find({
-            "date": {"$gte": year_start, "$lte": year_end}
-        }, {"_id": 0}))
-        
-        # Calculate totals
-        recette_payments = sum(p.get("montant", 0) for p in payments)
-        movements_total = 0
-        for movement in cash_movements:
-            if movement["type_mouvement"] == "ajout":
-                movements_total += movement["montant"]
-            else:
-                movements_total -= movement["montant"]
+        # Year figures from the daily rollups (at most 366 documents)
+        totals = await get_rollup_totals(year_start, year_end)
         
-        recette_annee = recette_payments + movements_total
-        nb_visites = len([a for a in appointments if a.get("type_rdv") == "visite"])
-        nb_controles = len([a for a in appointments if a.get("type_rdv") == "controle"])
-        nb_assures = len([a for a in appointments if a.get("assure", False)])
+        recette_annee = totals["recette"] + totals["mouvements_net"]
+        nb_visites = totals["nb_visites"]
+        nb_controles = totals["nb_controles"]
+        nb_assures = totals["nb_assures"]
         
         return {
             "year": year,
@@ -3163,7 +4022,7 @@ async def get_yearly_stats(year: int = Query(...)):
             "nb_visites": nb_visites,
             "nb_controles": nb_controles,
             "nb_assures": nb_assures,
-            "nb_total_rdv": len(appointments)
+            "nb_total_rdv": totals["nb_rdv"]
         }
         
     except Exception as e:
@@ -3174,19 +4033,19 @@ async def get_patient_payments(patient_id: str = Query(...)):
     """Get all payments for a specific patient"""
     try:
         # Get patient info
-        patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
+        patient = await patients_collection.find_one({"id": patient_id}, {"_id": 0})
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
         
         # Get all payments for the patient
-        payments = list(payments_collection.find({
+        payments = await payments_collection.find({
             "patient_id": patient_id,
             "statut": "paye"
-        }, {"_id": 0}).sort("date", -1))
+        }, {"_id": 0}).sort("date", -1).to_list(length=None)
         
         # Enrich payments with appointment info
         for payment in payments:
-            appointment = appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
+            appointment = await appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
             if appointment:
                 payment["type_visite"] = appointment.get("type_rdv", "visite")
                 payment["date_rdv"] = appointment.get("date", payment["date"])
@@ -3212,28 +4071,14 @@ async def get_patient_payments(patient_id: str = Query(...)):
 async def get_top_profitable_patients(limit: int = Query(10)):
     """Get top 10 most profitable patients"""
     try:
-        # Get all payments grouped by patient
-        payments = list(payments_collection.find({"statut": "paye"}, {"_id": 0}))
-        
-        # Group by patient and calculate totals
-        patient_totals = {}
-        for payment in payments:
-            patient_id = payment["patient_id"]
-            if patient_id not in patient_totals:
-                patient_totals[patient_id] = {
-                    "total_montant": 0,
-                    "nb_payments": 0
-                }
-            patient_totals[patient_id]["total_montant"] += payment.get("montant", 0)
-            patient_totals[patient_id]["nb_payments"] += 1
+        # Ranked on the materialized patient stats
+        query = {"nb_payments": {"$gt": 0}}
+        ranked = await patient_stats_collection.find(query, {"_id": 0}).sort("revenue", -1).limit(limit).to_list(length=limit)
+        patients = await get_patient_summaries([stats["patient_id"] for stats in ranked])
         
-        # Sort by total amount and get top patients
-        sorted_patients = sorted(patient_totals.items(), key=lambda x: x[1]["total_montant"], reverse=True)[:limit]
-        
-        # Enrich with patient information
         top_patients = []
-        for patient_id, stats in sorted_patients:
-            patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
+        for stats in ranked:
+            patient = patients.get(stats["patient_id"])
             if patient:
                 top_patients.append({
                     "patient": {
@@ -3242,19 +4087,66 @@ async def get_top_profitable_patients(limit: int = Query(10)):
                         "prenom": patient.get("prenom", ""),
                         "telephone": patient.get("numero_whatsapp", "")
                     },
-                    "total_montant": stats["total_montant"],
+                    "total_montant": stats["revenue"],
                     "nb_payments": stats["nb_payments"],
-                    "moyenne_paiement": stats["total_montant"] / stats["nb_payments"] if stats["nb_payments"] > 0 else 0
+                    "moyenne_paiement": stats["revenue"] / stats["nb_payments"] if stats["nb_payments"] > 0 else 0
                 })
         
         return {
             "top_patients": top_patients,
-            "total_analyzed": len(patient_totals)
+            "total_analyzed": await patient_stats_collection.count_documents(query)
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating top patients: {str(e)}")
 
+def get_month_bounds(year: int, month: int):
+    """First and last day (YYYY-MM-DD) of a month"""
+    month_start = datetime(year, month, 1)
+    if month == 12:
+        month_end = datetime(year + 1, 1, 1) - timedelta(days=1)
+    else:
+        month_end = datetime(year, month + 1, 1) - timedelta(days=1)
+    return month_start.strftime("%Y-%m-%d"), month_end.strftime("%Y-%m-%d")
+
+async def aggregate_by_day(collection, match: dict, fields: List[str], sums: dict = None,
+                           date_field: str = "date", datetime_field: bool = False) -> List[dict]:
+    """Group the matching documents by day in a single aggregation.
+    
+    Each row holds the day, whether the value is a bare day (string without time part,
+    or datetime at midnight) and the grouped sums, so that month totals can be derived
+    with the exact bounds of the per-month range queries they replace.
+    """
+    value = f"${date_field}"
+    if datetime_field:
+        day = {"$dateToString": {"format": "%Y-%m-%d", "date": value}}
+        bare = {"$and": [{"$eq": [{"$hour": value}, 0]}, {"$eq": [{"$minute": value}, 0]},
+                         {"$eq": [{"$second": value}, 0]}, {"$eq": [{"$millisecond": value}, 0]}]}
+    else:
+        day = {"$substrCP": [value, 0, 10]}
+        bare = {"$lte": [{"$strLenCP": value}, 10]}
+    
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, **{field: 1 for field in [date_field] + fields}}},
+        {"$group": {"_id": {"day": day, "bare": bare}, "count": {"$sum": 1}, **(sums or {})}}
+    ]
+    rows = await collection.aggregate(pipeline).to_list(length=None)
+    for row in rows:
+        row.update(row.pop("_id"))
+    return rows
+
+def sum_rows_in_range(rows: List[dict], start: str, end: str, key: str = "count"):
+    """Sum a grouped value over the rows within [start, end] (same bounds as $gte/$lte on the raw value)"""
+    return sum(
+        row.get(key, 0) for row in rows
+        if start <= row["day"] and (row["day"] < end or (row["day"] == end and row["bare"]))
+    )
+
+CASH_MOVEMENT_NET_SUM = {"$sum": {"$cond": [
+    {"$eq": ["$type_mouvement", "ajout"]}, "$montant", {"$multiply": ["$montant", -1]}
+]}}
+
 @app.get("/api/facturation/evolution-graphs")
 async def get_evolution_graphs(period: str = Query("month"), year: int = Query(None)):
     """Get data for evolution graphs (revenue, consultations, new patients)"""
@@ -3262,55 +4154,33 @@ async def get_evolution_graphs(period: str = Query("month"), year: int = Query(N
         current_year = datetime.now().year if year is None else year
         
         if period == "month":
+            year_range = {"$gte": f"{current_year}-01-01", "$lte": f"{current_year}-12-31"}
+            
+            # One aggregation per collection for the whole year, run concurrently
+            payment_rows, appointment_rows, patient_rows, movement_rows = await asyncio.gather(
+                aggregate_by_day(payments_collection, {"date": year_range, "statut": "paye"},
+                                 ["montant"], {"montant": {"$sum": "$montant"}}),
+                aggregate_by_day(appointments_collection, {"date": year_range}, ["type_rdv"]),
+                aggregate_by_day(patients_collection, {"created_at": year_range}, [], date_field="created_at"),
+                aggregate_by_day(cash_movements_collection, {"date": year_range},
+                                 ["montant", "type_mouvement"], {"net": CASH_MOVEMENT_NET_SUM})
+            )
+            
             # Monthly evolution for the year
             evolution_data = []
             for month in range(1, 13):
-                # Calculate month boundaries
-                month_start = datetime(current_year, month, 1).strftime("%Y-%m-%d")
-                if month == 12:
-                    month_end = datetime(current_year + 1, 1, 1) - timedelta(days=1)
-                else:
-                    month_end = datetime(current_year, month + 1, 1) - timedelta(days=1)
-                month_end_str = month_end.strftime("%Y-%m-%d")
-                
-                # Get payments for the month
-                payments = list(payments_collection.find({
-                    "date": {"$gte": month_start, "$lte": month_end_str},
-                    "statut": "paye"
-                }, {"_id": 0}))
-                
-                # Get appointments for the month
-                appointments = list(appointments_collection.find({
-                    "date": {"$gte": month_start, "$lte": month_end_str}
-                }, {"_id": 0}))
-                
-                # Get new patients for the month
-                new_patients = patients_collection.count_documents({
-                    "created_at": {"$gte": month_start, "$lte": month_end_str}
-                })
-                
-                # Get cash movements for the month
-                cash_movements = list(cash_movements_collection.find({
-                    "date": {"$gte": month_start, "$lte": month_end_str}
-                }, {"_id": 0}))
-                
-                # Calculate totals
-                recette_payments = sum(p.get("montant", 0) for p in payments)
-                movements_total = 0
-                for movement in cash_movements:
-                    if movement["type_mouvement"] == "ajout":
-                        movements_total += movement["montant"]
-                    else:
-                        movements_total -= movement["montant"]
+                month_start, month_end_str = get_month_bounds(current_year, month)
                 
+                recette_payments = sum_rows_in_range(payment_rows, month_start, month_end_str, "montant")
+                movements_total = sum_rows_in_range(movement_rows, month_start, month_end_str, "net")
                 recette_total = recette_payments + movements_total
                 
                 evolution_data.append({
                     "periode": f"{current_year}-{month:02d}",
                     "mois": month,
                     "recette": recette_total,
-                    "nb_consultations": len(appointments),
-                    "nouveaux_patients": new_patients
+                    "nb_consultations": sum_rows_in_range(appointment_rows, month_start, month_end_str),
+                    "nouveaux_patients": sum_rows_in_range(patient_rows, month_start, month_end_str)
                 })
             
             return {
@@ -3350,19 +4220,19 @@ async def get_predictive_analysis():
                 month_end_str = month_end.strftime("%Y-%m-%d")
                 
                 # Get payments and appointments for the month
-                payments = list(payments_collection.find({
+                payments = await payments_collection.find({
                     "date": {"$gte": month_start, "$lte": month_end_str},
                     "statut": "paye"
-                }, {"_id": 0}))
+                }, {"_id": 0}).to_list(length=None)
                 
-                appointments = list(appointments_collection.find({
+                appointments = await appointments_collection.find({
                     "date": {"$gte": month_start, "$lte": month_end_str}
-                }, {"_id": 0}))
+                }, {"_id": 0}).to_list(length=None)
                 
                 # Get cash movements
-                cash_movements = list(cash_movements_collection.find({
+                cash_movements = await cash_movements_collection.find({
                     "date": {"$gte": month_start, "$lte": month_end_str}
-                }, {"_id": 0}))
+                }, {"_id": 0}).to_list(length=None)
                 
                 # Calculate totals
                 recette_payments = sum(p.get("montant", 0) for p in payments)
@@ -3473,9 +4343,27 @@ async def get_predictive_analysis():
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint pour messagerie temps réel"""
     await manager.connect(websocket)
+    initial_topics = websocket.query_params.get("topics")
+    if initial_topics:
+        manager.subscribe(websocket, initial_topics.split(","))
     try:
         while True:
             data = await websocket.receive_text()
+            
+            # {"action": "subscribe" | "unsubscribe", "topics": ["rdv:2025-01-15", "dashboard"]}
+            try:
+                command = json.loads(data)
+            except ValueError:
+                command = None
+            if isinstance(command, dict) and command.get("action") in ("subscribe", "unsubscribe"):
+                topics = [t for t in command.get("topics", []) if isinstance(t, str)]
+                if command["action"] == "subscribe":
+                    subscribed = manager.subscribe(websocket, topics)
+                else:
+                    subscribed = manager.unsubscribe(websocket, topics)
+                await manager.send_personal_message(json.dumps({"type": "subscriptions", "topics": subscribed}), websocket)
+                continue
+            
             # Echo back for now - can be enhanced for specific functionality
             await manager.send_personal_message(f"Message received: {data}", websocket)
     except WebSocketDisconnect:
@@ -3485,7 +4373,7 @@ async def websocket_endpoint(websocket: WebSocket):
 async def get_messages():
     """Récupérer tous les messages de la journée"""
     try:
-        messages = list(messages_collection.find({}, {"_id": 0}).sort("timestamp", 1))
+        messages = await messages_collection.find({}, {"_id": 0}).sort("timestamp", 1).to_list(length=None)
         return {"messages": messages}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching messages: {str(e)}")
@@ -3497,7 +4385,7 @@ async def create_message(message_data: MessageCreate, sender_type: str, sender_n
         # Si c'est une réponse, récupérer le contenu du message original
         reply_content = ""
         if message_data.reply_to:
-            original_message = messages_collection.find_one(
+            original_message = await messages_collection.find_one(
                 {"id": message_data.reply_to}, 
                 {"_id": 0}
             )
@@ -3513,13 +4401,13 @@ async def create_message(message_data: MessageCreate, sender_type: str, sender_n
         )
         
         message_dict = message.dict()
-        messages_collection.insert_one(message_dict)
+        await messages_collection.insert_one(message_dict)
         
         # Diffuser le message à tous les clients connectés
         await manager.broadcast({
             "type": "new_message",
             "data": message_dict
-        })
+        }, topic="messages")
         
         return {"message": "Message created successfully", "id": message.id}
     except Exception as e:
@@ -3530,7 +4418,7 @@ async def update_message(message_id: str, message_data: MessageUpdate, user_type
     """Modifier un message (seulement par son émetteur)"""
     try:
         # Vérifier que le message existe et appartient à l'utilisateur
-        message = messages_collection.find_one({"id": message_id}, {"_id": 0})
+        message = await messages_collection.find_one({"id": message_id}, {"_id": 0})
         if not message:
             raise HTTPException(status_code=404, detail="Message not found")
         
@@ -3547,7 +4435,7 @@ async def update_message(message_id: str, message_data: MessageUpdate, user_type
         if not message.get("original_content"):
             update_data["original_content"] = message.get("content", "")
         
-        result = messages_collection.update_one(
+        result = await messages_collection.update_one(
             {"id": message_id},
             {"$set": update_data}
         )
@@ -3556,13 +4444,13 @@ async def update_message(message_id: str, message_data: MessageUpdate, user_type
             raise HTTPException(status_code=404, detail="Message not found")
         
         # Récupérer le message mis à jour
-        updated_message = messages_collection.find_one({"id": message_id}, {"_id": 0})
+        updated_message = await messages_collection.find_one({"id": message_id}, {"_id": 0})
         
         # Diffuser la mise à jour
         await manager.broadcast({
             "type": "message_updated",
             "data": updated_message
-        })
+        }, topic="messages")
         
         return {"message": "Message updated successfully"}
     except HTTPException:
@@ -3575,14 +4463,14 @@ async def delete_message(message_id: str, user_type: str):
     """Supprimer un message (seulement par son émetteur)"""
     try:
         # Vérifier que le message existe et appartient à l'utilisateur
-        message = messages_collection.find_one({"id": message_id}, {"_id": 0})
+        message = await messages_collection.find_one({"id": message_id}, {"_id": 0})
         if not message:
             raise HTTPException(status_code=404, detail="Message not found")
         
         if message.get("sender_type") != user_type:
             raise HTTPException(status_code=403, detail="Not authorized to delete this message")
         
-        result = messages_collection.delete_one({"id": message_id})
+        result = await messages_collection.delete_one({"id": message_id})
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Message not found")
@@ -3591,7 +4479,7 @@ async def delete_message(message_id: str, user_type: str):
         await manager.broadcast({
             "type": "message_deleted",
             "data": {"id": message_id}
-        })
+        }, topic="messages")
         
         return {"message": "Message deleted successfully"}
     except HTTPException:
@@ -3603,13 +4491,13 @@ async def delete_message(message_id: str, user_type: str):
 async def clear_all_messages():
     """Clear all messages from the chat"""
     try:
-        result = messages_collection.delete_many({})
+        result = await messages_collection.delete_many({})
         
         # Broadcast clear event via WebSocket
         await manager.broadcast({
             "type": "messages_cleared",
             "deleted_count": result.deleted_count
-        })
+        }, topic="messages")
         
         return {"message": f"All messages cleared successfully", "deleted_count": result.deleted_count}
     except Exception as e:
@@ -3619,7 +4507,7 @@ async def clear_all_messages():
 async def mark_message_as_read(message_id: str):
     """Marquer un message comme lu"""
     try:
-        result = messages_collection.update_one(
+        result = await messages_collection.update_one(
             {"id": message_id},
             {"$set": {"is_read": True}}
         )
@@ -3631,7 +4519,7 @@ async def mark_message_as_read(message_id: str):
         await manager.broadcast({
             "type": "message_read",
             "data": {"id": message_id}
-        })
+        }, topic="messages")
         
         return {"message": "Message marked as read"}
     except Exception as e:
@@ -3647,7 +4535,7 @@ async def manual_cleanup_messages():
         await manager.broadcast({
             "type": "messages_cleared",
             "data": {"count": deleted_count}
-        })
+        }, topic="messages")
         
         return {"message": f"Messages cleared successfully", "count": deleted_count}
     except Exception as e:
@@ -3662,9 +4550,11 @@ async def search_payments(
     statut_paiement: Optional[str] = Query(None, description="Payment status filter: visite, controle, impaye"),
     assure: Optional[bool] = Query(None, description="Insurance status filter"),
     page: int = Query(1, ge=1, description="Page number"),
-    limit: int = Query(20, ge=1, le=100, description="Items per page")
+    limit: int = Query(20, ge=1, le=100, description="Items per page"),
+    after: Optional[str] = Query(None, description="Cursor of the next page (next_cursor of the previous response)"),
+    include_total: bool = Query(True, description="Also count all matching payments (false skips the count)")
 ):
-    """Advanced search for payments with pagination"""
+    """Advanced search for payments with pagination (page numbers or keyset cursor on date, id)"""
     try:
         # Build search query for payments
         query = {}
@@ -3680,36 +4570,79 @@ async def search_payments(
         # Insurance filter
         if assure is not None:
             query["assure"] = assure
-            
+        
+        # Patient info and name filter, joined in the database
+        patient_stages = [
+            {"$lookup": {"from": "patients", "localField": "patient_id", "foreignField": "id", "as": "patient"}},
+            {"$addFields": {"patient": {"$ifNull": [
+                {"$arrayElemAt": [{"$map": {"input": "$patient", "as": "p", "in": {
+                    "nom": {"$ifNull": ["$$p.nom", ""]},
+                    "prenom": {"$ifNull": ["$$p.prenom", ""]}
+                }}}, 0]},
+                {"nom": "Inconnu", "prenom": ""}
+            ]}}}
+        ]
+        if patient_name:
+            patient_stages.append({"$match": {"$expr": {"$regexMatch": {
+                "input": {"$concat": ["$patient.prenom", " ", "$patient.nom"]},
+                "regex": re.escape(patient_name),
+                "options": "i"
+            }}}})
+        
         # Handle "impaye" status differently - find unpaid consultations
         if statut_paiement == "impaye":
             # Find appointments that are completed but not paid (paye = False)
-            appointments_query = {
+            collection = appointments_collection
+            query.update({
                 "paye": False,
                 "statut": {"$in": ["termine", "absent", "retard"]},  # Completed appointments
                 "type_rdv": "visite"  # Only visite appointments can be unpaid (controles are free)
-            }
+            })
+            stages = patient_stages + [{"$project": {"_id": 0}}]
+        else:
+            # Handle paid payments (visite and controle)
+            collection = payments_collection
+            query["statut"] = "paye"  # Only paid payments for visite/controle filtering
             
-            # Add date filter to appointments query
-            if date_debut and date_fin:
-                appointments_query["date"] = {"$gte": date_debut, "$lte": date_fin}
-            elif date_debut:
-                appointments_query["date"] = {"$gte": date_debut}
-            elif date_fin:
-                appointments_query["date"] = {"$lte": date_fin}
-                
-            # Add insurance filter to appointments query
-            if assure is not None:
-                appointments_query["assure"] = assure
+            # Type and patient come from the appointment, or the consultation when it is gone
+            stages = [
+                {"$lookup": {"from": "appointments", "localField": "appointment_id", "foreignField": "id", "as": "appointment"}},
+                {"$lookup": {"from": "consultations", "localField": "appointment_id", "foreignField": "appointment_id", "as": "consultation"}},
+                {"$addFields": {
+                    "appointment": {"$arrayElemAt": ["$appointment", 0]},
+                    "consultation": {"$arrayElemAt": ["$consultation", 0]}
+                }},
+                {"$addFields": {
+                    "type_rdv": {"$ifNull": ["$appointment.type_rdv", {"$ifNull": ["$consultation.type_rdv", "visite"]}]},
+                    "patient_id": {"$ifNull": ["$appointment.patient_id", {"$ifNull": ["$consultation.patient_id", "$patient_id"]}]}
+                }}
+            ]
             
-            # Get unpaid appointments
-            unpaid_appointments = list(appointments_collection.find(appointments_query, {"_id": 0}))
+            # Apply statut_paiement filter
+            if statut_paiement in ("visite", "controle"):
+                stages.append({"$match": {"type_rdv": statut_paiement}})
             
+            stages += patient_stages + [{"$project": {"_id": 0, "appointment": 0, "consultation": 0}}]
+        
+        # One aggregation in (date, id) order (most recent first) from the cursor position
+        page_query = aggregate_keyset_page(
+            collection, query, PAYMENTS_SORT, stages, limit,
+            after=after, skip=(page - 1) * limit
+        )
+        if include_total:
+            (payments, next_cursor), total_count = await asyncio.gather(
+                page_query, aggregate_count(collection, query, stages)
+            )
+            total_pages = (total_count + limit - 1) // limit
+        else:
+            payments, next_cursor = await page_query
+            total_count = None
+            total_pages = None
+        
+        if statut_paiement == "impaye":
             # Convert appointments to payment-like format for consistency
-            payments = []
-            for appointment in unpaid_appointments:
-                # Create a payment-like object for unpaid appointment
-                fake_payment = {
+            payments = [
+                {
                     "id": f"impaye_{appointment['id']}",
                     "patient_id": appointment["patient_id"],
                     "appointment_id": appointment["id"],
@@ -3720,103 +4653,27 @@ async def search_payments(
                     "assure": appointment.get("assure", False),
                     "date": appointment.get("date", ""),
                     "notes": "Consultation non payée",
-                    "created_at": appointment.get("created_at", datetime.now())
+                    "created_at": appointment.get("created_at", datetime.now()),
+                    "patient": appointment["patient"]
                 }
-                
-                # Get patient info
-                try:
-                    patient = patients_collection.find_one({"id": appointment["patient_id"]}, {"_id": 0})
-                    if patient:
-                        fake_payment["patient"] = {
-                            "nom": patient.get("nom", ""),
-                            "prenom": patient.get("prenom", "")
-                        }
-                    else:
-                        fake_payment["patient"] = {"nom": "Inconnu", "prenom": ""}
-                except:
-                    fake_payment["patient"] = {"nom": "Inconnu", "prenom": ""}
-                
-                payments.append(fake_payment)
-                
-        else:
-            # Handle paid payments (visite and controle)
-            query["statut"] = "paye"  # Only paid payments for visite/controle filtering
-            
-            # Get all payments matching basic criteria
-            payments = list(payments_collection.find(query, {"_id": 0}))
-            
-            # Enrich payments with appointment/consultation data and apply type filter
-            filtered_payments = []
-            for payment in payments:
-                # Get appointment data first
-                appointment = appointments_collection.find_one({"id": payment["appointment_id"]}, {"_id": 0})
-                if appointment:
-                    payment["type_rdv"] = appointment.get("type_rdv", "visite")
-                    payment["patient_id"] = appointment.get("patient_id", "")
-                else:
-                    # Try to get from consultation
-                    consultation = consultations_collection.find_one({"appointment_id": payment["appointment_id"]}, {"_id": 0})
-                    if consultation:
-                        payment["type_rdv"] = consultation.get("type_rdv", "visite")
-                        payment["patient_id"] = consultation.get("patient_id", "")
-                    else:
-                        payment["type_rdv"] = "visite"  # Default
-                
-                # Apply statut_paiement filter
-                if statut_paiement == "visite" and payment["type_rdv"] != "visite":
-                    continue
-                elif statut_paiement == "controle" and payment["type_rdv"] != "controle":
-                    continue
-                
-                # Get patient info
-                try:
-                    if payment.get("patient_id"):
-                        patient = patients_collection.find_one({"id": payment["patient_id"]}, {"_id": 0})
-                        if patient:
-                            payment["patient"] = {
-                                "nom": patient.get("nom", ""),
-                                "prenom": patient.get("prenom", "")
-                            }
-                        else:
-                            payment["patient"] = {"nom": "Inconnu", "prenom": ""}
-                    else:
-                        payment["patient"] = {"nom": "Inconnu", "prenom": ""}
-                except:
-                    payment["patient"] = {"nom": "Inconnu", "prenom": ""}
-                
-                filtered_payments.append(payment)
-            
-            payments = filtered_payments
-        
-        # Filter by patient name if provided
-        if patient_name:
-            patient_name = patient_name.lower()
-            payments = [
-                payment for payment in payments 
-                if patient_name in f"{payment['patient'].get('prenom', '')} {payment['patient'].get('nom', '')}".lower()
+                for appointment in payments
             ]
         
-        # Sort by date (most recent first)
-        payments.sort(key=lambda x: x.get("date", ""), reverse=True)
-        
-        # Calculate pagination
-        total_count = len(payments)
-        total_pages = (total_count + limit - 1) // limit
-        skip = (page - 1) * limit
-        paginated_payments = payments[skip:skip + limit]
-        
         return {
-            "payments": paginated_payments,
+            "payments": payments,
             "pagination": {
                 "current_page": page,
                 "total_pages": total_pages,
                 "total_count": total_count,
                 "limit": limit,
-                "has_next": page < total_pages,
-                "has_prev": page > 1
+                "has_next": next_cursor is not None,
+                "has_prev": page > 1 or bool(after),
+                "next_cursor": next_cursor
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error searching payments: {str(e)}")
 
@@ -3825,7 +4682,7 @@ async def update_payment(payment_id: str, payment_data: PaymentUpdate):
     """Update existing payment record"""
     try:
         # Check if payment exists
-        existing_payment = payments_collection.find_one({"id": payment_id})
+        existing_payment = await payments_collection.find_one({"id": payment_id})
         if not existing_payment:
             raise HTTPException(status_code=404, detail="Payment not found")
         
@@ -3839,7 +4696,7 @@ async def update_payment(payment_id: str, payment_data: PaymentUpdate):
         }
         
         # Update payment record
-        result = payments_collection.update_one(
+        result = await payments_collection.update_one(
             {"id": payment_id},
             {"$set": update_data}
         )
@@ -3848,10 +4705,17 @@ async def update_payment(payment_id: str, payment_data: PaymentUpdate):
             raise HTTPException(status_code=404, detail="Failed to update payment")
         
         # Also update appointment payment status
-        appointments_collection.update_one(
+        await appointments_collection.update_one(
             {"id": existing_payment["appointment_id"]},
             {"$set": {"paye": payment_data.paye, "assure": payment_data.assure}}
         )
+        await record_appointment_change(
+            "updated", existing_payment["appointment_id"], {"paye": payment_data.paye, "assure": payment_data.assure}
+        )
+        
+        appointment = await appointments_collection.find_one({"id": existing_payment["appointment_id"]}, {"_id": 0, "date": 1})
+        await refresh_daily_rollups(existing_payment.get("date"), appointment.get("date") if appointment else None)
+        await refresh_patient_stats(existing_payment.get("patient_id"))
         
         return {"message": "Payment updated successfully"}
         
@@ -3875,7 +4739,7 @@ async def update_rdv_priority(rdv_id: str, priority_data: dict):
         raise HTTPException(status_code=400, detail=f"Invalid action. Must be one of: {valid_actions}")
     
     # Get the appointment to reorder
-    appointment = appointments_collection.find_one({"id": rdv_id})
+    appointment = await appointments_collection.find_one({"id": rdv_id})
     if not appointment:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
@@ -3887,10 +4751,10 @@ async def update_rdv_priority(rdv_id: str, priority_data: dict):
         
         # Get all appointments for the same date with 'attente' status, sorted by current priority
         date = appointment["date"]
-        waiting_appointments = list(appointments_collection.find({
+        waiting_appointments = await appointments_collection.find({
             "date": date,
             "statut": "attente"
-        }).sort([("priority", 1), ("heure", 1)]))  # Sort by priority first, then time
+        }).sort([("priority", 1), ("heure", 1)]).to_list(length=None)  # Sort by priority first, then time
         
         if len(waiting_appointments) <= 1:
             return {"message": "Only one appointment in waiting room, no reordering needed"}
@@ -3943,11 +4807,16 @@ async def update_rdv_priority(rdv_id: str, priority_data: dict):
         
         # Update all priorities based on new positions
         for i, appt in enumerate(new_order):
-            appointments_collection.update_one(
+            await appointments_collection.update_one(
                 {"id": appt["id"]},
                 {"$set": {"priority": i, "updated_at": datetime.now()}}
             )
         
+        # One delta for the whole waiting room
+        await record_appointment_change(
+            "reordered", rdv_id, {"priorities": {appt["id"]: i for i, appt in enumerate(new_order)}}, date
+        )
+        
         return {
             "message": f"Appointment {action} successful",
             "previous_position": current_pos + 1,
@@ -3968,7 +4837,9 @@ async def get_phone_messages(
     direction: str = Query("", description="Filter by direction: secretary_to_doctor, doctor_to_secretary"),
     recipient_role: str = Query("", description="Filter by recipient role: medecin, secretaire"),
     date_from: str = Query("", description="Filter from date YYYY-MM-DD"),
-    date_to: str = Query("", description="Filter to date YYYY-MM-DD")
+    date_to: str = Query("", description="Filter to date YYYY-MM-DD"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Messages per page (all messages when omitted)"),
+    after: Optional[str] = Query(None, description="Cursor of the next page (next_cursor of the previous response)")
 ):
     """Get phone messages with filtering (bidirectional)"""
     try:
@@ -3991,12 +4862,26 @@ async def get_phone_messages(
             else:
                 filter_query["call_date"] = {"$lte": date_to}
         
-        # Get messages sorted by call_date and call_time (newest first)
-        messages = list(phone_messages_collection.find(filter_query, {"_id": 0})
-                       .sort([("call_date", -1), ("call_time", -1)]))
+        # Get messages sorted by call_date and call_time (newest first), one page when limit is given
+        if limit is None:
+            messages = await (phone_messages_collection.find(cursor_query(filter_query, PHONE_MESSAGES_SORT, after), {"_id": 0})
+                              .sort(PHONE_MESSAGES_SORT)
+                              .to_list(length=None))
+            next_cursor = None
+        else:
+            messages, next_cursor = await fetch_keyset_page(
+                phone_messages_collection, filter_query, PHONE_MESSAGES_SORT, limit, after=after
+            )
+        total = await phone_messages_collection.count_documents(filter_query)
         
-        return {"phone_messages": messages, "total": len(messages)}
+        return {
+            "phone_messages": messages,
+            "total": total,
+            "next_cursor": next_cursor
+        }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching phone messages: {str(e)}")
 
@@ -4011,7 +4896,7 @@ async def create_phone_message(message_data: PhoneMessageCreate):
                 raise HTTPException(status_code=400, detail="Patient ID is required for secretary-to-doctor messages")
             
             # Get patient info
-            patient = patients_collection.find_one({"id": message_data.patient_id}, {"_id": 0})
+            patient = await get_patient_summary(message_data.patient_id)
             if not patient:
                 raise HTTPException(status_code=404, detail="Patient not found")
             
@@ -4041,7 +4926,8 @@ async def create_phone_message(message_data: PhoneMessageCreate):
         
         # Insert into database
         phone_message_dict = phone_message.dict()
-        phone_messages_collection.insert_one(phone_message_dict)
+        await phone_messages_collection.insert_one(phone_message_dict)
+        await bump_data_version("phone_messages")
         
         # Send WebSocket notification to appropriate recipient
         if message_data.direction == "secretary_to_doctor":
@@ -4067,7 +4953,7 @@ async def create_phone_message(message_data: PhoneMessageCreate):
                 "timestamp": phone_message.created_at.isoformat()
             }
         
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="phone_messages")
         
         return {"message": "Phone message created successfully", "message_id": phone_message.id}
         
@@ -4081,7 +4967,7 @@ async def respond_phone_message(message_id: str, response_data: PhoneMessageResp
     """Add response to phone message (bidirectional)"""
     try:
         # Find message
-        message = phone_messages_collection.find_one({"id": message_id})
+        message = await phone_messages_collection.find_one({"id": message_id})
         if not message:
             raise HTTPException(status_code=404, detail="Phone message not found")
         
@@ -4103,13 +4989,14 @@ async def respond_phone_message(message_id: str, response_data: PhoneMessageResp
             "updated_at": datetime.now()
         }
         
-        result = phone_messages_collection.update_one(
+        result = await phone_messages_collection.update_one(
             {"id": message_id},
             {"$set": update_data}
         )
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Failed to update message")
+        await bump_data_version("phone_messages")
         
         # Send WebSocket notification about response
         notification_data = {
@@ -4121,7 +5008,7 @@ async def respond_phone_message(message_id: str, response_data: PhoneMessageResp
             "direction": message["direction"],
             "timestamp": datetime.now().isoformat()
         }
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="phone_messages")
         
         return {"message": "Response added successfully"}
         
@@ -4135,7 +5022,7 @@ async def edit_phone_message(message_id: str, edit_data: PhoneMessageEdit):
     """Edit phone message content and priority"""
     try:
         # Find message
-        message = phone_messages_collection.find_one({"id": message_id})
+        message = await phone_messages_collection.find_one({"id": message_id})
         if not message:
             raise HTTPException(status_code=404, detail="Phone message not found")
         
@@ -4146,13 +5033,14 @@ async def edit_phone_message(message_id: str, edit_data: PhoneMessageEdit):
             "updated_at": datetime.now()
         }
         
-        result = phone_messages_collection.update_one(
+        result = await phone_messages_collection.update_one(
             {"id": message_id},
             {"$set": update_data}
         )
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Failed to update message")
+        await bump_data_version("phone_messages")
         
         # Send WebSocket notification about edit
         notification_data = {
@@ -4161,7 +5049,7 @@ async def edit_phone_message(message_id: str, edit_data: PhoneMessageEdit):
             "patient_name": message.get("patient_name", ""),
             "timestamp": datetime.now().isoformat()
         }
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="phone_messages")
         
         return {"message": "Phone message updated successfully"}
         
@@ -4175,16 +5063,16 @@ async def get_phone_messages_stats():
     """Get phone messages statistics"""
     try:
         # Count by status
-        nouveau_count = phone_messages_collection.count_documents({"status": "nouveau"})
-        traite_count = phone_messages_collection.count_documents({"status": "traité"})
+        nouveau_count = await phone_messages_collection.count_documents({"status": "nouveau"})
+        traite_count = await phone_messages_collection.count_documents({"status": "traité"})
         
         # Count by priority
-        urgent_count = phone_messages_collection.count_documents({"priority": "urgent"})
-        normal_count = phone_messages_collection.count_documents({"priority": "normal"})
+        urgent_count = await phone_messages_collection.count_documents({"priority": "urgent"})
+        normal_count = await phone_messages_collection.count_documents({"priority": "normal"})
         
         # Count by today
         today = datetime.now().strftime("%Y-%m-%d")
-        today_count = phone_messages_collection.count_documents({"call_date": today})
+        today_count = await phone_messages_collection.count_documents({"call_date": today})
         
         return {
             "nouveau": nouveau_count,
@@ -4202,9 +5090,10 @@ async def get_phone_messages_stats():
 async def delete_phone_message(message_id: str):
     """Delete phone message"""
     try:
-        result = phone_messages_collection.delete_one({"id": message_id})
+        result = await phone_messages_collection.delete_one({"id": message_id})
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Phone message not found")
+        await bump_data_version("phone_messages")
         
         return {"message": "Phone message deleted successfully"}
         
@@ -4217,7 +5106,8 @@ async def delete_phone_message(message_id: str):
 async def delete_all_phone_messages():
     """Delete all phone messages"""
     try:
-        result = phone_messages_collection.delete_many({})
+        result = await phone_messages_collection.delete_many({})
+        await bump_data_version("phone_messages")
         
         return {
             "message": f"{result.deleted_count} message(s) supprimé(s) avec succès",
@@ -4245,7 +5135,8 @@ async def create_cash_movement(movement: CashMovementCreate):
         ).dict()
         
         # Insert into database
-        result = cash_movements_collection.insert_one(movement_data)
+        result = await cash_movements_collection.insert_one(movement_data)
+        await refresh_daily_rollups(movement_data["date"])
         
         # Calculer le nouveau solde de caisse pour aujourd'hui
         solde = await get_daily_cash_balance()
@@ -4267,7 +5158,7 @@ async def create_cash_movement(movement: CashMovementCreate):
             "solde_actuel": solde,
             "timestamp": datetime.now().isoformat()
         }
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="cash")
         
         return {
             "message": "Mouvement de caisse créé avec succès",
@@ -4302,14 +5193,15 @@ async def get_cash_movements(
             filter_query["type_mouvement"] = type_mouvement
         
         # Compter total
-        total_count = cash_movements_collection.count_documents(filter_query)
+        total_count = await cash_movements_collection.count_documents(filter_query)
         
         # Récupérer les mouvements avec pagination
         skip = (page - 1) * limit
-        movements = list(cash_movements_collection.find(filter_query, {"_id": 0})
-                        .sort("created_at", -1)
-                        .skip(skip)
-                        .limit(limit))
+        movements = await (cash_movements_collection.find(filter_query, {"_id": 0})
+                           .sort("created_at", -1)
+                           .skip(skip)
+                           .limit(limit)
+                           .to_list(length=None))
         
         # Calcul pagination
         total_pages = (total_count + limit - 1) // limit
@@ -4336,20 +5228,20 @@ async def get_cash_balance(date: Optional[str] = Query(None)):
         
         # Calculer le solde depuis les paiements consultations
         payments_total = 0
-        consultations_with_payment = list(consultations_collection.find(
+        consultations_with_payment = await consultations_collection.find(
             {"date": target_date}, {"_id": 0}
-        ))
+        ).to_list(length=None)
         
         for consultation in consultations_with_payment:
             # Chercher le paiement associé
-            payment = payments_collection.find_one({"appointment_id": consultation["appointment_id"]})
+            payment = await payments_collection.find_one({"appointment_id": consultation["appointment_id"]})
             if payment and payment.get("statut") == "paye":
                 payments_total += payment.get("montant", 0)
         
         # Calculer les mouvements de caisse
-        mouvements = list(cash_movements_collection.find(
+        mouvements = await cash_movements_collection.find(
             {"date": target_date}, {"_id": 0}
-        ))
+        ).to_list(length=None)
         
         mouvements_total = 0
         for movement in mouvements:
@@ -4383,7 +5275,9 @@ async def update_cash_movement(movement_id: str, movement_update: CashMovementCr
             "updated_at": datetime.now()
         }
         
-        result = cash_movements_collection.update_one(
+        previous = await cash_movements_collection.find_one({"id": movement_id}, {"_id": 0, "date": 1})
+        
+        result = await cash_movements_collection.update_one(
             {"id": movement_id},
             {"$set": update_data}
         )
@@ -4391,6 +5285,8 @@ async def update_cash_movement(movement_id: str, movement_update: CashMovementCr
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Mouvement de caisse non trouvé")
         
+        await refresh_daily_rollups(update_data["date"], previous.get("date") if previous else None)
+        
         # Nouveau solde
         solde = await get_daily_cash_balance()
         
@@ -4401,7 +5297,7 @@ async def update_cash_movement(movement_id: str, movement_update: CashMovementCr
             "solde_actuel": solde,
             "timestamp": datetime.now().isoformat()
         }
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="cash")
         
         return {
             "message": "Mouvement de caisse modifié avec succès",
@@ -4417,11 +5313,13 @@ async def update_cash_movement(movement_id: str, movement_update: CashMovementCr
 async def delete_cash_movement(movement_id: str):
     """Supprimer un mouvement de caisse"""
     try:
-        result = cash_movements_collection.delete_one({"id": movement_id})
+        deleted = await cash_movements_collection.find_one_and_delete({"id": movement_id}, {"_id": 0, "date": 1})
         
-        if result.deleted_count == 0:
+        if not deleted:
             raise HTTPException(status_code=404, detail="Mouvement de caisse non trouvé")
         
+        await refresh_daily_rollups(deleted.get("date"))
+        
         # Nouveau solde
         solde = await get_daily_cash_balance()
         
@@ -4432,7 +5330,7 @@ async def delete_cash_movement(movement_id: str):
             "solde_actuel": solde,
             "timestamp": datetime.now().isoformat()
         }
-        await manager.broadcast(notification_data)
+        await manager.broadcast(notification_data, topic="cash")
         
         return {
             "message": "Mouvement de caisse supprimé avec succès",
@@ -4450,18 +5348,18 @@ async def get_daily_cash_balance():
     
     # Paiements du jour
     payments_total = 0
-    consultations_today = list(consultations_collection.find(
+    consultations_today = await consultations_collection.find(
         {"date": today}, {"_id": 0}
-    ))
+    ).to_list(length=None)
     
     for consultation in consultations_today:
-        payment = payments_collection.find_one({"appointment_id": consultation["appointment_id"]})
+        payment = await payments_collection.find_one({"appointment_id": consultation["appointment_id"]})
         if payment and payment.get("statut") == "paye":
             payments_total += payment.get("montant", 0)
     
     # Mouvements de caisse du jour
     mouvements_total = 0
-    mouvements = list(cash_movements_collection.find({"date": today}, {"_id": 0}))
+    mouvements = await cash_movements_collection.find({"date": today}, {"_id": 0}).to_list(length=None)
     
     for movement in mouvements:
         if movement["type_mouvement"] == "ajout":
@@ -4478,28 +5376,17 @@ async def get_admin_stats():
     """Get administration statistics"""
     try:
         # Total patients in database
-        total_patients = patients_collection.count_documents({})
+        total_patients = await patients_collection.count_documents({})
         
         # New patients since start of current year
         current_year = datetime.now().year
         start_of_year = f"{current_year}-01-01"
-        nouveaux_patients_annee = patients_collection.count_documents({
+        nouveaux_patients_annee = await patients_collection.count_documents({
             "created_at": {"$gte": datetime.strptime(start_of_year, "%Y-%m-%d")}
         })
         
         # Inactive patients (no consultation in last 12 months)
-        twelve_months_ago = (datetime.now() - timedelta(days=365)).strftime("%Y-%m-%d")
-        
-        # Get all patient IDs who have consultations in last 12 months
-        recent_consultations = list(consultations_collection.find(
-            {"date": {"$gte": twelve_months_ago}}, 
-            {"patient_id": 1, "_id": 0}
-        ))
-        active_patient_ids = set(c["patient_id"] for c in recent_consultations)
-        
-        # Count total patients not in active list
-        all_patient_ids = set(p["id"] for p in patients_collection.find({}, {"id": 1, "_id": 0}))
-        patients_inactifs = len(all_patient_ids - active_patient_ids)
+        patients_inactifs = await patients_collection.count_documents(inactive_patients_query())
         
         return {
             "total_patients": total_patients,
@@ -4514,48 +5401,106 @@ async def get_admin_stats():
 async def get_inactive_patients():
     """Get list of patients inactive for more than 12 months"""
     try:
-        twelve_months_ago = (datetime.now() - timedelta(days=365)).strftime("%Y-%m-%d")
-        
-        # Get patient IDs with recent consultations
-        recent_consultations = list(consultations_collection.find(
-            {"date": {"$gte": twelve_months_ago}}, 
-            {"patient_id": 1, "_id": 0}
-        ))
-        active_patient_ids = set(c["patient_id"] for c in recent_consultations)
-        
-        # Get all patients
-        all_patients = list(patients_collection.find({}, {"_id": 0}))
+        patients = await patients_collection.find(
+            inactive_patients_query(),
+            {"_id": 0, "id": 1, "nom": 1, "prenom": 1, "age": 1, "numero_whatsapp": 1,
+             "lien_whatsapp": 1, "last_consultation_date": 1, "created_at": 1}
+        ).sort("last_consultation_date", 1).to_list(length=None)
         
-        # Filter inactive patients and get their last consultation date
-        inactive_patients = []
-        for patient in all_patients:
-            if patient["id"] not in active_patient_ids:
-                # Get last consultation date for this patient
-                last_consultation = consultations_collection.find_one(
-                    {"patient_id": patient["id"]},
-                    sort=[("date", -1)]
-                )
-                
-                last_consultation_date = None
-                if last_consultation:
-                    last_consultation_date = last_consultation.get("date")
-                
-                inactive_patients.append({
-                    "id": patient["id"],
-                    "nom": patient.get("nom", ""),
-                    "prenom": patient.get("prenom", ""),
-                    "age": patient.get("age", ""),
-                    "numero_whatsapp": patient.get("numero_whatsapp", ""),
-                    "lien_whatsapp": patient.get("lien_whatsapp", ""),
-                    "last_consultation_date": last_consultation_date,
-                    "created_at": patient.get("created_at", datetime.now()).isoformat() if patient.get("created_at") else None
-                })
+        inactive_patients = [
+            {
+                "id": patient["id"],
+                "nom": patient.get("nom", ""),
+                "prenom": patient.get("prenom", ""),
+                "age": patient.get("age", ""),
+                "numero_whatsapp": patient.get("numero_whatsapp", ""),
+                "lien_whatsapp": patient.get("lien_whatsapp", ""),
+                "last_consultation_date": patient.get("last_consultation_date") or None,
+                "created_at": patient["created_at"].isoformat() if isinstance(patient.get("created_at"), datetime) else patient.get("created_at")
+            }
+            for patient in patients
+        ]
         
-        return {"inactive_patients": inactive_patients}
+        return {"inactive_patients": inactive_patients, "count": len(inactive_patients)}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching inactive patients: {str(e)}")
 
+# ==================== DATABASE INDEXES ====================
+
+async def ensure_indexes() -> dict:
+    """Create the indexes declared in db_indexes.INDEX_SPECS (idempotent)"""
+    created, errors = [], []
+    for collection_name, specs in INDEX_SPECS.items():
+        collection = db[collection_name]
+        for spec in specs:
+            name = index_name(spec["keys"])
+            try:
+                await collection.create_index(spec["keys"], **index_options(spec))
+                created.append(f"{collection_name}.{name}")
+            except Exception as e:
+                errors.append({"index": f"{collection_name}.{name}", "error": str(e)})
+                print(f"⚠️  Index {collection_name}.{name} not created: {e}")
+    print(f"🗂️  Indexes ensured: {len(created)} ok, {len(errors)} errors")
+    return {"ensured": created, "errors": errors}
+
+async def get_index_report() -> dict:
+    """Compare declared indexes with existing ones and their usage since server start"""
+    report = {}
+    collection_names = set(INDEX_SPECS) | set(await db.list_collection_names())
+    for collection_name in sorted(collection_names):
+        if collection_name.startswith("system."):
+            continue
+        collection = db[collection_name]
+        declared = {index_name(spec["keys"]) for spec in INDEX_SPECS.get(collection_name, [])}
+        existing = {}
+        async for index in collection.list_indexes():
+            existing[index["name"]] = index_name(list(index["key"].items()))
+        existing_keys = set(existing.values())
+        
+        usage = {}
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = {
+                    "ops": stat.get("accesses", {}).get("ops", 0),
+                    "since": stat.get("accesses", {}).get("since")
+                }
+        except Exception as e:
+            print(f"⚠️  $indexStats unavailable for {collection_name}: {e}")
+        
+        report[collection_name] = {
+            "existing": sorted(existing),
+            "missing": sorted(declared - existing_keys),
+            "undeclared": sorted(name for name, keys in existing.items()
+                                 if name != "_id_" and keys not in declared),
+            "unused": sorted(name for name, stat in usage.items()
+                             if name != "_id_" and stat["ops"] == 0),
+            "usage": usage
+        }
+    return report
+
+@app.get("/api/admin/indexes")
+async def get_indexes_report():
+    """Report missing, undeclared and unused indexes per collection"""
+    try:
+        report = await get_index_report()
+        return {
+            "collections": report,
+            "missing_total": sum(len(c["missing"]) for c in report.values()),
+            "unused_total": sum(len(c["unused"]) for c in report.values()),
+            "generated_at": datetime.now().isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error building index report: {str(e)}")
+
+@app.post("/api/admin/indexes/ensure")
+async def ensure_indexes_endpoint():
+    """Create the declared indexes now"""
+    try:
+        return await ensure_indexes()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating indexes: {str(e)}")
+
 @app.delete("/api/admin/database/{collection_name}")
 async def reset_database_collection(collection_name: str):
     """Reset specific database collection"""
@@ -4575,11 +5520,13 @@ async def reset_database_collection(collection_name: str):
         
         # Reset the specific collection
         collection = valid_collections[collection_name]
-        result = collection.delete_many({})
+        result = await collection.delete_many({})
+        await rebuild_patient_stats()
         
         # For facturation, also reset cash movements
         if collection_name == "facturation":
-            cash_result = cash_movements_collection.delete_many({})
+            cash_result = await cash_movements_collection.delete_many({})
+            await rebuild_daily_rollups()
             return {
                 "message": f"Collection '{collection_name}' réinitialisée avec succès",
                 "payments_deleted": result.deleted_count,
@@ -4587,6 +5534,18 @@ async def reset_database_collection(collection_name: str):
                 "total_deleted": result.deleted_count + cash_result.deleted_count
             }
         
+        if collection_name == "appointments":
+            await rebuild_daily_rollups()
+            await reset_day_versions()
+        
+        if collection_name == "patients":
+            await bump_data_version("patients")
+            await publish_patient_search_change("reload")
+        
+        if collection_name == "consultations":
+            await backfill_last_consultation_dates(only_missing=False)
+            await bump_data_version("consultations")
+        
         return {
             "message": f"Collection '{collection_name}' réinitialisée avec succès",
             "deleted_count": result.deleted_count
@@ -4615,8 +5574,18 @@ async def get_monthly_report(
             if not end_year:
                 end_year = start_year
                 
-            # Generate multi-month report
-            monthly_reports = []
+            # Months of the range
+            months = []
+            current_year, current_month = start_year, start_month
+            while (current_year < end_year) or (current_year == end_year and current_month <= end_month):
+                months.append((current_year, current_month))
+                current_year, current_month = (current_year + 1, 1) if current_month == 12 else (current_year, current_month + 1)
+            if not months:
+                raise HTTPException(status_code=400, detail="Invalid month range")
+            
+            # One pass over each collection for the whole range
+            monthly_reports = await calculate_monthly_stats(months)
+            
             total_stats = {
                 "nouveaux_patients": 0,
                 "consultations_totales": 0,
@@ -4626,38 +5595,9 @@ async def get_monthly_report(
                 "recette_totale": 0.0,
                 "nb_relances_telephoniques": 0
             }
-            
-            # Generate reports for each month in range
-            current_year = start_year
-            current_month = start_month
-            
-            while (current_year < end_year) or (current_year == end_year and current_month <= end_month):
-                # Date range for the month
-                start_date = datetime(current_year, current_month, 1).strftime("%Y-%m-%d")
-                
-                # Calculate end date (last day of month)
-                if current_month == 12:
-                    end_date = datetime(current_year + 1, 1, 1) - timedelta(days=1)
-                    next_year = current_year + 1
-                    next_month = 1
-                else:
-                    end_date = datetime(current_year, current_month + 1, 1) - timedelta(days=1)
-                    next_year = current_year
-                    next_month = current_month + 1
-                    
-                end_date_str = end_date.strftime("%Y-%m-%d")
-                
-                # Calculate monthly stats
-                monthly_data = await calculate_monthly_stats(start_date, end_date_str, current_year, current_month)
-                monthly_reports.append(monthly_data)
-                
-                # Add to totals
+            for monthly_data in monthly_reports:
                 for key in total_stats:
                     total_stats[key] += monthly_data[key]
-                
-                # Move to next month
-                current_year = next_year
-                current_month = next_month
             
             # Calculate averages
             num_months = len(monthly_reports)
@@ -4683,17 +5623,7 @@ async def get_monthly_report(
             if not month:
                 month = datetime.now().month
                 
-            # Date range for the month
-            start_date = datetime(year, month, 1).strftime("%Y-%m-%d")
-            
-            # Calculate end date (last day of month)
-            if month == 12:
-                end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-            else:
-                end_date = datetime(year, month + 1, 1) - timedelta(days=1)
-            end_date_str = end_date.strftime("%Y-%m-%d")
-            
-            monthly_data = await calculate_monthly_stats(start_date, end_date_str, year, month)
+            monthly_data = (await calculate_monthly_stats([(year, month)]))[0]
             
             return {
                 **monthly_data,
@@ -4701,119 +5631,209 @@ async def get_monthly_report(
                 "generated_at": datetime.now().isoformat()
             }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating monthly report: {str(e)}")
 
-async def calculate_monthly_stats(start_date: str, end_date_str: str, year: int, month: int):
-    """Calculate statistics for a specific month"""
-    # New patients this month
-    nouveaux_patients = patients_collection.count_documents({
-        "created_at": {
-            "$gte": datetime.strptime(start_date, "%Y-%m-%d"),
-            "$lte": datetime.strptime(end_date_str, "%Y-%m-%d")
-        }
-    })
-    
-    # Consultations this month  
-    consultations_mois = consultations_collection.count_documents({
-        "date": {"$gte": start_date, "$lte": end_date_str}
-    })
-    
-    # Visites vs Controles
-    nb_visites = consultations_collection.count_documents({
-        "date": {"$gte": start_date, "$lte": end_date_str},
-        "type_rdv": "visite"
-    })
-    
-    nb_controles = consultations_collection.count_documents({
-        "date": {"$gte": start_date, "$lte": end_date_str},
-        "type_rdv": "controle"
-    })
-    
-    # Patients assurés (appointments with assure=true)
-    nb_assures = appointments_collection.count_documents({
-        "date": {"$gte": start_date, "$lte": end_date_str},
-        "assure": True,
-        "statut": {"$in": ["termine", "absent", "retard"]}  # Completed appointments
-    })
-    
-    # Total revenue for the month
-    recette_totale = 0
-    
-    # From payments
-    payments_month = list(payments_collection.find({
-        "date": {"$gte": start_date, "$lte": end_date_str},
-        "statut": "paye"
-    }, {"_id": 0}))
-    
-    for payment in payments_month:
-        recette_totale += payment.get("montant", 0)
-        
-    # From cash movements
-    cash_movements_month = list(cash_movements_collection.find({
-        "date": {"$gte": start_date, "$lte": end_date_str}
-    }, {"_id": 0}))
+async def calculate_monthly_stats(months: List[tuple]) -> List[dict]:
+    """Statistics of each (year, month): one aggregation per collection over the whole range, run concurrently"""
+    range_start = get_month_bounds(*months[0])[0]
+    range_end = get_month_bounds(*months[-1])[1]
+    date_range = {"$gte": range_start, "$lte": range_end}
+    
+    patient_rows, consultation_rows, insured_rows, payment_rows, movement_rows, call_rows = await asyncio.gather(
+        aggregate_by_day(
+            patients_collection,
+            {"created_at": {"$gte": datetime.strptime(range_start, "%Y-%m-%d"),
+                            "$lte": datetime.strptime(range_end, "%Y-%m-%d")}},
+            [], date_field="created_at", datetime_field=True
+        ),
+        aggregate_by_day(consultations_collection, {"date": date_range}, ["type_rdv"], {
+            "visites": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "visite"]}, 1, 0]}},
+            "controles": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "controle"]}, 1, 0]}}
+        }),
+        # Patients assurés: completed appointments with assure=true
+        aggregate_by_day(appointments_collection, {
+            "date": date_range,
+            "assure": True,
+            "statut": {"$in": ["termine", "absent", "retard"]}
+        }, []),
+        aggregate_by_day(payments_collection, {"date": date_range, "statut": "paye"},
+                         ["montant"], {"montant": {"$sum": "$montant"}}),
+        aggregate_by_day(cash_movements_collection, {"date": date_range},
+                         ["montant", "type_mouvement"], {"net": CASH_MOVEMENT_NET_SUM}),
+        # Phone reminders (relances téléphoniques)
+        aggregate_by_day(phone_messages_collection, {"call_date": date_range}, [], date_field="call_date")
+    )
     
-    for movement in cash_movements_month:
-        if movement["type_mouvement"] == "ajout":
-            recette_totale += movement["montant"]
+    monthly_stats = []
+    for year, month in months:
+        start_date, end_date_str = get_month_bounds(year, month)
+        recette_totale = (sum_rows_in_range(payment_rows, start_date, end_date_str, "montant")
+                          + sum_rows_in_range(movement_rows, start_date, end_date_str, "net"))
+        monthly_stats.append({
+            "periode": f"{month:02d}/{year}",
+            "start_date": start_date,
+            "end_date": end_date_str,
+            "nouveaux_patients": sum_rows_in_range(patient_rows, start_date, end_date_str),
+            "consultations_totales": sum_rows_in_range(consultation_rows, start_date, end_date_str),
+            "nb_visites": sum_rows_in_range(consultation_rows, start_date, end_date_str, "visites"),
+            "nb_controles": sum_rows_in_range(consultation_rows, start_date, end_date_str, "controles"),
+            "nb_assures": sum_rows_in_range(insured_rows, start_date, end_date_str),
+            "recette_totale": round(recette_totale, 2),
+            "nb_relances_telephoniques": sum_rows_in_range(call_rows, start_date, end_date_str)
+        })
+    return monthly_stats
+
+# ==================== STREAMING EXPORTS ====================
+
+EXPORT_BATCH_SIZE = 500
+
+# Exportable collections and the date field filtered by start_date/end_date
+EXPORT_COLLECTIONS = {
+    "patients": (patients_collection, "created_at"),
+    "appointments": (appointments_collection, "date"),
+    "consultations": (consultations_collection, "date"),
+    "payments": (payments_collection, "date")
+}
+
+# Fields removed from the patient model, never exported
+EXPORT_DROPPED_FIELDS = {"patients": ["assurance", "numero_assurance", "nom_parent", "telephone_parent"]}
+
+EXPORT_MEDIA_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8"
+}
+
+def export_query(date_field: str, start_date: Optional[str], end_date: Optional[str]) -> dict:
+    """Date range filter (YYYY-MM-DD, inclusive), ValueError on malformed dates"""
+    bounds = {}
+    if date_field == "created_at":  # Stored as datetime
+        if start_date:
+            bounds["$gte"] = datetime.strptime(start_date, "%Y-%m-%d")
+        if end_date:
+            bounds["$lt"] = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+    else:
+        for value in (start_date, end_date):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+        if start_date:
+            bounds["$gte"] = start_date
+        if end_date:
+            bounds["$lte"] = end_date
+    return {date_field: bounds} if bounds else {}
+
+def export_projection(collection_name: str, fields: List[str]) -> dict:
+    if fields:
+        return {"_id": 0, **{field: 1 for field in fields}}
+    return {"_id": 0, **{field: 0 for field in EXPORT_DROPPED_FIELDS.get(collection_name, [])}}
+
+async def export_columns(collection_name: str, collection, query: dict) -> List[str]:
+    """CSV columns: every field found in the exported documents (collected by MongoDB), id first"""
+    keys = await collection.aggregate([
+        {"$match": query},
+        {"$project": {"keys": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}}}},
+        {"$unwind": "$keys"},
+        {"$group": {"_id": "$keys"}}
+    ], allowDiskUse=True).to_list(length=None)
+    excluded = {"_id", *EXPORT_DROPPED_FIELDS.get(collection_name, [])}
+    columns = sorted(key["_id"] for key in keys if key["_id"] not in excluded)
+    return sorted(columns, key=lambda column: column != "id")
+
+def export_json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def export_json(document: dict) -> str:
+    return json.dumps(document, default=export_json_default, ensure_ascii=False)
+
+def export_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return export_json(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def csv_line(values) -> str:
+    out = io.StringIO()
+    csv.writer(out).writerow(values)
+    return out.getvalue()
+
+async def export_chunks(collection_name: str, collection, query: dict, projection: dict,
+                        export_format: str, columns: List[str]):
+    """Export text in chunks of EXPORT_BATCH_SIZE documents read from a batched cursor"""
+    if export_format == "json":
+        yield f'{{"collection": {json.dumps(collection_name)}, "data": ['
+    elif export_format == "csv":
+        yield "\ufeff" + csv_line(columns)  # UTF-8 BOM for Excel
+    count = 0
+    lines = []
+    async for document in collection.find(query, projection).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE):
+        if export_format == "csv":
+            lines.append(csv_line(export_cell(document.get(column)) for column in columns))
+        elif export_format == "json":
+            lines.append(("," if count else "") + export_json(document))
         else:
-            recette_totale -= movement["montant"]
-    
-    # Phone reminders count (relances téléphoniques)
-    nb_relances = phone_messages_collection.count_documents({
-        "call_date": {"$gte": start_date, "$lte": end_date_str}
-    })
-    
-    return {
-        "periode": f"{month:02d}/{year}",
-        "start_date": start_date,
-        "end_date": end_date_str,
-        "nouveaux_patients": nouveaux_patients,
-        "consultations_totales": consultations_mois,
-        "nb_visites": nb_visites,
-        "nb_controles": nb_controles,
-        "nb_assures": nb_assures,
-        "recette_totale": round(recette_totale, 2),
-        "nb_relances_telephoniques": nb_relances
-    }
+            lines.append(export_json(document) + "\n")
+        count += 1
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+    if export_format == "json":
+        yield f'], "count": {count}}}'
+
+async def gzip_chunks(chunks):
+    """gzip-compress a stream of text chunks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
 
 @app.get("/api/admin/export/{collection_name}")
-async def export_collection_data(collection_name: str):
-    """Export collection data for download"""
+async def export_collection_data(
+    collection_name: str,
+    export_format: str = Query("json", alias="format", pattern="^(json|ndjson|csv)$",
+                               description="json (single document), ndjson or csv"),
+    start_date: Optional[str] = Query(None, description="First day (YYYY-MM-DD)"),
+    end_date: Optional[str] = Query(None, description="Last day (YYYY-MM-DD)"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to export"),
+    gzip: bool = Query(False, description="gzip-compressed download")
+):
+    """Stream a collection export (constant memory, batched cursor)"""
+    if collection_name not in EXPORT_COLLECTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid collection. Valid options: {', '.join(EXPORT_COLLECTIONS.keys())}"
+        )
+    collection, date_field = EXPORT_COLLECTIONS[collection_name]
     try:
-        valid_collections = {
-            "patients": patients_collection,
-            "appointments": appointments_collection,
-            "consultations": consultations_collection,
-            "payments": payments_collection
-        }
-        
-        if collection_name not in valid_collections:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid collection. Valid options: {', '.join(valid_collections.keys())}"
-            )
-        
-        collection = valid_collections[collection_name]
-        data = list(collection.find({}, {"_id": 0}))  # Exclude MongoDB _id field
-        
-        if not data:
-            return {
-                "message": f"Aucune donnée trouvée dans la collection {collection_name}",
-                "data": [],
-                "count": 0
-            }
-        
-        return {
-            "message": f"Export de {len(data)} éléments de {collection_name}",
-            "data": data,
-            "count": len(data),
-            "collection": collection_name
-        }
+        query = export_query(date_field, start_date, end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must use the YYYY-MM-DD format")
+    
+    try:
+        field_list = [field.strip() for field in (fields or "").split(",") if field.strip()]
+        projection = export_projection(collection_name, field_list)
+        columns = []
+        if export_format == "csv":
+            columns = field_list or await export_columns(collection_name, collection, query)
         
-    except HTTPException:
-        raise
+        body = export_chunks(collection_name, collection, query, projection, export_format, columns)
+        media_type = EXPORT_MEDIA_TYPES[export_format]
+        filename = f"{collection_name}_{datetime.now().strftime('%Y-%m-%d')}.{export_format}"
+        if gzip:
+            body = gzip_chunks(body)
+            media_type = "application/gzip"
+            filename += ".gz"
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        return StreamingResponse(body, media_type=media_type, headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error exporting collection: {str(e)}")
 
@@ -4826,7 +5846,7 @@ async def perform_maintenance(action: str):
             patients_updated = 0
             current_date = datetime.now()
             
-            for patient in patients_collection.find():
+            async for patient in patients_collection.find():
                 updates = {}
                 
                 # Update age if birth date exists
@@ -4842,9 +5862,17 @@ async def perform_maintenance(action: str):
                 if patient.get("numero_whatsapp"):
                     updates["lien_whatsapp"] = f"https://wa.me/{patient['numero_whatsapp']}"
                 
+                # Refresh accent-folded search keys
+                search_keys = patient_search_keys(patient)
+                if search_keys != patient.get("search_keys"):
+                    updates["search_keys"] = search_keys
+                
                 if updates:
-                    patients_collection.update_one({"id": patient["id"]}, {"$set": updates})
+                    await patients_collection.update_one({"id": patient["id"]}, {"$set": updates})
                     patients_updated += 1
+            if patients_updated:
+                await bump_data_version("patients")
+                await publish_patient_search_change("reload")
             
             return {
                 "action": "update_calculated_fields",
@@ -4860,18 +5888,18 @@ async def perform_maintenance(action: str):
             issues = []
             
             # Check orphaned consultations
-            consultations = list(consultations_collection.find())
+            consultations = await consultations_collection.find().to_list(length=None)
             for consultation in consultations:
                 if consultation.get("appointment_id"):
-                    appointment = appointments_collection.find_one({"id": consultation["appointment_id"]})
+                    appointment = await appointments_collection.find_one({"id": consultation["appointment_id"]})
                     if not appointment:
                         issues.append(f"Consultation {consultation['id']} has orphaned appointment_id {consultation['appointment_id']}")
             
             # Check orphaned payments
-            payments = list(payments_collection.find())
+            payments = await payments_collection.find().to_list(length=None)
             for payment in payments:
                 if payment.get("appointment_id"):
-                    appointment = appointments_collection.find_one({"id": payment["appointment_id"]})
+                    appointment = await appointments_collection.find_one({"id": payment["appointment_id"]})
                     if not appointment:
                         issues.append(f"Payment {payment['id']} has orphaned appointment_id {payment['appointment_id']}")
             
@@ -4914,18 +5942,21 @@ async def perform_maintenance(action: str):
 async def login(user_login: UserLogin):
     """Authenticate user and return JWT token"""
     try:
-        user = users_collection.find_one({"username": user_login.username}, {"_id": 0})
+        user = await users_collection.find_one({"username": user_login.username}, {"_id": 0})
         
-        if not user or not verify_password(user_login.password, user["hashed_password"]):
+        if not user or not await verify_password(user_login.password, user["hashed_password"]):
             raise HTTPException(status_code=401, detail="Nom d'utilisateur ou mot de passe incorrect")
         
         if not user.get("is_active", True):
             raise HTTPException(status_code=401, detail="Compte utilisateur désactivé")
         
-        # Update last login
-        users_collection.update_one(
+        # Update last login (and upgrade hashes made with another work factor)
+        login_update = {"last_login": datetime.now()}
+        if password_needs_rehash(user["hashed_password"]):
+            login_update["hashed_password"] = await hash_password(user_login.password)
+        await users_collection.update_one(
             {"username": user_login.username}, 
-            {"$set": {"last_login": datetime.now()}}
+            {"$set": login_update}
         )
         
         # Create access token
@@ -4965,7 +5996,7 @@ async def get_all_users(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Permission refusée: gestion des utilisateurs requise")
     
     try:
-        users = list(users_collection.find({}, {"_id": 0, "hashed_password": 0}))
+        users = await users_collection.find({}, {"_id": 0, "hashed_password": 0}).to_list(length=None)
         return {"users": users, "count": len(users)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching users: {str(e)}")
@@ -4978,7 +6009,7 @@ async def create_user(user_create: UserCreate, current_user: dict = Depends(get_
     
     try:
         # Check if username already exists
-        existing_user = users_collection.find_one({"username": user_create.username})
+        existing_user = await users_collection.find_one({"username": user_create.username})
         if existing_user:
             raise HTTPException(status_code=400, detail="Ce nom d'utilisateur existe déjà")
         
@@ -5012,12 +6043,12 @@ async def create_user(user_create: UserCreate, current_user: dict = Depends(get_
             email=user_create.email,
             full_name=user_create.full_name,
             role=user_create.role,
-            hashed_password=hash_password(user_create.password),
+            hashed_password=await hash_password(user_create.password),
             permissions=permissions
         )
         
         # Insert to database
-        users_collection.insert_one(new_user.dict())
+        await users_collection.insert_one(new_user.dict())
         
         # Return user without password
         return UserResponse(**new_user.dict())
@@ -5040,7 +6071,7 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
         raise HTTPException(status_code=403, detail="Permission refusée")
     
     try:
-        user = users_collection.find_one({"id": user_id}, {"_id": 0})
+        user = await users_collection.find_one({"id": user_id}, {"_id": 0})
         if not user:
             raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
         
@@ -5049,7 +6080,7 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
         
         if user_update.username is not None:
             # Check if new username is taken by someone else
-            existing = users_collection.find_one({"username": user_update.username, "id": {"$ne": user_id}})
+            existing = await users_collection.find_one({"username": user_update.username, "id": {"$ne": user_id}})
             if existing:
                 raise HTTPException(status_code=400, detail="Ce nom d'utilisateur est déjà pris")
             update_data["username"] = user_update.username
@@ -5061,7 +6092,7 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
             update_data["full_name"] = user_update.full_name
         
         if user_update.password is not None:
-            update_data["hashed_password"] = hash_password(user_update.password)
+            update_data["hashed_password"] = await hash_password(user_update.password)
         
         if user_update.is_active is not None:
             # Only admins can change active status
@@ -5074,10 +6105,10 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
                 update_data["permissions"] = user_update.permissions.dict()
         
         # Update user
-        users_collection.update_one({"id": user_id}, {"$set": update_data})
+        await users_collection.update_one({"id": user_id}, {"$set": update_data})
         
         # Return updated user
-        updated_user = users_collection.find_one({"id": user_id}, {"_id": 0, "hashed_password": 0})
+        updated_user = await users_collection.find_one({"id": user_id}, {"_id": 0, "hashed_password": 0})
         return {"message": "Utilisateur mis à jour avec succès", "user": updated_user}
         
     except HTTPException:
@@ -5096,12 +6127,12 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
         if current_user.get("id") == user_id:
             raise HTTPException(status_code=400, detail="Impossible de supprimer votre propre compte")
         
-        user = users_collection.find_one({"id": user_id})
+        user = await users_collection.find_one({"id": user_id})
         if not user:
             raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
         
         # Delete user
-        result = users_collection.delete_one({"id": user_id})
+        result = await users_collection.delete_one({"id": user_id})
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
@@ -5120,18 +6151,18 @@ async def update_user_permissions(user_id: str, permissions: UserPermissions, cu
         raise HTTPException(status_code=403, detail="Permission refusée: gestion des utilisateurs requise")
     
     try:
-        user = users_collection.find_one({"id": user_id})
+        user = await users_collection.find_one({"id": user_id})
         if not user:
             raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
         
         # Update permissions
-        users_collection.update_one(
+        await users_collection.update_one(
             {"id": user_id}, 
             {"$set": {"permissions": permissions.dict(), "updated_at": datetime.now()}}
         )
         
         # Return updated user
-        updated_user = users_collection.find_one({"id": user_id}, {"_id": 0, "hashed_password": 0})
+        updated_user = await users_collection.find_one({"id": user_id}, {"_id": 0, "hashed_password": 0})
         return {"message": "Permissions mises à jour avec succès", "user": updated_user}
         
     except HTTPException:
@@ -5146,73 +6177,46 @@ async def get_yearly_evolution_charts():
         current_year = datetime.now().year
         monthly_data = []
         
+        year_start = f"{current_year}-01-01"
+        year_end = f"{current_year}-12-31"
+        year_range = {"$gte": year_start, "$lte": year_end}
+        
+        # One aggregation per collection for the whole year, run concurrently
+        patient_rows, consultation_rows, payment_rows, movement_rows = await asyncio.gather(
+            aggregate_by_day(
+                patients_collection,
+                {"created_at": {"$gte": datetime.strptime(year_start, "%Y-%m-%d"),
+                                "$lte": datetime.strptime(year_end, "%Y-%m-%d")}},
+                [], date_field="created_at", datetime_field=True
+            ),
+            aggregate_by_day(consultations_collection, {"date": year_range}, ["type_rdv"], {
+                "visites": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "visite"]}, 1, 0]}},
+                "controles": {"$sum": {"$cond": [{"$eq": ["$type_rdv", "controle"]}, 1, 0]}}
+            }),
+            aggregate_by_day(payments_collection, {"date": year_range, "statut": "paye"},
+                             ["montant"], {"montant": {"$sum": "$montant"}}),
+            aggregate_by_day(cash_movements_collection, {"date": year_range},
+                             ["montant", "type_mouvement"], {"net": CASH_MOVEMENT_NET_SUM})
+        )
+        
         # Generate data for each month of current year
         for month in range(1, 13):
-            # Date range for the month
-            start_date = datetime(current_year, month, 1).strftime("%Y-%m-%d")
-            
-            # Calculate end date (last day of month)
-            if month == 12:
-                end_date = datetime(current_year + 1, 1, 1) - timedelta(days=1)
-            else:
-                end_date = datetime(current_year, month + 1, 1) - timedelta(days=1)
-            end_date_str = end_date.strftime("%Y-%m-%d")
-            
-            # New patients this month
-            nouveaux_patients = patients_collection.count_documents({
-                "created_at": {
-                    "$gte": datetime.strptime(start_date, "%Y-%m-%d"),
-                    "$lte": datetime.strptime(end_date_str, "%Y-%m-%d")
-                }
-            })
-            
-            # Total consultations this month
-            consultations_mois = consultations_collection.count_documents({
-                "date": {"$gte": start_date, "$lte": end_date_str}
-            })
+            start_date, end_date_str = get_month_bounds(current_year, month)
             
             # Revenue this month (from payments + cash movements)
-            recette_mensuelle = 0
-            
-            # From payments
-            payments_month = list(payments_collection.find({
-                "date": {"$gte": start_date, "$lte": end_date_str},
-                "statut": "paye"
-            }, {"_id": 0, "montant": 1}))
-            
-            for payment in payments_month:
-                recette_mensuelle += payment.get("montant", 0)
-                
-            # From cash movements (additions only)
-            cash_movements_month = list(cash_movements_collection.find({
-                "date": {"$gte": start_date, "$lte": end_date_str}
-            }, {"_id": 0, "montant": 1, "type_mouvement": 1}))
-            
-            for movement in cash_movements_month:
-                if movement["type_mouvement"] == "ajout":
-                    recette_mensuelle += movement["montant"]
-                else:
-                    recette_mensuelle -= movement["montant"]
-            
-            # Visites vs Controles breakdown
-            nb_visites = consultations_collection.count_documents({
-                "date": {"$gte": start_date, "$lte": end_date_str},
-                "type_rdv": "visite"
-            })
-            
-            nb_controles = consultations_collection.count_documents({
-                "date": {"$gte": start_date, "$lte": end_date_str},
-                "type_rdv": "controle"
-            })
+            recette_mensuelle = (
+                sum_rows_in_range(payment_rows, start_date, end_date_str, "montant")
+                + sum_rows_in_range(movement_rows, start_date, end_date_str, "net")
+            )
             
             monthly_data.append({
                 "month": month,
                 "month_name": datetime(current_year, month, 1).strftime("%B"),
                 "month_short": datetime(current_year, month, 1).strftime("%b"),
-                "nouveaux_patients": nouveaux_patients,
-                "consultations_totales": consultations_mois,
-                "nb_visites": nb_visites,
-                "nb_controles": nb_controles,
+                "nouveaux_patients": sum_rows_in_range(patient_rows, start_date, end_date_str),
+                "consultations_totales": sum_rows_in_range(consultation_rows, start_date, end_date_str),
+                "nb_visites": sum_rows_in_range(consultation_rows, start_date, end_date_str, "visites"),
+                "nb_controles": sum_rows_in_range(consultation_rows, start_date, end_date_str, "controles"),
                 "recette_mensuelle": round(recette_mensuelle, 2)
             })
         
@@ -5239,8 +6243,6 @@ async def get_yearly_evolution_charts():
 
 # ==================== ADVANCED REPORTS API ====================
 
-from collections import defaultdict
-
 # Advanced Report Models
 class AdvancedReportRequest(BaseModel):
     period_type: str = Field(..., description="monthly, semester, annual, custom")
@@ -5261,17 +6263,17 @@ async def calculate_advanced_statistics(start_date: str, end_date: str):
         end_dt = datetime.strptime(end_date, "%Y-%m-%d")
         
         # Get all appointments in period
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
         # Get all consultations in period
-        consultations = list(consultations_collection.find({
+        consultations = await consultations_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
         # Get all patients
-        all_patients = list(patients_collection.find({}, {"_id": 0}))
+        all_patients = await patients_collection.find({}, {"_id": 0}).to_list(length=None)
         
         # 1. Répartition Visite/Contrôle
         visites = [apt for apt in appointments if apt.get("type_rdv") == "visite"]
@@ -5294,51 +6296,24 @@ async def calculate_advanced_statistics(start_date: str, end_date: str):
             "total": len(appointments)
         }
         
-        # 2. Top 10 Patients Rentables - Enhanced Analysis
-        patient_revenue = defaultdict(lambda: {
-            "consultations": 0, 
-            "revenue": 0, 
-            "last_visit": None, 
-            "first_visit": None,
-            "loyalty_score": 0,
-            "avg_interval": 0,
-            "total_visits": 0,
-            "visits_per_year": 0
-        })
-        
-        for apt in appointments:
-            patient_id = apt.get("patient_id")
-            if patient_id and apt.get("status") == "terminé":
-                # Count all types of visits
-                visit_revenue = 65 if apt.get("type_rdv") == "visite" else 45  # Control visits have some value
-                
-                patient_revenue[patient_id]["consultations"] += 1
-                patient_revenue[patient_id]["total_visits"] += 1
-                
-                if apt.get("paye", True):  # Only count revenue if paid
-                    patient_revenue[patient_id]["revenue"] += visit_revenue
-                
-                # Track visit dates
-                apt_date = apt["date"]
-                if not patient_revenue[patient_id]["last_visit"] or apt_date > patient_revenue[patient_id]["last_visit"]:
-                    patient_revenue[patient_id]["last_visit"] = apt_date
-                if not patient_revenue[patient_id]["first_visit"] or apt_date < patient_revenue[patient_id]["first_visit"]:
-                    patient_revenue[patient_id]["first_visit"] = apt_date
-
-        # Calculate advanced metrics for each patient
-        for patient_id, stats in patient_revenue.items():
-            if stats["first_visit"] and stats["last_visit"] and stats["consultations"] > 1:
-                # Calculate visit frequency
-                first_date = datetime.strptime(stats["first_visit"], "%Y-%m-%d")
-                last_date = datetime.strptime(stats["last_visit"], "%Y-%m-%d")
-                total_days = (last_date - first_date).days
-                
-                if total_days > 0:
-                    stats["avg_interval"] = total_days / max(stats["consultations"] - 1, 1)
-                    stats["visits_per_year"] = (stats["consultations"] / max(total_days / 365, 0.1))
+        # 2. Top 10 Patients Rentables - figures of the months of the period (materialized monthly stats)
+        ranked, _ = await rank_patients_in_period(start_date, end_date, "revenue", 10)
+        patients = await get_patient_summaries([stats["patient_id"] for stats in ranked])
+
+        top_patients = []
+        for stats in ranked:
+            patient = patients.get(stats["patient_id"])
+            if not patient:
+                continue
+            last_date = datetime.strptime(stats["last_visit"], "%Y-%m-%d")
+            span_days = (last_date - datetime.strptime(stats["first_visit"], "%Y-%m-%d")).days
+            if stats["consultations"] > 1:
+                if span_days > 0:
+                    avg_interval = span_days / (stats["consultations"] - 1)
+                    visits_per_year = stats["consultations"] / max(span_days / 365, 0.1)
                 else:
-                    stats["avg_interval"] = 30
-                    stats["visits_per_year"] = stats["consultations"]
+                    avg_interval = 30
+                    visits_per_year = stats["consultations"]
                 
                 # Loyalty score calculation (0-100)
                 # Based on frequency, revenue, and recency
@@ -5349,34 +6324,23 @@ async def calculate_advanced_statistics(start_date: str, end_date: str):
                 days_since_last = (datetime.now() - last_date).days
                 recency_score = max(0, 20 - (days_since_last / 15))
                 
-                stats["loyalty_score"] = frequency_score + revenue_score + recency_score
+                loyalty_score = frequency_score + revenue_score + recency_score
             else:
-                stats["avg_interval"] = 180  # Default for single visit
-                stats["visits_per_year"] = stats["consultations"]
-                stats["loyalty_score"] = min(20, stats["revenue"] / 10)  # Basic score for new patients
-
-        # Get patient names and create enhanced top 10 list
-        top_patients = []
-        for patient_id, stats in patient_revenue.items():
-            patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
-            if patient:
-                top_patients.append({
-                    "nom": f"{patient.get('prenom', '')} {patient.get('nom', '')}".strip(),
-                    "consultations": stats["consultations"],
-                    "revenue": stats["revenue"],
-                    "last_visit": stats["last_visit"],
-                    "loyalty_score": round(stats["loyalty_score"], 1),
-                    "avg_interval_days": round(stats["avg_interval"], 0),
-                    "visits_per_year": round(stats["visits_per_year"], 1),
-                    "status": "VIP" if stats["revenue"] > 400 else ("Fidèle" if stats["consultations"] > 3 else "Régulier")
-                })
-
-        # Sort by revenue and get top 10
-        top_patients = sorted(top_patients, key=lambda x: x["revenue"], reverse=True)[:10]
-
-        # Add ranking
-        for i, patient in enumerate(top_patients):
-            patient["ranking"] = i + 1
+                avg_interval = 180  # Default for single visit
+                visits_per_year = stats["consultations"]
+                loyalty_score = min(20, stats["revenue"] / 10)  # Basic score for new patients
+            
+            top_patients.append({
+                "nom": f"{patient.get('prenom', '')} {patient.get('nom', '')}".strip(),
+                "consultations": stats["consultations"],
+                "revenue": stats["revenue"],
+                "last_visit": stats["last_visit"],
+                "loyalty_score": round(loyalty_score, 1),
+                "avg_interval_days": round(avg_interval, 0),
+                "visits_per_year": round(visits_per_year, 1),
+                "status": "VIP" if stats["revenue"] > 400 else ("Fidèle" if stats["consultations"] > 3 else "Régulier"),
+                "ranking": len(top_patients) + 1
+            })
         
         # 3. Durées moyennes
         waiting_times = []
@@ -5445,7 +6409,7 @@ async def calculate_advanced_statistics(start_date: str, end_date: str):
         six_months_ago = (datetime.now() - timedelta(days=180)).strftime("%Y-%m-%d")
         recent_patients = set()
         
-        for apt in appointments_collection.find({"date": {"$gte": six_months_ago}}):
+        async for apt in appointments_collection.find({"date": {"$gte": six_months_ago}}):
             recent_patients.add(apt.get("patient_id"))
         
         total_patients = len(all_patients)
@@ -5466,7 +6430,7 @@ async def calculate_advanced_statistics(start_date: str, end_date: str):
             period_patients.add(patient_id)
             
             # Check if this is patient's first appointment ever
-            first_apt = appointments_collection.find_one(
+            first_apt = await appointments_collection.find_one(
                 {"patient_id": patient_id}, 
                 sort=[("date", 1)]
             )
@@ -5544,9 +6508,9 @@ async def calculate_monthly_evolution(start_date: str, end_date: str):
             month_end_str = month_end.strftime("%Y-%m-%d")
             
             # Get appointments for this month
-            monthly_appointments = list(appointments_collection.find({
+            monthly_appointments = await appointments_collection.find({
                 "date": {"$gte": month_start, "$lte": month_end_str}
-            }))
+            }).to_list(length=None)
             
             visites = len([apt for apt in monthly_appointments if apt.get("type_rdv") == "visite"])
             controles = len([apt for apt in monthly_appointments if apt.get("type_rdv") == "controle"])
@@ -5579,16 +6543,16 @@ async def calculate_year_comparison(current_year: int):
         # Current year data
         current_start = f"{current_year}-01-01"
         current_end = f"{current_year}-12-31"
-        current_appointments = list(appointments_collection.find({
+        current_appointments = await appointments_collection.find({
             "date": {"$gte": current_start, "$lte": current_end}
-        }))
+        }).to_list(length=None)
         
         # Previous year data
         previous_start = f"{previous_year}-01-01"
         previous_end = f"{previous_year}-12-31"
-        previous_appointments = list(appointments_collection.find({
+        previous_appointments = await appointments_collection.find({
             "date": {"$gte": previous_start, "$lte": previous_end}
-        }))
+        }).to_list(length=None)
         
         # Calculate metrics
         current_consultations = len(current_appointments)
@@ -5635,9 +6599,9 @@ async def calculate_seasonality_patterns():
         two_years_ago = (datetime.now() - timedelta(days=730)).strftime("%Y-%m-%d")
         today = datetime.now().strftime("%Y-%m-%d")
         
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": two_years_ago, "$lte": today}
-        }))
+        }).to_list(length=None)
         
         # Group by month across years
         monthly_stats = defaultdict(list)
@@ -6313,14 +7277,14 @@ async def get_advanced_reports(
             raise HTTPException(status_code=400, detail="Invalid period_type. Use: monthly, semester, annual, custom")
         
         # Get appointments for the period (needed for Gemini enrichment)
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
         # Get consultations for the period (needed for Gemini AI predictions)
-        consultations = list(consultations_collection.find({
+        consultations = await consultations_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
         # Calculate advanced statistics
         advanced_stats = await calculate_advanced_statistics(start_date, end_date)
@@ -6441,16 +7405,16 @@ async def get_demographics_report(
     """Get detailed demographics breakdown"""
     try:
         # Get patients who had appointments in the period
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
         active_patient_ids = set(apt.get("patient_id") for apt in appointments if apt.get("patient_id"))
         
         # Get patient details
-        active_patients = list(patients_collection.find({
+        active_patients = await patients_collection.find({
             "id": {"$in": list(active_patient_ids)}
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         # Detailed age analysis
         age_breakdown = {
@@ -6515,86 +7479,54 @@ async def get_top_patients_report(
 ):
     """Get detailed top patients analysis"""
     try:
-        # Calculate start date
-        start_date = (datetime.now() - timedelta(days=period_months * 30)).strftime("%Y-%m-%d")
-        end_date = datetime.now().strftime("%Y-%m-%d")
-        
-        # Get appointments in period
-        appointments = list(appointments_collection.find({
-            "date": {"$gte": start_date, "$lte": end_date}
-        }))
-        
-        # Analyze patients
-        patient_stats = defaultdict(lambda: {
-            "consultations": 0,
-            "visites": 0,
-            "controles": 0,
-            "revenue": 0,
-            "first_visit": None,
-            "last_visit": None,
-            "visits_per_month": 0
-        })
+        # Whole calendar months: the current one and the period_months - 1 before it
+        now = datetime.now()
+        start_year, start_month = divmod(now.year * 12 + now.month - 1 - max(period_months - 1, 0), 12)
+        start_date = f"{start_year}-{start_month + 1:02d}-01"
+        end_date = now.strftime("%Y-%m-%d")
+        
+        # Patients consulted during the period, figures summed over its months
+        sort_field = {"consultations": "consultations", "frequency": "visits_per_month"}.get(metric, "revenue")
+        ranked, totals = await rank_patients_in_period(start_date, end_date, sort_field, limit)
+        
+        patients = {
+            patient["id"]: patient
+            async for patient in patients_collection.find(
+                {"id": {"$in": [stats["patient_id"] for stats in ranked]}},
+                {"_id": 0, "id": 1, "nom": 1, "prenom": 1, "age": 1, "numero_whatsapp": 1, "adresse": 1}
+            )
+        }
         
-        for apt in appointments:
-            patient_id = apt.get("patient_id")
-            if not patient_id:
-                continue
-                
-            stats = patient_stats[patient_id]
-            stats["consultations"] += 1
-            
-            if apt.get("type_rdv") == "visite":
-                stats["visites"] += 1
-                if apt.get("paye", True):
-                    stats["revenue"] += 65
-            else:
-                stats["controles"] += 1
-            
-            apt_date = apt["date"]
-            if not stats["first_visit"] or apt_date < stats["first_visit"]:
-                stats["first_visit"] = apt_date
-            if not stats["last_visit"] or apt_date > stats["last_visit"]:
-                stats["last_visit"] = apt_date
-        
-        # Calculate visits per month
-        for patient_id, stats in patient_stats.items():
-            if stats["first_visit"] and stats["last_visit"]:
-                first_dt = datetime.strptime(stats["first_visit"], "%Y-%m-%d")
-                last_dt = datetime.strptime(stats["last_visit"], "%Y-%m-%d")
-                months_diff = max(1, (last_dt - first_dt).days / 30)
-                stats["visits_per_month"] = round(stats["consultations"] / months_diff, 2)
-        
-        # Get patient details and create results
         results = []
-        for patient_id, stats in patient_stats.items():
-            patient = patients_collection.find_one({"id": patient_id}, {"_id": 0})
+        for stats in ranked:
+            patient = patients.get(stats["patient_id"])
             if patient:
                 results.append({
-                    "patient_id": patient_id,
+                    "patient_id": stats["patient_id"],
                     "name": f"{patient.get('prenom', '')} {patient.get('nom', '')}".strip(),
                     "age": patient.get("age"),
                     "phone": patient.get("numero_whatsapp"),
                     "address": patient.get("adresse"),
-                    "statistics": stats
+                    "statistics": {
+                        "consultations": stats["consultations"],
+                        "visites": stats["visites"],
+                        "controles": stats["controles"],
+                        "revenue": stats["revenue"],
+                        "first_visit": stats["first_visit"],
+                        "last_visit": stats["last_visit"],
+                        "visits_per_month": stats["visits_per_month"]
+                    }
                 })
         
-        # Sort by selected metric
-        if metric == "revenue":
-            results = sorted(results, key=lambda x: x["statistics"]["revenue"], reverse=True)
-        elif metric == "consultations":
-            results = sorted(results, key=lambda x: x["statistics"]["consultations"], reverse=True)
-        elif metric == "frequency":
-            results = sorted(results, key=lambda x: x["statistics"]["visits_per_month"], reverse=True)
-        
         return {
             "period": f"{start_date} - {end_date}",
             "metric": metric,
-            "total_patients_analyzed": len(results),
-            "top_patients": results[:limit],
+            "total_patients_analyzed": totals["patients"],
+            "top_patients": results,
             "summary": {
-                "total_revenue": sum(r["statistics"]["revenue"] for r in results),
-                "total_consultations": sum(r["statistics"]["consultations"] for r in results),
-                "average_revenue_per_patient": round(sum(r["statistics"]["revenue"] for r in results) / max(len(results), 1), 2)
+                "total_revenue": totals["revenue"],
+                "total_consultations": totals["consultations"],
+                "average_revenue_per_patient": round(totals["revenue"] / max(totals["patients"], 1), 2)
             },
             "generated_at": datetime.now().isoformat()
         }
@@ -6668,6 +7600,17 @@ class GeminiAIService:
             system_message="You are an AI assistant specialized in medical practice management. Provide intelligent recommendations for patient scheduling, treatment optimization, and workflow improvements."
         ).with_model("gemini", "gemini-2.0-flash")
     
+    async def send(self, user_message, method: str):
+        """Send a message to Gemini, recording latency and errors for /metrics"""
+        started = time.perf_counter()
+        try:
+            return await self.chat.send_message(user_message)
+        except Exception:
+            gemini_errors_total.inc(method)
+            raise
+        finally:
+            gemini_request_duration.observe(time.perf_counter() - started, method)
+    
     async def get_medical_recommendation(self, context: str, data: Dict[str, Any]) -> str:
         """Get AI-powered medical recommendations"""
         try:
@@ -6686,7 +7629,7 @@ class GeminiAIService:
             """
             
             user_message = UserMessage(text=prompt)
-            response = await self.chat.send_message(user_message)
+            response = await self.send(user_message, "get_medical_recommendation")
             return response
         except Exception as e:
             return f"Erreur lors de la génération de recommandations: {str(e)}"
@@ -6764,7 +7707,7 @@ class GeminiAIService:
             """
             
             user_message = UserMessage(text=context_prompt)
-            response = await self.chat.send_message(user_message)
+            response = await self.send(user_message, "enrich_advanced_report")
             
             # Parse la réponse JSON
             try:
@@ -6823,7 +7766,7 @@ class GeminiAIService:
             """
             
             user_message = UserMessage(text=prompt)
-            response = await self.chat.send_message(user_message)
+            response = await self.send(user_message, "enhance_patient_insights")
             return response
         except Exception as e:
             return f"Erreur lors de l'analyse comportementale: {str(e)}"
@@ -6832,7 +7775,7 @@ class GeminiAIService:
         """Generic method to get AI response from Gemini"""
         try:
             user_message = UserMessage(text=prompt)
-            response = await self.chat.send_message(user_message)
+            response = await self.send(user_message, "get_response")
             return response
         except Exception as e:
             print(f"Error getting Gemini response: {e}")
@@ -6857,7 +7800,7 @@ class GeminiAIService:
             """
             
             user_message = UserMessage(text=prompt)
-            response = await self.chat.send_message(user_message)
+            response = await self.send(user_message, "generate_proactive_recommendations")
             
             # Parse the JSON response
             try:
@@ -6894,7 +7837,7 @@ class TemporalDataCollector:
     def __init__(self):
         self.collection = temporal_patterns
     
-    def record_consultation_timing(self, consultation_data):
+    async def record_consultation_timing(self, consultation_data):
         """Enregistre les données temporelles d'une consultation"""
         temporal_record = {
             'consultation_id': consultation_data.get('id'),
@@ -6923,7 +7866,7 @@ class TemporalDataCollector:
             },
             'recorded_at': datetime.now()
         }
-        self.collection.insert_one(temporal_record)
+        await self.collection.insert_one(temporal_record)
         return temporal_record
     
     def calculate_delay(self, consultation_data):
@@ -6936,7 +7879,7 @@ class TemporalDataCollector:
         except:
             return 0
     
-    def get_temporal_patterns(self, lookback_days=30):
+    async def get_temporal_patterns(self, lookback_days=30):
         """Analyse les patterns temporels des derniers jours"""
         cutoff_date = datetime.now() - timedelta(days=lookback_days)
         
@@ -6956,7 +7899,7 @@ class TemporalDataCollector:
             {"$sort": {"_id.day_of_week": 1, "_id.hour": 1}}
         ]
         
-        return list(self.collection.aggregate(pipeline))
+        return await self.collection.aggregate(pipeline).to_list(length=None)
     
     def calculate_moment_efficiency(self, consultation_data):
         """Calcule l'efficacité du médecin à ce moment"""
@@ -6986,7 +7929,7 @@ class DoctorPerformanceCollector:
     def __init__(self):
         self.collection = doctor_performance_patterns
     
-    def record_performance_snapshot(self, doctor_id, consultation_data):
+    async def record_performance_snapshot(self, doctor_id, consultation_data):
         """Enregistre un snapshot de performance"""
         performance_record = {
             'doctor_id': doctor_id,
@@ -7000,10 +7943,10 @@ class DoctorPerformanceCollector:
                 'multitasking_score': consultation_data.get('multitasking_score', 5)
             },
             'context_factors': {
-                'consultations_done_today': self.get_consultations_count_today(doctor_id),
-                'time_since_last_break': self.get_time_since_break(doctor_id),
-                'queue_pressure': self.get_current_queue_pressure(),
-                'complexity_recent_cases': self.get_recent_complexity_avg(doctor_id),
+                'consultations_done_today': await self.get_consultations_count_today(doctor_id),
+                'time_since_last_break': await self.get_time_since_break(doctor_id),
+                'queue_pressure': await self.get_current_queue_pressure(),
+                'complexity_recent_cases': await self.get_recent_complexity_avg(doctor_id),
                 'interruptions_recent': consultation_data.get('interruptions_recentes', 0)
             },
             'predictions_accuracy': {
@@ -7011,15 +7954,15 @@ class DoctorPerformanceCollector:
                 'complexity_prediction_error': self.calculate_prediction_error(consultation_data, 'complexity')
             }
         }
-        self.collection.insert_one(performance_record)
+        await self.collection.insert_one(performance_record)
         return performance_record
     
-    def get_doctor_current_state(self, doctor_id):
+    async def get_doctor_current_state(self, doctor_id):
         """Obtient l'état actuel du médecin basé sur les données récentes"""
-        recent_records = list(self.collection.find({
+        recent_records = await self.collection.find({
             'doctor_id': doctor_id,
             'timestamp': {'$gte': datetime.now() - timedelta(hours=4)}
-        }).sort('timestamp', -1).limit(10))
+        }).sort('timestamp', -1).limit(10).to_list(length=None)
         
         if not recent_records:
             return self.get_default_doctor_state()
@@ -7091,18 +8034,18 @@ class DoctorPerformanceCollector:
         
         return min(10, stress_score)
     
-    def get_consultations_count_today(self, doctor_id):
+    async def get_consultations_count_today(self, doctor_id):
         """Nombre de consultations faites aujourd'hui"""
         today = datetime.now().strftime("%Y-%m-%d")
-        return consultations_collection.count_documents({
+        return await consultations_collection.count_documents({
             "date": today,
             "doctor_id": doctor_id
         })
     
-    def get_time_since_break(self, doctor_id):
+    async def get_time_since_break(self, doctor_id):
         """Temps depuis la dernière pause (en minutes)"""
         # Logique simplifiée - à améliorer avec tracking réel des pauses
-        last_consultation = consultations_collection.find_one({
+        last_consultation = await consultations_collection.find_one({
             "doctor_id": doctor_id,
             "date": datetime.now().strftime("%Y-%m-%d")
         }, sort=[("heure_fin_reelle", -1)])
@@ -7112,21 +8055,21 @@ class DoctorPerformanceCollector:
             return min(180, datetime.now().hour * 30)  # Max 3h
         return 0
     
-    def get_current_queue_pressure(self):
+    async def get_current_queue_pressure(self):
         """Pression actuelle de la queue (0-10)"""
         today = datetime.now().strftime("%Y-%m-%d")
-        waiting_count = appointments_collection.count_documents({
+        waiting_count = await appointments_collection.count_documents({
             "date": today,
             "statut": "attente"
         })
         return min(10, waiting_count)
     
-    def get_recent_complexity_avg(self, doctor_id):
+    async def get_recent_complexity_avg(self, doctor_id):
         """Complexité moyenne des cas récents"""
-        recent_consultations = list(consultations_collection.find({
+        recent_consultations = await consultations_collection.find({
             "doctor_id": doctor_id,
             "date": datetime.now().strftime("%Y-%m-%d")
-        }).limit(5))
+        }).limit(5).to_list(length=None)
         
         if recent_consultations:
             total_complexity = sum(c.get('complexite_reelle', 1) for c in recent_consultations)
@@ -7211,11 +8154,11 @@ class PredictiveEngine:
         self.temporal_collector = TemporalDataCollector()
         self.performance_collector = DoctorPerformanceCollector()
     
-    def predict_consultation_duration(self, patient_id, consultation_type, doctor_state, temporal_context):
+    async def predict_consultation_duration(self, patient_id, consultation_type, doctor_state, temporal_context):
         """Prédiction avancée de durée de consultation"""
         
         # Récupérer les patterns historiques
-        historical_data = self.get_historical_patterns(patient_id, consultation_type, temporal_context)
+        historical_data = await self.get_historical_patterns(patient_id, consultation_type, temporal_context)
         
         # Facteurs de base
         base_duration = historical_data.get('avg_duration', 15)
@@ -7256,7 +8199,7 @@ class PredictiveEngine:
             'explanation': self.generate_prediction_explanation(adjustments)
         }
     
-    def predict_wait_time(self, patient_position, current_queue, doctor_state, temporal_context):
+    async def predict_wait_time(self, patient_position, current_queue, doctor_state, temporal_context):
         """Prédiction avancée de temps d'attente"""
         
         if patient_position <= 0:
@@ -7269,7 +8212,7 @@ class PredictiveEngine:
         
         for i, patient_ahead in enumerate(patients_ahead):
             # Prédiction pour chaque patient devant
-            patient_prediction = self.predict_consultation_duration(
+            patient_prediction = await self.predict_consultation_duration(
                 patient_ahead['patient_id'],
                 patient_ahead['consultation_type'],
                 doctor_state,
@@ -7304,27 +8247,27 @@ class PredictiveEngine:
             'confidence_level': round(max(0.1, min(0.95, final_confidence)), 2),
             'patients_ahead': len(patients_ahead),
             'individual_predictions': [p['predicted_minutes'] for p in [
-                self.predict_consultation_duration(pa['patient_id'], pa['consultation_type'], doctor_state, temporal_context) 
+                await self.predict_consultation_duration(pa['patient_id'], pa['consultation_type'], doctor_state, temporal_context) 
                 for pa in patients_ahead
             ]],
             'contextual_factors': contextual_adjustments,
             'explanation': self.generate_wait_time_explanation(patients_ahead, contextual_adjustments)
         }
     
-    def get_historical_patterns(self, patient_id, consultation_type, temporal_context):
+    async def get_historical_patterns(self, patient_id, consultation_type, temporal_context):
         """Récupère les patterns historiques pour un patient"""
         # Rechercher les consultations similaires
-        similar_consultations = list(temporal_patterns.find({
+        similar_consultations = await temporal_patterns.find({
             "patient_id": patient_id,
             "consultation_type": consultation_type,
             "temporal_context.hour_of_day": {"$gte": temporal_context['hour'] - 2, "$lte": temporal_context['hour'] + 2}
-        }))
+        }).to_list(length=None)
         
         if not similar_consultations:
             # Fallback sur le type de consultation général
-            similar_consultations = list(temporal_patterns.find({
+            similar_consultations = await temporal_patterns.find({
                 "consultation_type": consultation_type
-            }).limit(20))
+            }).limit(20).to_list(length=None)
         
         if similar_consultations:
             avg_duration = sum(c.get('actual_duration', 15) for c in similar_consultations) / len(similar_consultations)
@@ -7693,7 +8636,7 @@ class PatientBehaviorCollector:
     def __init__(self):
         self.collection = patient_behavior_patterns
     
-    def record_patient_behavior(self, patient_id, consultation_data):
+    async def record_patient_behavior(self, patient_id, consultation_data):
         """Enregistre le comportement d'un patient lors d'une consultation"""
         behavior_record = {
             'patient_id': patient_id,
@@ -7724,17 +8667,17 @@ class PatientBehaviorCollector:
                 'reschedule_frequency': consultation_data.get('freq_reprogrammation', 0.1)
             }
         }
-        self.collection.insert_one(behavior_record)
+        await self.collection.insert_one(behavior_record)
         return behavior_record
     
-    def get_patient_behavioral_profile(self, patient_id, lookback_days=90):
+    async def get_patient_behavioral_profile(self, patient_id, lookback_days=90):
         """Analyse le profil comportemental d'un patient"""
         cutoff_date = datetime.now() - timedelta(days=lookback_days)
         
-        patient_records = list(self.collection.find({
+        patient_records = await self.collection.find({
             'patient_id': patient_id,
             'timestamp': {'$gte': cutoff_date}
-        }).sort('timestamp', -1))
+        }).sort('timestamp', -1).to_list(length=None)
         
         if not patient_records:
             return self.get_default_behavioral_profile()
@@ -7915,7 +8858,7 @@ class ExternalFactorsCollector:
     def __init__(self):
         self.collection = external_factors_patterns
     
-    def record_daily_external_factors(self, date_str, external_data=None):
+    async def record_daily_external_factors(self, date_str, external_data=None):
         """Enregistre les facteurs externes pour une journée"""
         if external_data is None:
             external_data = self.gather_external_data()
@@ -7959,25 +8902,25 @@ class ExternalFactorsCollector:
         }
         
         # Upsert (insert or update)
-        self.collection.replace_one(
+        await self.collection.replace_one(
             {'date': date_str}, 
             external_record, 
             upsert=True
         )
         return external_record
     
-    def get_external_factors_for_date(self, date_str):
+    async def get_external_factors_for_date(self, date_str):
         """Récupère les facteurs externes pour une date"""
-        record = self.collection.find_one({'date': date_str}, {"_id": 0})
+        record = await self.collection.find_one({'date': date_str}, {"_id": 0})
         if record:
             return record
         else:
             # Créer des données par défaut
-            return self.record_daily_external_factors(date_str)
+            return await self.record_daily_external_factors(date_str)
     
-    def calculate_total_external_impact(self, date_str):
+    async def calculate_total_external_impact(self, date_str):
         """Calcule l'impact total des facteurs externes (-1 à +1)"""
-        factors = self.get_external_factors_for_date(date_str)
+        factors = await self.get_external_factors_for_date(date_str)
         
         weather_impact = factors['weather_data']['impact_score']
         traffic_impact = factors['traffic_data']['impact_score']
@@ -8199,22 +9142,22 @@ class DataEnrichmentEngine:
         self.predictor = PredictiveEngine()
         self.suggestions_engine = ProactiveSuggestionsEngine()
     
-    def enrich_consultation_data(self, consultation_data, patient_id, doctor_id="default_doctor"):
+    async def enrich_consultation_data(self, consultation_data, patient_id, doctor_id="default_doctor"):
         """Enrichit toutes les données d'une consultation"""
         enriched_data = consultation_data.copy()
         
         # Enrichissement temporel
-        temporal_data = self.temporal_collector.record_consultation_timing(consultation_data)
+        temporal_data = await self.temporal_collector.record_consultation_timing(consultation_data)
         
         # Enrichissement performance médecin
-        doctor_performance = self.doctor_performance_collector.record_performance_snapshot(doctor_id, consultation_data)
+        doctor_performance = await self.doctor_performance_collector.record_performance_snapshot(doctor_id, consultation_data)
         
         # Enrichissement comportement patient
-        patient_behavior = self.patient_behavior_collector.record_patient_behavior(patient_id, consultation_data)
+        patient_behavior = await self.patient_behavior_collector.record_patient_behavior(patient_id, consultation_data)
         
         # Enrichissement facteurs externes
         date_str = consultation_data.get('date', datetime.now().strftime('%Y-%m-%d'))
-        external_factors = self.external_factors_collector.get_external_factors_for_date(date_str)
+        external_factors = await self.external_factors_collector.get_external_factors_for_date(date_str)
         
         # Ajout des données enrichies
         enriched_data.update({
@@ -8237,7 +9180,7 @@ class DataEnrichmentEngine:
                 'external_impact': {
                     'weather_impact': external_factors['weather_data']['impact_score'],
                     'traffic_impact': external_factors['traffic_data']['impact_score'],
-                    'total_external_score': self.external_factors_collector.calculate_total_external_impact(date_str)
+                    'total_external_score': await self.external_factors_collector.calculate_total_external_impact(date_str)
                 },
                 'enrichment_timestamp': datetime.now().isoformat()
             }
@@ -8245,17 +9188,17 @@ class DataEnrichmentEngine:
         
         return enriched_data
     
-    def get_comprehensive_predictions(self, patient_id, consultation_type, date_str, doctor_id="default_doctor"):
+    async def get_comprehensive_predictions(self, patient_id, consultation_type, date_str, doctor_id="default_doctor"):
         """Génère des prédictions complètes avec tous les facteurs"""
         
         # État du médecin
-        doctor_state = self.doctor_performance_collector.get_doctor_current_state(doctor_id)
+        doctor_state = await self.doctor_performance_collector.get_doctor_current_state(doctor_id)
         
         # Profil comportemental patient
-        patient_profile = self.patient_behavior_collector.get_patient_behavioral_profile(patient_id)
+        patient_profile = await self.patient_behavior_collector.get_patient_behavioral_profile(patient_id)
         
         # Facteurs externes
-        external_impact = self.external_factors_collector.calculate_total_external_impact(date_str)
+        external_impact = await self.external_factors_collector.calculate_total_external_impact(date_str)
         
         # Contexte temporal
         temporal_context = {
@@ -8266,7 +9209,7 @@ class DataEnrichmentEngine:
         }
         
         # Prédictions durée et attente
-        duration_prediction = self.predictor.predict_consultation_duration(
+        duration_prediction = await self.predictor.predict_consultation_duration(
             patient_id, consultation_type, doctor_state, temporal_context
         )
         
@@ -8316,11 +9259,11 @@ async def record_consultation_data(consultation_data: dict):
         performance_collector = DoctorPerformanceCollector()
         
         # Enregistrer les patterns temporels
-        temporal_record = temporal_collector.record_consultation_timing(consultation_data)
+        temporal_record = await temporal_collector.record_consultation_timing(consultation_data)
         
         # Enregistrer la performance du médecin
         doctor_id = consultation_data.get('doctor_id', 'default_doctor')
-        performance_record = performance_collector.record_performance_snapshot(doctor_id, consultation_data)
+        performance_record = await performance_collector.record_performance_snapshot(doctor_id, consultation_data)
         
         return {
             "message": "Consultation data recorded for AI learning",
@@ -8343,7 +9286,7 @@ async def predict_consultation_duration_api(
         performance_collector = DoctorPerformanceCollector()
         
         # Obtenir l'état actuel du médecin
-        doctor_state = performance_collector.get_doctor_current_state(doctor_id)
+        doctor_state = await performance_collector.get_doctor_current_state(doctor_id)
         
         # Contexte temporal actuel
         temporal_context = {
@@ -8354,7 +9297,7 @@ async def predict_consultation_duration_api(
         }
         
         # Prédiction
-        prediction = predictor.predict_consultation_duration(
+        prediction = await predictor.predict_consultation_duration(
             patient_id, consultation_type, doctor_state, temporal_context
         )
         
@@ -8381,15 +9324,16 @@ async def predict_wait_time_api(
         performance_collector = DoctorPerformanceCollector()
         
         # Obtenir la queue actuelle
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": date,
             "statut": {"$in": ["attente", "programme"]}
-        }))
+        }).to_list(length=None)
         
         # Construire la queue avec données enrichies
         current_queue = []
+        patients_by_id = await get_patient_summaries(apt.get("patient_id") for apt in appointments)
         for apt in appointments:
-            patient = patients_collection.find_one({"id": apt.get("patient_id")})
+            patient = patients_by_id.get(apt.get("patient_id"))
             if patient:
                 current_queue.append({
                     'patient_id': apt.get('patient_id'),
@@ -8402,7 +9346,7 @@ async def predict_wait_time_api(
         current_queue.sort(key=lambda x: x['scheduled_time'])
         
         # État médecin
-        doctor_state = performance_collector.get_doctor_current_state("default_doctor")
+        doctor_state = await performance_collector.get_doctor_current_state("default_doctor")
         
         # Contexte temporal
         temporal_context = {
@@ -8412,7 +9356,7 @@ async def predict_wait_time_api(
         }
         
         # Prédiction
-        prediction = predictor.predict_wait_time(
+        prediction = await predictor.predict_wait_time(
             patient_position, current_queue, doctor_state, temporal_context
         )
         
@@ -8436,14 +9380,14 @@ async def get_proactive_suggestions():
         performance_collector = DoctorPerformanceCollector()
         
         # Contexte actuel
-        doctor_state = performance_collector.get_doctor_current_state("default_doctor")
+        doctor_state = await performance_collector.get_doctor_current_state("default_doctor")
         
         # État de la queue
         today = datetime.now().strftime("%Y-%m-%d")
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": today, 
             "statut": {"$in": ["attente", "programme"]}
-        }))
+        }).to_list(length=None)
         
         queue_state = {
             'length': len(appointments),
@@ -8482,7 +9426,7 @@ async def get_doctor_current_state_api(doctor_id: str = Query(default="default_d
     """Obtient l'état actuel du médecin"""
     try:
         performance_collector = DoctorPerformanceCollector()
-        doctor_state = performance_collector.get_doctor_current_state(doctor_id)
+        doctor_state = await performance_collector.get_doctor_current_state(doctor_id)
         
         return {
             "doctor_id": doctor_id,
@@ -8498,7 +9442,7 @@ async def get_temporal_patterns_api(lookback_days: int = Query(default=30)):
     """Analyse des patterns temporels"""
     try:
         temporal_collector = TemporalDataCollector()
-        patterns = temporal_collector.get_temporal_patterns(lookback_days)
+        patterns = await temporal_collector.get_temporal_patterns(lookback_days)
         
         return {
             "patterns": patterns,
@@ -8518,22 +9462,22 @@ async def initialize_ai_learning():
         collections_created = []
         
         # Vérifier et créer les index nécessaires
-        if ai_learning_data.count_documents({}) == 0:
-            ai_learning_data.create_index([("timestamp", -1)])
+        if await ai_learning_data.count_documents({}) == 0:
+            await ai_learning_data.create_index([("timestamp", -1)])
             collections_created.append("ai_learning_data")
         
-        if temporal_patterns.count_documents({}) == 0:
-            temporal_patterns.create_index([("recorded_at", -1)])
-            temporal_patterns.create_index([("patient_id", 1)])
-            temporal_patterns.create_index([("temporal_context.hour_of_day", 1)])
+        if await temporal_patterns.count_documents({}) == 0:
+            await temporal_patterns.create_index([("recorded_at", -1)])
+            await temporal_patterns.create_index([("patient_id", 1)])
+            await temporal_patterns.create_index([("temporal_context.hour_of_day", 1)])
             collections_created.append("temporal_patterns")
         
-        if doctor_performance_patterns.count_documents({}) == 0:
-            doctor_performance_patterns.create_index([("doctor_id", 1), ("timestamp", -1)])
+        if await doctor_performance_patterns.count_documents({}) == 0:
+            await doctor_performance_patterns.create_index([("doctor_id", 1), ("timestamp", -1)])
             collections_created.append("doctor_performance_patterns")
         
-        if prediction_accuracy.count_documents({}) == 0:
-            prediction_accuracy.create_index([("prediction_type", 1), ("date", -1)])
+        if await prediction_accuracy.count_documents({}) == 0:
+            await prediction_accuracy.create_index([("prediction_type", 1), ("date", -1)])
             collections_created.append("prediction_accuracy")
         
         return {
@@ -8559,7 +9503,7 @@ async def enrich_consultation_data_api(consultation_data: dict):
         if not patient_id:
             raise HTTPException(status_code=400, detail="patient_id is required")
         
-        enriched_data = enrichment_engine.enrich_consultation_data(
+        enriched_data = await enrichment_engine.enrich_consultation_data(
             consultation_data, patient_id, doctor_id
         )
         
@@ -8583,7 +9527,7 @@ async def get_comprehensive_predictions_api(
     try:
         enrichment_engine = DataEnrichmentEngine()
         
-        predictions = enrichment_engine.get_comprehensive_predictions(
+        predictions = await enrichment_engine.get_comprehensive_predictions(
             patient_id, consultation_type, date, doctor_id
         )
         
@@ -8607,7 +9551,7 @@ async def get_patient_behavioral_profile_api(
     try:
         behavior_collector = PatientBehaviorCollector()
         
-        profile = behavior_collector.get_patient_behavioral_profile(patient_id, lookback_days)
+        profile = await behavior_collector.get_patient_behavioral_profile(patient_id, lookback_days)
         
         return {
             "patient_id": patient_id,
@@ -8625,8 +9569,8 @@ async def get_external_factors_api(date: str = Query(...)):
     try:
         external_collector = ExternalFactorsCollector()
         
-        factors = external_collector.get_external_factors_for_date(date)
-        total_impact = external_collector.calculate_total_external_impact(date)
+        factors = await external_collector.get_external_factors_for_date(date)
+        total_impact = await external_collector.calculate_total_external_impact(date)
         
         return {
             "date": date,
@@ -8648,7 +9592,7 @@ async def record_patient_behavior_api(
     try:
         behavior_collector = PatientBehaviorCollector()
         
-        behavior_record = behavior_collector.record_patient_behavior(patient_id, consultation_data)
+        behavior_record = await behavior_collector.record_patient_behavior(patient_id, consultation_data)
         
         return {
             "message": "Patient behavior recorded successfully",
@@ -8669,7 +9613,7 @@ async def update_external_factors_api(
     try:
         external_collector = ExternalFactorsCollector()
         
-        updated_record = external_collector.record_daily_external_factors(date, external_data)
+        updated_record = await external_collector.record_daily_external_factors(date, external_data)
         
         return {
             "message": "External factors updated successfully",
@@ -8697,11 +9641,11 @@ async def get_dashboard_insights_api(
         suggestions_engine = ProactiveSuggestionsEngine()
         
         # État du médecin
-        doctor_state = performance_collector.get_doctor_current_state(doctor_id)
+        doctor_state = await performance_collector.get_doctor_current_state(doctor_id)
         
         # Facteurs externes
-        external_impact = external_collector.calculate_total_external_impact(date)
-        external_factors = external_collector.get_external_factors_for_date(date)
+        external_impact = await external_collector.calculate_total_external_impact(date)
+        external_factors = await external_collector.get_external_factors_for_date(date)
         
         # Contexte pour suggestions
         current_context = {
@@ -8782,10 +9726,10 @@ class WhatsAppSendRequest(BaseModel):
     custom_message: Optional[str] = None
     auto_send: bool = False
 
-def create_default_whatsapp_templates():
+async def create_default_whatsapp_templates():
     """Create default WhatsApp templates if they don't exist"""
     try:
-        if whatsapp_templates_collection.count_documents({}) == 0:
+        if await whatsapp_templates_collection.count_documents({}) == 0:
             default_templates = [
                 {
                     "id": "template_confirmation",
@@ -8855,7 +9799,8 @@ def create_default_whatsapp_templates():
                 }
             ]
             
-            whatsapp_templates_collection.insert_many(default_templates)
+            await whatsapp_templates_collection.insert_many(default_templates)
+            await bump_data_version("whatsapp_templates")
             print("Default WhatsApp templates created successfully")
             
     except Exception as e:
@@ -8917,34 +9862,34 @@ def generate_whatsapp_link(phone_number, message):
     
     return whatsapp_link
 
-def calculate_ai_context(patient_id, appointment_data=None):
+async def calculate_ai_context(patient_id, appointment_data=None):
     """Calculate AI context for smarter templates"""
     context = {}
     
     try:
         # Get patient history
-        patient = patients_collection.find_one({"id": patient_id})
+        patient = await patients_collection.find_one({"id": patient_id})
         if not patient:
             return context
         
         # Calculate punctuality score
-        appointments = list(appointments_collection.find({"patient_id": patient_id}))
+        appointments = await appointments_collection.find({"patient_id": patient_id}).to_list(length=None)
         if appointments:
             on_time_count = sum(1 for apt in appointments if apt.get("statut") not in ["absent", "retard"])
             punctuality_score = (on_time_count / len(appointments)) * 100
             context["punctuality_score"] = round(punctuality_score, 1)
         
         # Calculate average consultation duration
-        consultations = list(consultations_collection.find({"patient_id": patient_id}))
+        consultations = await consultations_collection.find({"patient_id": patient_id}).to_list(length=None)
         if consultations:
             avg_duration = sum(int(c.get("duree", 15)) for c in consultations) / len(consultations)
             context["avg_consultation_duration"] = round(avg_duration, 1)
         
         # Doctor efficiency today
         today = datetime.now().strftime("%Y-%m-%d")
-        today_consultations = list(consultations_collection.find({
+        today_consultations = await consultations_collection.find({
             "date": today
-        }))
+        }).to_list(length=None)
         
         if today_consultations:
             avg_today = sum(int(c.get("duree", 15)) for c in today_consultations) / len(today_consultations)
@@ -8952,10 +9897,10 @@ def calculate_ai_context(patient_id, appointment_data=None):
         
         # Current queue position and wait time
         if appointment_data:
-            today_appointments = list(appointments_collection.find({
+            today_appointments = await appointments_collection.find({
                 "date": appointment_data.get("date", today),
                 "statut": {"$in": ["attente", "programme"]}
-            }))
+            }).to_list(length=None)
             
             # Sort by appointment time
             today_appointments.sort(key=lambda x: x.get("heure", "00:00"))
@@ -8977,14 +9922,102 @@ def calculate_ai_context(patient_id, appointment_data=None):
         print(f"Error calculating AI context: {e}")
         return context
 
+async def get_patients_history_stats(patient_ids) -> Dict[str, dict]:
+    """Punctuality score and average consultation duration of several patients in two aggregations
+
+    Same figures as calculate_ai_context, keyed by patient id.
+    """
+    ids = list({pid for pid in patient_ids if pid})
+    if not ids:
+        return {}
+    
+    punctuality_rows, duration_rows = await asyncio.gather(
+        appointments_collection.aggregate([
+            {"$match": {"patient_id": {"$in": ids}}},
+            {"$group": {
+                "_id": "$patient_id",
+                "total": {"$sum": 1},
+                "on_time": {"$sum": {"$cond": [{"$in": ["$statut", ["absent", "retard"]]}, 0, 1]}}
+            }}
+        ]).to_list(length=None),
+        consultations_collection.aggregate([
+            {"$match": {"patient_id": {"$in": ids}}},
+            {"$group": {
+                "_id": "$patient_id",
+                "avg_duration": {"$avg": {"$convert": {
+                    "input": "$duree", "to": "int", "onError": 15, "onNull": 15
+                }}}
+            }}
+        ]).to_list(length=None)
+    )
+    
+    stats = {pid: {} for pid in ids}
+    for row in punctuality_rows:
+        stats[row["_id"]]["punctuality_score"] = round(row["on_time"] / row["total"] * 100, 1)
+    for row in duration_rows:
+        stats[row["_id"]]["avg_consultation_duration"] = round(row["avg_duration"], 1)
+    return stats
+
+async def build_whatsapp_queue(date: str) -> dict:
+    """WhatsApp queue of a day: appointments, patients and history stats loaded once"""
+    appointments = await appointments_collection.find({"date": date}, {"_id": 0}).to_list(length=None)
+    patient_ids = [a.get("patient_id") for a in appointments]
+    patients_by_id, stats_by_id = await asyncio.gather(
+        get_patient_summaries(patient_ids),
+        get_patients_history_stats(patient_ids)
+    )
+    
+    # Waiting line of the day sorted by appointment time, first position of each patient
+    waiting = sorted(
+        (a for a in appointments if a.get("statut") in ["attente", "programme"]),
+        key=lambda x: x.get("heure", "00:00")
+    )
+    positions = {}
+    for i, apt in enumerate(waiting):
+        positions.setdefault(apt.get("patient_id"), i)
+    
+    queue = []
+    for appointment in appointments:
+        patient_id = appointment.get("patient_id")
+        patient = patients_by_id.get(patient_id)
+        
+        if patient and patient.get("numero_whatsapp"):
+            stats = stats_by_id.get(patient_id, {})
+            position = positions.get(patient_id)
+            
+            queue.append({
+                "appointment_id": appointment.get("id"),
+                "patient_id": patient_id,
+                "patient_name": f"{patient.get('prenom', '')} {patient.get('nom', '')}",
+                "appointment_time": appointment.get("heure", ""),
+                "type_rdv": appointment.get("type_rdv", ""),
+                "status": appointment.get("statut", "programme"),
+                "numero_whatsapp": patient.get("numero_whatsapp", ""),
+                "queue_position": position + 1 if position is not None else 0,
+                "estimated_wait_time": max(5, position * 20) if position is not None else 0,  # 20min per patient average
+                "punctuality_score": stats.get("punctuality_score", 85),
+                "avg_consultation_duration": stats.get("avg_consultation_duration", 15),
+                "has_whatsapp": True
+            })
+    
+    # Sort by appointment time
+    queue.sort(key=lambda x: x["appointment_time"])
+    
+    return {
+        "queue": queue,
+        "total_patients": len(queue),
+        "patients_with_whatsapp": len(queue),
+        "date": date
+    }
+
 # WhatsApp Hub API Endpoints
 
 @app.post("/api/whatsapp-hub/initialize")
 async def initialize_whatsapp_hub():
     """Initialize WhatsApp Hub with default templates"""
     try:
-        create_default_whatsapp_templates()
-        templates_count = whatsapp_templates_collection.count_documents({})
+        await create_default_whatsapp_templates()
+        templates_count = await whatsapp_templates_collection.count_documents({})
         
         return {
             "message": "WhatsApp Hub initialized successfully",
@@ -8995,10 +10028,14 @@ async def initialize_whatsapp_hub():
         raise HTTPException(status_code=500, detail=f"Error initializing WhatsApp Hub: {str(e)}")
 
 @app.get("/api/whatsapp-hub/templates")
-async def get_whatsapp_templates():
+async def get_whatsapp_templates(request: Request, response: Response):
     """Get all WhatsApp templates"""
+    not_modified = conditional_response(request, response, await get_data_versions("whatsapp_templates"))
+    if not_modified:
+        return not_modified
+    
     try:
-        templates = list(whatsapp_templates_collection.find({}, {"_id": 0}))
+        templates = await whatsapp_templates_collection.find({}, {"_id": 0}).to_list(length=None)
         
         # Group by category
         categorized = defaultdict(list)
@@ -9022,7 +10059,8 @@ async def create_whatsapp_template(template: WhatsAppTemplate):
         template_dict["created_at"] = datetime.now()
         template_dict["updated_at"] = datetime.now()
         
-        result = whatsapp_templates_collection.insert_one(template_dict)
+        result = await whatsapp_templates_collection.insert_one(template_dict)
+        await bump_data_version("whatsapp_templates")
         
         # Remove MongoDB ObjectId and return clean template
         template_dict.pop("_id", None)
@@ -9041,15 +10079,16 @@ async def update_whatsapp_template(template_id: str, template_update: dict):
     try:
         template_update["updated_at"] = datetime.now()
         
-        result = whatsapp_templates_collection.update_one(
+        result = await whatsapp_templates_collection.update_one(
             {"id": template_id},
             {"$set": template_update}
         )
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Template not found")
+        await bump_data_version("whatsapp_templates")
         
-        updated_template = whatsapp_templates_collection.find_one({"id": template_id}, {"_id": 0})
+        updated_template = await whatsapp_templates_collection.find_one({"id": template_id}, {"_id": 0})
         
         # Convert datetime objects to strings for JSON serialization
         if updated_template:
@@ -9072,10 +10111,11 @@ async def update_whatsapp_template(template_id: str, template_update: dict):
 async def delete_whatsapp_template(template_id: str):
     """Delete WhatsApp template"""
     try:
-        result = whatsapp_templates_collection.delete_one({"id": template_id})
+        result = await whatsapp_templates_collection.delete_one({"id": template_id})
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Template not found")
+        await bump_data_version("whatsapp_templates")
         
         return {"message": "Template deleted successfully"}
         
@@ -9089,7 +10129,7 @@ async def prepare_whatsapp_message(request: WhatsAppSendRequest):
     """Prepare WhatsApp message with template and context"""
     try:
         # Get patient data
-        patient = patients_collection.find_one({"id": request.patient_id})
+        patient = await patients_collection.find_one({"id": request.patient_id})
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
         
@@ -9102,20 +10142,20 @@ async def prepare_whatsapp_message(request: WhatsAppSendRequest):
         
         if request.template_id:
             # Get template
-            template = whatsapp_templates_collection.find_one({"id": request.template_id})
+            template = await whatsapp_templates_collection.find_one({"id": request.template_id})
             if not template:
                 raise HTTPException(status_code=404, detail="Template not found")
             
             # Get appointment data if exists
             appointment_data = None
             today = datetime.now().strftime("%Y-%m-%d")
-            appointment = appointments_collection.find_one({
+            appointment = await appointments_collection.find_one({
                 "patient_id": request.patient_id,
                 "date": {"$gte": today}
             })
             
             # Generate AI context
-            ai_context = calculate_ai_context(request.patient_id, appointment)
+            ai_context = await calculate_ai_context(request.patient_id, appointment)
             
             # Generate variables
             variables = generate_whatsapp_variables(patient, appointment, ai_context)
@@ -9134,7 +10174,7 @@ async def prepare_whatsapp_message(request: WhatsAppSendRequest):
         
         # Prepare response with AI suggestions
         ai_suggestions = []
-        ai_context = calculate_ai_context(request.patient_id)
+        ai_context = await calculate_ai_context(request.patient_id)
         
         if ai_context.get("punctuality_score", 100) < 70:
             ai_suggestions.append("💡 Patient souvent en retard - Considérer mentionner importance ponctualité")
@@ -9177,7 +10217,7 @@ async def send_auto_confirmation(appointment_data: dict):
         appointment_id = appointment_data.get("appointment_id")
         
         # Get confirmation template
-        template = whatsapp_templates_collection.find_one({
+        template = await whatsapp_templates_collection.find_one({
             "category": "confirmation",
             "auto_send": True
         })
@@ -9195,7 +10235,7 @@ async def send_auto_confirmation(appointment_data: dict):
         prepared_message = await prepare_whatsapp_message(request)
         
         # Log the auto-confirmation (don't actually send, just prepare)
-        whatsapp_history_collection.insert_one({
+        await whatsapp_history_collection.insert_one({
             "id": str(uuid.uuid4()),
             "patient_id": patient_id,
             "patient_name": f"{prepared_message['patient']['prenom']} {prepared_message['patient']['nom']}",
@@ -9222,44 +10262,7 @@ async def send_auto_confirmation(appointment_data: dict):
 async def get_whatsapp_queue(date: str = Query(...)):
     """Get patients queue for WhatsApp messaging"""
     try:
-        # Get appointments for the date
-        appointments = list(appointments_collection.find({"date": date}))
-        queue = []
-        
-        for appointment in appointments:
-            patient_id = appointment.get("patient_id")
-            patient = patients_collection.find_one({"id": patient_id})
-            
-            if patient and patient.get("numero_whatsapp"):
-                # Calculate AI context
-                ai_context = calculate_ai_context(patient_id, appointment)
-                
-                queue_item = {
-                    "appointment_id": appointment.get("id"),
-                    "patient_id": patient_id,
-                    "patient_name": f"{patient.get('prenom', '')} {patient.get('nom', '')}",
-                    "appointment_time": appointment.get("heure", ""),
-                    "type_rdv": appointment.get("type_rdv", ""),
-                    "status": appointment.get("statut", "programme"),
-                    "numero_whatsapp": patient.get("numero_whatsapp", ""),
-                    "queue_position": ai_context.get("position", 0),
-                    "estimated_wait_time": ai_context.get("temps_attente", 0),
-                    "punctuality_score": ai_context.get("punctuality_score", 85),
-                    "avg_consultation_duration": ai_context.get("avg_consultation_duration", 15),
-                    "has_whatsapp": bool(patient.get("numero_whatsapp"))
-                }
-                
-                queue.append(queue_item)
-        
-        # Sort by appointment time
-        queue.sort(key=lambda x: x["appointment_time"])
-        
-        return {
-            "queue": queue,
-            "total_patients": len(queue),
-            "patients_with_whatsapp": len([p for p in queue if p["has_whatsapp"]]),
-            "date": date
-        }
+        return await build_whatsapp_queue(date)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching queue: {str(e)}")
@@ -9269,7 +10272,6 @@ async def get_whatsapp_queue(date: str = Query(...)):
 # ==================== AI ROOM API ====================
 
 import random
-from collections import defaultdict
 
 # AI Room collections
 ai_room_data_collection = db.ai_room_data
@@ -9277,29 +10279,30 @@ ai_queue_collection = db.ai_queue
 ai_predictions_collection = db.ai_predictions
 ai_doctor_analytics_collection = db.ai_doctor_analytics
 
+# AI Room updates describing a current state: only the latest pending one is sent
+AI_STATE_UPDATES = {"metrics_update"}
+
 # AI Room WebSocket connection manager
-class AIRoomConnectionManager:
+class AIRoomConnectionManager(BroadcastHub):
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        super().__init__("ai-room", WS_SEND_QUEUE_SIZE, WS_SEND_TIMEOUT_SECONDS)
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.register(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.unregister(websocket)
 
     async def broadcast_ai_update(self, data: dict):
-        data_json = json.dumps(data, default=str)
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(data_json)
-            except:
-                if connection in self.active_connections:
-                    self.active_connections.remove(connection)
+        coalesce_key = data.get("type") if data.get("type") in AI_STATE_UPDATES else None
+        await event_bus.publish("ai_room", {"text": json.dumps(data, default=str), "coalesce_key": coalesce_key})
+
+    async def deliver_event(self, event: dict):
+        self.fan_out(event["text"], coalesce_key=event.get("coalesce_key"))
 
 ai_manager = AIRoomConnectionManager()
+event_bus.subscribe("ai_room", ai_manager.deliver_event)
 
 # AI Room Models
 class AIPatientClassification(BaseModel):
@@ -9337,9 +10340,9 @@ class AIRoomSettings(BaseModel):
     emergency_mode: bool = False
 
 # AI Room Utility Functions
-def calculate_punctuality_score(patient_id: str) -> float:
+async def calculate_punctuality_score(patient_id: str) -> float:
     """Calculate patient punctuality based on historical data"""
-    appointments = list(appointments_collection.find({"patient_id": patient_id}))
+    appointments = await appointments_collection.find({"patient_id": patient_id}).to_list(length=None)
     if not appointments:
         return 85.0  # Default score for new patients
     
@@ -9354,9 +10357,9 @@ def calculate_punctuality_score(patient_id: str) -> float:
     base_score = (on_time_count / total_appointments) * 100
     return min(100, max(0, base_score + random.uniform(-5, 5)))
 
-def calculate_complexity_score(patient_id: str) -> float:
+async def calculate_complexity_score(patient_id: str) -> float:
     """Calculate consultation complexity based on historical data"""
-    consultations = list(consultations_collection.find({"patient_id": patient_id}))
+    consultations = await consultations_collection.find({"patient_id": patient_id}).to_list(length=None)
     if not consultations:
         return 5.0  # Default complexity for new patients
     
@@ -9380,9 +10383,9 @@ def calculate_complexity_score(patient_id: str) -> float:
     
     return max(1, min(10, complexity + random.uniform(-0.5, 0.5)))
 
-def predict_consultation_duration(patient_id: str, consultation_type: str) -> int:
+async def predict_consultation_duration(patient_id: str, consultation_type: str) -> int:
     """Predict consultation duration using ML"""
-    consultations = list(consultations_collection.find({"patient_id": patient_id}))
+    consultations = await consultations_collection.find({"patient_id": patient_id}).to_list(length=None)
     
     if not consultations:
         # Default durations based on type
@@ -9427,16 +10430,16 @@ def calculate_optimal_arrival_time(appointment_time: str, predicted_wait: int) -
     except:
         return appointment_time
 
-def generate_ai_recommendations() -> List[Dict]:
+async def generate_ai_recommendations() -> List[Dict]:
     """Generate AI-powered recommendations"""
     recommendations = []
     
     # Check for queue optimization opportunities
     today = datetime.now().strftime("%Y-%m-%d")
-    appointments = list(appointments_collection.find({
+    appointments = await appointments_collection.find({
         "date": today,
         "statut": {"$in": ["programme", "attente"]}
-    }))
+    }).to_list(length=None)
     
     if len(appointments) > 3:
         recommendations.append({
@@ -9483,14 +10486,14 @@ async def initialize_ai_room():
     """Initialize AI Room with data collection and models"""
     try:
         # Clear existing AI data for fresh start
-        ai_room_data_collection.delete_many({})
-        ai_queue_collection.delete_many({})
-        ai_predictions_collection.delete_many({})
-        ai_doctor_analytics_collection.delete_many({})
+        await ai_room_data_collection.delete_many({})
+        await ai_queue_collection.delete_many({})
+        await ai_predictions_collection.delete_many({})
+        await ai_doctor_analytics_collection.delete_many({})
         
         # Initialize with current appointments
         today = datetime.now().strftime("%Y-%m-%d")
-        appointments = list(appointments_collection.find({"date": today}))
+        appointments = await appointments_collection.find({"date": today}).to_list(length=None)
         
         # Create AI classifications for each patient
         for appointment in appointments:
@@ -9499,14 +10502,14 @@ async def initialize_ai_room():
                 classification = {
                     "patient_id": patient_id,
                     "appointment_id": appointment.get("id"),
-                    "punctuality_score": calculate_punctuality_score(patient_id),
-                    "complexity_score": calculate_complexity_score(patient_id),
+                    "punctuality_score": await calculate_punctuality_score(patient_id),
+                    "complexity_score": await calculate_complexity_score(patient_id),
                     "no_show_probability": random.uniform(0.05, 0.25),
                     "communication_responsiveness": random.uniform(70, 95),
                     "priority_score": random.choice(["normal", "normal", "normal", "high", "urgent"]),
                     "created_at": datetime.now()
                 }
-                ai_room_data_collection.insert_one(classification)
+                await ai_room_data_collection.insert_one(classification)
         
         # Initialize doctor analytics
         doctor_analytics = {
@@ -9531,7 +10534,7 @@ async def initialize_ai_room():
             },
             "created_at": datetime.now()
         }
-        ai_doctor_analytics_collection.insert_one(doctor_analytics)
+        await ai_doctor_analytics_collection.insert_one(doctor_analytics)
         
         return {"message": "AI Room initialized successfully", "appointments_processed": len(appointments)}
         
@@ -9543,19 +10546,20 @@ async def get_ai_queue(date: str = Query(...)):
     """Get AI-optimized patient queue for a specific date"""
     try:
         # Get appointments for the date
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         ai_queue = []
+        patients_by_id = await get_patient_summaries(a.get("patient_id") for a in appointments)
         
         for appointment in appointments:
             patient_id = appointment.get("patient_id")
-            patient = patients_collection.find_one({"id": patient_id})
+            patient = patients_by_id.get(patient_id)
             
             if patient:
                 # Get AI classification
-                ai_data = ai_room_data_collection.find_one({"patient_id": patient_id})
+                ai_data = await ai_room_data_collection.find_one({"patient_id": patient_id})
                 
                 # Predict consultation duration
-                predicted_duration = predict_consultation_duration(
+                predicted_duration = await predict_consultation_duration(
                     patient_id, 
                     appointment.get("type_rdv", "visite")
                 )
@@ -9632,15 +10636,15 @@ async def get_ai_predictions(date: str = Query(...)):
         }
         
         # Patient classifications
-        patient_classifications = list(ai_room_data_collection.find({}, {"_id": 0}))
+        patient_classifications = await ai_room_data_collection.find({}, {"_id": 0}).to_list(length=None)
         
         # Queue optimization suggestions
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         optimizations = []
         
         for i, appointment in enumerate(appointments[:5]):  # Limit to first 5 for performance
             patient_id = appointment.get("patient_id")
-            ai_data = ai_room_data_collection.find_one({"patient_id": patient_id})
+            ai_data = await ai_room_data_collection.find_one({"patient_id": patient_id})
             
             if ai_data and ai_data.get("complexity_score", 5) > 7:
                 optimizations.append({
@@ -9674,7 +10678,7 @@ async def get_doctor_analytics():
     """Get doctor performance analytics"""
     try:
         today = datetime.now().strftime("%Y-%m-%d")
-        analytics = ai_doctor_analytics_collection.find_one({"date": today}, {"_id": 0})
+        analytics = await ai_doctor_analytics_collection.find_one({"date": today}, {"_id": 0})
         
         if not analytics:
             # Create default analytics if none exist
@@ -9704,7 +10708,7 @@ async def get_ai_metrics(date: str = Query(...)):
     """Get real-time AI Room metrics"""
     try:
         # Calculate real-time metrics
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         
         # Queue metrics
         waiting_patients = [a for a in appointments if a.get("statut") == "attente"]
@@ -9737,7 +10741,7 @@ async def optimize_queue(optimization_data: dict):
         settings = optimization_data.get("settings", {})
         
         # Get current appointments
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         
         optimizations_made = 0
         time_saved = 0
@@ -9745,7 +10749,7 @@ async def optimize_queue(optimization_data: dict):
         # Simulate AI optimization process
         for appointment in appointments:
             patient_id = appointment.get("patient_id")
-            ai_data = ai_room_data_collection.find_one({"patient_id": patient_id})
+            ai_data = await ai_room_data_collection.find_one({"patient_id": patient_id})
             
             if ai_data:
                 # Check if optimization is beneficial
@@ -9769,7 +10773,7 @@ async def optimize_queue(optimization_data: dict):
             "message": "Queue optimization completed",
             "optimizations_made": optimizations_made,
             "estimated_time_saved": f"{time_saved} minutes",
-            "recommendations": generate_ai_recommendations()
+            "recommendations": await generate_ai_recommendations()
         }
         
     except Exception as e:
@@ -9783,7 +10787,7 @@ async def send_whatsapp_notification(notification_data: dict):
         message = notification_data.get("message")
         
         # Get patient data
-        patient = patients_collection.find_one({"id": patient_id})
+        patient = await get_patient_summary(patient_id)
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
         
@@ -9791,7 +10795,7 @@ async def send_whatsapp_notification(notification_data: dict):
         # For now, we simulate the notification
         
         # Log the notification
-        ai_room_data_collection.update_one(
+        await ai_room_data_collection.update_one(
             {"patient_id": patient_id},
             {"$push": {"whatsapp_notifications": {
                 "message": message,
@@ -9822,11 +10826,11 @@ async def send_whatsapp_notification(notification_data: dict):
 async def get_ai_recommendations():
     """Get AI-powered recommendations for workflow optimization"""
     try:
-        recommendations = generate_ai_recommendations()
+        recommendations = await generate_ai_recommendations()
         
         # Add more specific recommendations based on current data
         today = datetime.now().strftime("%Y-%m-%d")
-        appointments = list(appointments_collection.find({"date": today}))
+        appointments = await appointments_collection.find({"date": today}).to_list(length=None)
         
         # Check for scheduling conflicts
         time_slots = {}
@@ -9872,7 +10876,7 @@ async def ai_room_websocket_endpoint(websocket: WebSocket):
             
             # Send real-time metrics update
             today = datetime.now().strftime("%Y-%m-%d")
-            appointments = list(appointments_collection.find({"date": today}))
+            appointments = await appointments_collection.find({"date": today}).to_list(length=None)
             waiting_count = len([a for a in appointments if a.get("statut") == "attente"])
             
             await ai_manager.broadcast_ai_update({
@@ -9888,78 +10892,35 @@ async def ai_room_websocket_endpoint(websocket: WebSocket):
         print(f"AI Room WebSocket error: {e}")
         ai_manager.disconnect(websocket)
 
-# ==================== ADMIN EXPORT API ====================
+@app.get("/api/admin/websockets")
+async def get_websocket_stats():
+    """Connections, queued/coalesced messages and evictions of the WebSocket hubs"""
+    return {
+        "ws": manager.stats(),
+        "ai_room": ai_manager.stats(),
+        "event_bus": event_bus.stats(),
+        "send_queue_size": WS_SEND_QUEUE_SIZE,
+        "send_timeout_seconds": WS_SEND_TIMEOUT_SECONDS
+    }
 
-@app.get("/api/admin/export/{data_type}")
-async def export_admin_data(data_type: str):
-    """Export data for administration (patients, consultations, payments)"""
-    try:
-        if data_type == "patients":
-            # Get all patients with only the valid fields (excluding removed fields)
-            patients = list(patients_collection.find({}, {"_id": 0}))
-            
-            # Clean the data to remove any remaining references to old fields
-            for patient in patients:
-                # Remove old fields if they exist
-                patient.pop('assurance', None)
-                patient.pop('numero_assurance', None)
-                patient.pop('nom_parent', None)
-                patient.pop('telephone_parent', None)
-                
-                # Ensure all valid fields are present with defaults
-                patient.setdefault('id', '')
-                patient.setdefault('nom', '')
-                patient.setdefault('prenom', '')
-                patient.setdefault('date_naissance', '')
-                patient.setdefault('age', '')
-                patient.setdefault('sexe', '')
-                patient.setdefault('telephone', '')
-                patient.setdefault('adresse', '')
-                patient.setdefault('numero_whatsapp', '')
-                patient.setdefault('pere', {"nom": "", "telephone": "", "fonction": ""})
-                patient.setdefault('mere', {"nom": "", "telephone": "", "fonction": ""})
-                patient.setdefault('notes', '')
-                patient.setdefault('antecedents', '')
-                patient.setdefault('allergies', '')
-                patient.setdefault('date_premiere_consultation', '')
-                patient.setdefault('date_derniere_consultation', '')
-                patient.setdefault('created_at', '')
-            
-            return {
-                "data": patients,
-                "count": len(patients),
-                "collection": "patients",
-                "fields": [
-                    "id", "nom", "prenom", "date_naissance", "age", "sexe", 
-                    "telephone", "adresse", "numero_whatsapp", "pere", "mere",
-                    "notes", "antecedents", "allergies", "date_premiere_consultation", 
-                    "date_derniere_consultation", "created_at"
-                ]
-            }
-            
-        elif data_type == "consultations":
-            consultations = list(consultations_collection.find({}, {"_id": 0}))
-            return {
-                "data": consultations,
-                "count": len(consultations),
-                "collection": "consultations"
-            }
-            
-        elif data_type == "payments":
-            payments = list(payments_collection.find({}, {"_id": 0}))
-            return {
-                "data": payments,
-                "count": len(payments),
-                "collection": "payments"
-            }
-            
-        else:
-            raise HTTPException(status_code=400, detail="Invalid data type")
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error exporting {data_type}: {str(e)}")
+@app.get("/api/admin/patient-cache")
+async def get_patient_cache_stats():
+    """Size, hit ratio, evictions and invalidations of this worker's patient summary cache"""
+    return patient_cache.stats()
 
-# ==================== END ADMIN EXPORT API ====================
+@app.get("/api/admin/diagnostics")
+async def get_diagnostics():
+    """Event loop lag and the recent stalls with the route, call and stack that blocked the loop"""
+    return {
+        "event_loop": loop_watchdog.stats(),
+        "recent_stalls": list(reversed(loop_watchdog.events)),
+        "password_hashing": password_hash_stats(),
+        "report_jobs": report_job_runner.stats(),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "background_tasks": [
+            {"name": task.get_name(), "done": task.done()} for task in background_tasks
+        ]
+    }
 
 # ==================== END AI ROOM API ====================
 
@@ -9998,14 +10959,14 @@ class AutomationEngine:
         self.settings = AutomationSettings()
         self.optimization_history = []
     
-    def analyze_schedule_optimization(self, date: str) -> List[ScheduleOptimization]:
+    async def analyze_schedule_optimization(self, date: str) -> List[ScheduleOptimization]:
         """Analyze current schedule and suggest optimizations"""
         optimizations = []
         
         # Get appointments for the date
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": date
-        }, {"_id": 0}))
+        }, {"_id": 0}).to_list(length=None)
         
         if not appointments:
             return optimizations
@@ -10038,7 +10999,7 @@ class AutomationEngine:
             # Analyze wait time optimization
             if i > 0:
                 prev_appointment = appointments[i-1]
-                prev_duration = self._predict_consultation_duration(prev_appointment["patient_id"])
+                prev_duration = await self._predict_consultation_duration(prev_appointment["patient_id"])
                 current_appointment_time = self._time_to_minutes(current_time)
                 prev_appointment_time = self._time_to_minutes(prev_appointment.get("heure", "09:00"))
                 
@@ -10058,13 +11019,13 @@ class AutomationEngine:
         
         return optimizations
     
-    def generate_proactive_recommendations(self) -> List[WorkflowOptimization]:
+    async def generate_proactive_recommendations(self) -> List[WorkflowOptimization]:
         """Generate proactive workflow optimization recommendations"""
         recommendations = []
         today = datetime.now().strftime("%Y-%m-%d")
         
         # Get current appointments
-        appointments = list(appointments_collection.find({"date": today}))
+        appointments = await appointments_collection.find({"date": today}).to_list(length=None)
         waiting_appointments = [a for a in appointments if a.get("statut") == "attente"]
         
         # Recommendation 1: Queue optimization
@@ -10115,9 +11076,9 @@ class AutomationEngine:
         
         return recommendations
     
-    def auto_reschedule_suggestions(self, appointment_id: str) -> Dict[str, Any]:
+    async def auto_reschedule_suggestions(self, appointment_id: str) -> Dict[str, Any]:
         """Generate automatic rescheduling suggestions for an appointment"""
-        appointment = appointments_collection.find_one({"id": appointment_id}, {"_id": 0})
+        appointment = await appointments_collection.find_one({"id": appointment_id}, {"_id": 0})
         if not appointment:
             return {"suggestions": [], "reason": "Appointment not found"}
         
@@ -10126,13 +11087,13 @@ class AutomationEngine:
         
         # Get patient behavioral data
         patient_id = appointment["patient_id"]
-        punctuality_score = calculate_punctuality_score(patient_id)
+        punctuality_score = await calculate_punctuality_score(patient_id)
         
         suggestions = []
         
         # If patient has low punctuality, suggest later time slots
         if punctuality_score < 70:
-            later_times = self._find_available_slots_after(current_date, current_time)
+            later_times = await self._find_available_slots_after(current_date, current_time)
             for time_slot in later_times[:2]:
                 suggestions.append({
                     "suggested_date": current_date,
@@ -10144,7 +11105,7 @@ class AutomationEngine:
         
         # If patient has high punctuality, suggest earlier slots for efficiency
         if punctuality_score > 90:
-            earlier_times = self._find_available_slots_before(current_date, current_time)
+            earlier_times = await self._find_available_slots_before(current_date, current_time)
             for time_slot in earlier_times[:2]:
                 suggestions.append({
                     "suggested_date": current_date,
@@ -10177,9 +11138,9 @@ class AutomationEngine:
         
         return available_slots[:5]  # Return first 5 available slots
     
-    def _find_available_slots_after(self, date: str, after_time: str) -> List[str]:
+    async def _find_available_slots_after(self, date: str, after_time: str) -> List[str]:
         """Find available slots after a specific time"""
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         occupied_times = set(a.get("heure", "09:00") for a in appointments)
         
         after_minutes = self._time_to_minutes(after_time)
@@ -10194,9 +11155,9 @@ class AutomationEngine:
         
         return available_slots[:3]
     
-    def _find_available_slots_before(self, date: str, before_time: str) -> List[str]:
+    async def _find_available_slots_before(self, date: str, before_time: str) -> List[str]:
         """Find available slots before a specific time"""
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         occupied_times = set(a.get("heure", "09:00") for a in appointments)
         
         before_minutes = self._time_to_minutes(before_time)
@@ -10211,9 +11172,9 @@ class AutomationEngine:
         
         return available_slots[-3:] if available_slots else []  # Return last 3 (closest to target time)
     
-    def _predict_consultation_duration(self, patient_id: str) -> int:
+    async def _predict_consultation_duration(self, patient_id: str) -> int:
         """Predict consultation duration for a patient"""
-        consultations = list(consultations_collection.find({"patient_id": patient_id}))
+        consultations = await consultations_collection.find({"patient_id": patient_id}).to_list(length=None)
         if not consultations:
             return 20  # Default 20 minutes
         
@@ -10237,11 +11198,24 @@ class AutomationEngine:
 # Initialize automation engine
 automation_engine = AutomationEngine()
 
+async def apply_shared_settings(event: dict):
+    """Settings changed by any worker"""
+    if event.get("name") == "automation":
+        automation_engine.settings = AutomationSettings(**event["values"])
+
+event_bus.subscribe("settings", apply_shared_settings)
+
+async def load_shared_settings():
+    """Settings saved by a previous run or another worker"""
+    stored = await app_settings_collection.find_one({"id": "automation"}, {"_id": 0, "id": 0})
+    if stored:
+        automation_engine.settings = AutomationSettings(**stored)
+
 @app.get("/api/automation/schedule-optimization")
 async def get_schedule_optimization(date: str = Query(..., description="Date in YYYY-MM-DD format")):
     """Get schedule optimization suggestions for a specific date"""
     try:
-        optimizations = automation_engine.analyze_schedule_optimization(date)
+        optimizations = await automation_engine.analyze_schedule_optimization(date)
         
         total_time_saved = sum(opt.potential_time_saved for opt in optimizations)
         high_confidence_count = len([opt for opt in optimizations if opt.confidence_score > 0.8])
@@ -10272,7 +11246,7 @@ async def get_ai_enhanced_recommendations():
         
         # Get current schedule and doctor analytics
         today = datetime.now().strftime('%Y-%m-%d')
-        appointments = list(appointments_collection.find({"date": today}))
+        appointments = await appointments_collection.find({"date": today}).to_list(length=None)
         
         # Get doctor analytics data
         doctor_analytics = {
@@ -10284,7 +11258,7 @@ async def get_ai_enhanced_recommendations():
         # Get patient behavioral data
         patients_data = []
         for apt in appointments[:5]:  # Sample first 5
-            patient = patients_collection.find_one({"id": apt.get("patient_id")})
+            patient = await get_patient_summary(apt.get("patient_id"))
             if patient:
                 patients_data.append({
                     "nom": patient.get("nom", ""),
@@ -10321,12 +11295,12 @@ async def get_ai_patient_insights(patient_id: str):
             return {"error": "Service IA non disponible"}
         
         # Get patient data
-        patient = patients_collection.find_one({"id": patient_id})
+        patient = await patients_collection.find_one({"id": patient_id})
         if not patient:
             raise HTTPException(status_code=404, detail="Patient non trouvé")
         
         # Get behavioral data
-        appointments = list(appointments_collection.find({"patient_id": patient_id}, {"_id": 0}))
+        appointments = await appointments_collection.find({"patient_id": patient_id}, {"_id": 0}).to_list(length=None)
         
         # Clean appointments data for JSON serialization
         clean_appointments = []
@@ -10379,7 +11353,7 @@ async def ai_schedule_optimization(request_data: dict):
         date = request_data.get("date", datetime.now().strftime('%Y-%m-%d'))
         
         # Get schedule data
-        appointments = list(appointments_collection.find({"date": date}))
+        appointments = await appointments_collection.find({"date": date}).to_list(length=None)
         
         context = f"Optimisation du planning médical pour le {date}"
         data = {
@@ -10411,7 +11385,7 @@ async def ai_schedule_optimization(request_data: dict):
 async def get_proactive_recommendations():
     """Get proactive workflow optimization recommendations"""
     try:
-        recommendations = automation_engine.generate_proactive_recommendations()
+        recommendations = await automation_engine.generate_proactive_recommendations()
         
         # Calculate summary statistics
         high_impact_count = len([r for r in recommendations if r.impact == "high"])
@@ -10437,7 +11411,7 @@ async def get_proactive_recommendations():
 async def get_reschedule_suggestions(appointment_id: str):
     """Get automatic rescheduling suggestions for a specific appointment"""
     try:
-        suggestions = automation_engine.auto_reschedule_suggestions(appointment_id)
+        suggestions = await automation_engine.auto_reschedule_suggestions(appointment_id)
         
         return {
             "appointment_id": appointment_id,
@@ -10453,7 +11427,7 @@ async def apply_schedule_optimization(optimization: ScheduleOptimization):
     """Apply a schedule optimization"""
     try:
         # Update the appointment with the new time
-        result = appointments_collection.update_one(
+        result = await appointments_collection.update_one(
             {"id": optimization.appointment_id},
             {
                 "$set": {
@@ -10468,6 +11442,12 @@ async def apply_schedule_optimization(optimization: ScheduleOptimization):
         if result.modified_count == 0:
             raise HTTPException(status_code=404, detail="Appointment not found or no changes made")
         
+        await record_appointment_change("updated", optimization.appointment_id, {
+            "heure": optimization.suggested_time,
+            "optimization_applied": True,
+            "optimization_type": optimization.optimization_type
+        })
+        
         # Log the optimization
         automation_engine.optimization_history.append({
             "appointment_id": optimization.appointment_id,
@@ -10499,6 +11479,12 @@ async def update_automation_settings(settings: AutomationSettings):
     try:
         automation_engine.settings = settings
         
+        # Persist and share with the other workers
+        await app_settings_collection.replace_one(
+            {"id": "automation"}, {"id": "automation", **settings.dict()}, upsert=True
+        )
+        await event_bus.publish("settings", {"name": "automation", "values": settings.dict()})
+        
         return {
             "success": True,
             "message": "Automation settings updated successfully",
@@ -10515,8 +11501,8 @@ async def get_automation_status():
         today = datetime.now().strftime("%Y-%m-%d")
         
         # Get current schedule optimizations
-        optimizations = automation_engine.analyze_schedule_optimization(today)
-        recommendations = automation_engine.generate_proactive_recommendations()
+        optimizations = await automation_engine.analyze_schedule_optimization(today)
+        recommendations = await automation_engine.generate_proactive_recommendations()
         
         # Calculate status metrics
         total_optimizations_available = len(optimizations)
@@ -10568,15 +11554,15 @@ async def get_ai_medical_report(
         end_date_dt = datetime.strptime(end_date, "%Y-%m-%d")
         
         # Get comprehensive data
-        appointments = list(appointments_collection.find({
+        appointments = await appointments_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
-        consultations = list(consultations_collection.find({
+        consultations = await consultations_collection.find({
             "date": {"$gte": start_date, "$lte": end_date}
-        }))
+        }).to_list(length=None)
         
-        patients = list(patients_collection.find({}))
+        patients = await patients_collection.find({}).to_list(length=None)
         
         # Get evolution data for trends
         evolution = await calculate_monthly_evolution(start_date, end_date)
@@ -10615,6 +11601,103 @@ async def get_ai_medical_report(
             "error_type": type(e).__name__
         }
 
+# ==================== REPORT JOBS ====================
+
+# Long reports (Gemini round-trips, multi-month aggregations) run as background jobs:
+# POST /api/reports/jobs, then poll GET /api/reports/jobs/{id} or subscribe to the
+# "reports" WebSocket topic, then GET /api/reports/jobs/{id}/result.
+# Results are reused while the data sets they read and the current day are unchanged.
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', '2'))
+REPORT_JOB_TIMEOUT_SECONDS = float(os.environ.get('REPORT_JOB_TIMEOUT_SECONDS', '600'))
+REPORT_RESULT_TTL_HOURS = float(os.environ.get('REPORT_RESULT_TTL_HOURS', '24'))
+REPORT_DATA_SETS = ("patients", "consultations", "appointments", "daily_rollups", "phone_messages")
+
+class ReportJobRequest(BaseModel):
+    report_type: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+    force: bool = False  # Recompute even if a cached result exists
+
+async def report_cache_parts() -> dict:
+    """Values report results depend on: data versions, and today (periods default to the current month)"""
+    versions = await get_data_versions(*REPORT_DATA_SETS)
+    return {**versions, "today": datetime.now().strftime("%Y-%m-%d")}
+
+async def publish_report_job(job: dict):
+    """Report job status change to the "reports" topic"""
+    if job["status"] in ("done", "failed"):
+        report_jobs_total.inc(job["report_type"], job["status"])
+        if job.get("duration_ms") is not None:
+            report_job_duration.observe(job["duration_ms"] / 1000, job["report_type"])
+    await manager.publish("reports", {"type": "report_job", "job": job}, coalesce_key=f"report_job:{job['id']}")
+
+report_job_runner = ReportJobRunner(
+    report_jobs_collection,
+    workers=REPORT_JOB_WORKERS,
+    result_ttl=REPORT_RESULT_TTL_HOURS * 3600,
+    timeout=REPORT_JOB_TIMEOUT_SECONDS,
+    cache_parts=report_cache_parts,
+    on_update=publish_report_job
+)
+report_job_runner.register(
+    "advanced", get_advanced_reports,
+    params={"period_type": str, "year": int, "month": int, "semester": int, "start_date": str, "end_date": str},
+    required=("period_type",)
+)
+async def ai_medical_report_job(**params) -> dict:
+    """AI medical report, failing the job instead of caching an error payload"""
+    report = await get_ai_medical_report(**params)
+    if report.get("status") == "error":
+        raise RuntimeError(report.get("message"))
+    return report
+
+report_job_runner.register(
+    "ai_medical", ai_medical_report_job, params={"start_date": str, "end_date": str},
+    required=("start_date", "end_date")
+)
+report_job_runner.register("predictive", get_predictive_analysis)
+report_job_runner.register(
+    "monthly", get_monthly_report,
+    params={"year": int, "month": int, "start_month": int, "end_month": int, "start_year": int, "end_year": int}
+)
+
+@app.post("/api/reports/jobs")
+async def submit_report_job(request: ReportJobRequest, current_user: dict = Depends(get_current_user)):
+    """Queue a report (advanced, ai_medical, predictive, monthly) or reuse the job of an identical one"""
+    try:
+        job = await report_job_runner.submit(
+            request.report_type, request.params, force=request.force, requested_by=current_user.get("username")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting report job: {str(e)}")
+    if job["cached"]:
+        report_jobs_total.inc(job["report_type"], "cached")
+    return job
+
+@app.get("/api/reports/jobs/{job_id}")
+async def get_report_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Status and progress of a report job"""
+    job = await report_job_runner.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job
+
+@app.get("/api/reports/jobs/{job_id}/result")
+async def get_report_job_result(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Report computed by a finished job (202 while it runs, 409 if it failed)"""
+    job = await report_job_runner.get(job_id, with_result=True)
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if job["status"] == "failed":
+        raise HTTPException(status_code=409, detail=f"Report job failed: {job.get('error')}")
+    if job["status"] != "done":
+        return Response(
+            content=json.dumps({"id": job_id, "status": job["status"], "progress": job.get("progress", 0)}),
+            status_code=202, media_type="application/json"
+        )
+    return job["result"]
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -10624,7 +11707,7 @@ async def create_default_users():
     """Create default users if they don't exist"""
     try:
         # Check if users already exist
-        existing_users = users_collection.count_documents({})
+        existing_users = await users_collection.count_documents({})
         if existing_users > 0:
             print("✅ Users already exist, skipping default user creation")
             return
@@ -10658,7 +11741,7 @@ async def create_default_users():
             email="medecin@cabinet.tn",
             full_name="Dr. Heni Dridi", 
             role="medecin",
-            hashed_password=hash_password("medecin123"),
+            hashed_password=await hash_password("medecin123"),
             permissions=medecin_permissions,
             is_active=True
         )
@@ -10669,14 +11752,14 @@ async def create_default_users():
             email="secretaire@cabinet.tn",
             full_name="Secrétaire Médicale",
             role="secretaire", 
-            hashed_password=hash_password("secretaire123"),
+            hashed_password=await hash_password("secretaire123"),
             permissions=secretaire_permissions,
             is_active=True
         )
 
         # Insert users
-        users_collection.insert_one(doctor_user.dict())
-        users_collection.insert_one(secretary_user.dict())
+        await users_collection.insert_one(doctor_user.dict())
+        await users_collection.insert_one(secretary_user.dict())
         
         print("✅ Default users created successfully:")
         print("   👨‍⚕️ Médecin: username=medecin, password=medecin123")
@@ -10701,13 +11784,13 @@ async def fix_users():
     """Fix existing users by adding missing 'id' field"""
     try:
         # Find users without 'id' field
-        users_without_id = list(users_collection.find({"id": {"$exists": False}}))
+        users_without_id = await users_collection.find({"id": {"$exists": False}}).to_list(length=None)
         
         if not users_without_id:
             return {
                 "status": "no_fix_needed",
                 "message": "All users already have 'id' field",
-                "users_checked": users_collection.count_documents({})
+                "users_checked": await users_collection.count_documents({})
             }
         
         fixed_count = 0
@@ -10716,7 +11799,7 @@ async def fix_users():
             user_id = f"{user['username']}_001"
             
             # Update user with id field
-            result = users_collection.update_one(
+            result = await users_collection.update_one(
                 {"_id": user["_id"]},
                 {"$set": {"id": user_id}}
             )
@@ -10728,7 +11811,7 @@ async def fix_users():
             "status": "fixed",
             "message": f"Fixed {fixed_count} users by adding 'id' field",
             "users_fixed": fixed_count,
-            "total_users": users_collection.count_documents({})
+            "total_users": await users_collection.count_documents({})
         }
         
     except Exception as e:
@@ -10742,13 +11825,13 @@ async def debug_database():
     """Debug database connection and permissions"""
     try:
         # Test basic connection
-        client.server_info()
+        await client.server_info()
         
         # Test database access
-        db.command("ping")
+        await db.command("ping")
         
         # List available databases
-        available_dbs = client.list_database_names()
+        available_dbs = await client.list_database_names()
         
         # Test collection access
         collections_info = {}
@@ -10757,7 +11840,7 @@ async def debug_database():
             for collection_name in collection_names:
                 try:
                     collection = db[collection_name]
-                    count = collection.count_documents({})
+                    count = await collection.count_documents({})
                     collections_info[collection_name] = {
                         "accessible": True,
                         "count": count
@@ -10797,7 +11880,7 @@ async def force_create_user():
         users_collection = db.users
         
         # Check if user already exists
-        existing_user = users_collection.find_one({"username": "medecin"})
+        existing_user = await users_collection.find_one({"username": "medecin"})
         if existing_user:
             return {
                 "status": "exists",
@@ -10811,7 +11894,7 @@ async def force_create_user():
             "username": "medecin",
             "full_name": "Dr Heni Dridi",
             "role": "medecin",
-            "hashed_password": bcrypt.hashpw("medecin123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+            "hashed_password": await hash_password("medecin123"),
             "is_active": True,
             "permissions": {
                 "administration": True,
@@ -10827,7 +11910,7 @@ async def force_create_user():
         }
         
         # Insert user
-        result = users_collection.insert_one(medecin_user)
+        result = await users_collection.insert_one(medecin_user)
         
         return {
             "status": "created",
@@ -10987,7 +12070,7 @@ async def deployment_debug():
     """Debug endpoint to check deployment state"""
     try:
         # Check database connection
-        db.command("ping")
+        await db.command("ping")
         
         # Check collections
         collections_info = {}
@@ -10995,12 +12078,12 @@ async def deployment_debug():
         
         for collection_name in collection_names:
             collection = db[collection_name]
-            count = collection.count_documents({})
+            count = await collection.count_documents({})
             collections_info[collection_name] = count
             
             # Special check for users
             if collection_name == 'users' and count > 0:
-                users = list(collection.find({}, {'username': 1, 'role': 1, 'is_active': 1}))
+                users = await collection.find({}, {'username': 1, 'role': 1, 'is_active': 1}).to_list(length=None)
                 collections_info['users_details'] = users
         
         # Check environment variables
@@ -11026,7 +12109,7 @@ async def create_debug_user():
     """Emergency endpoint to create medecin user if missing"""
     try:
         # Check if medecin user exists
-        existing_user = users_collection.find_one({"username": "medecin"})
+        existing_user = await users_collection.find_one({"username": "medecin"})
         if existing_user:
             return {"message": "medecin user already exists", "user_id": existing_user.get('username')}
         
@@ -11036,7 +12119,7 @@ async def create_debug_user():
             "username": "medecin",
             "full_name": "Dr Heni Dridi",
             "role": "medecin",
-            "hashed_password": bcrypt.hashpw("medecin123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+            "hashed_password": await hash_password("medecin123"),
             "is_active": True,
             "permissions": {
                 "administration": True,
@@ -11051,7 +12134,7 @@ async def create_debug_user():
             "last_login": None
         }
         
-        result = users_collection.insert_one(medecin_user)
+        result = await users_collection.insert_one(medecin_user)
         return {
             "message": "medecin user created successfully",
             "user_id": str(result.inserted_id),
@@ -11067,7 +12150,7 @@ async def health_check():
     """Health check endpoint for Kubernetes liveness/readiness probes"""
     try:
         # Check database connection
-        db.command("ping")
+        await db.command("ping")
         return {
             "status": "healthy",
             "database": "connected",
@@ -11081,8 +12164,8 @@ async def api_health_check():
     """API health check endpoint"""
     try:
         # Check database connection
-        db.command("ping")
-        users_count = users_collection.count_documents({})
+        await db.command("ping")
+        users_count = await users_collection.count_documents({})
         return {
             "status": "healthy",
             "api": "operational",
@@ -11098,7 +12181,7 @@ async def readiness_check():
     """Readiness check endpoint for Kubernetes"""
     try:
         # Check if all critical services are ready
-        patients_count = patients_collection.count_documents({})
+        patients_count = await patients_collection.count_documents({})
         return {
             "status": "ready",
             "database": "connected",
@@ -11108,3 +12191,8 @@ async def readiness_check():
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Service not ready: {str(e)}")
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus metrics of this worker (requests, latency, event loop, MongoDB pool, WebSockets, Gemini)"""
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
@@ -44,6 +44,32 @@ import {
 // 🔄 CRITICAL FIX: Define API_BASE_URL for consistent API calls
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || '';
 
+// Long reports run as background jobs: submit, poll the status, then fetch the result.
+// Identical reports on unchanged data return the cached job immediately.
+// Polling stops after REPORT_JOB_MAX_WAIT_MS (longer than the server job timeout).
+const REPORT_JOB_POLL_MS = 1000;
+const REPORT_JOB_MAX_WAIT_MS = 12 * 60 * 1000;
+
+const runReportJob = async (reportType, params) => {
+  const { data: submitted } = await axios.post(`${API_BASE_URL}/api/reports/jobs`, {
+    report_type: reportType,
+    params
+  });
+  let job = submitted;
+  const deadline = Date.now() + REPORT_JOB_MAX_WAIT_MS;
+  while (job.status === 'queued' || job.status === 'running') {
+    if (Date.now() > deadline) {
+      throw new Error('Le rapport prend trop de temps, veuillez réessayer plus tard');
+    }
+    await new Promise(resolve => setTimeout(resolve, REPORT_JOB_POLL_MS));
+    job = (await axios.get(`${API_BASE_URL}/api/reports/jobs/${submitted.id}`)).data;
+  }
+  if (job.status !== 'done') {
+    throw new Error(job.error || 'Report job failed');
+  }
+  return (await axios.get(`${API_BASE_URL}/api/reports/jobs/${submitted.id}/result`)).data;
+};
+
 // Register Chart.js components
 ChartJS.register(
   CategoryScale,
@@ -447,21 +473,19 @@ const Administration = ({ user }) => {
         endDate = new Date(endYear, endMonth, 0).toISOString().split('T')[0];
       }
       
-      // Use our advanced AI reports endpoint
-      const params = new URLSearchParams({
+      // Use our advanced AI reports job
+      const params = {
         start_date: startDate,
         end_date: endDate
-      });
+      };
       
       console.log('🤖 Generating AI-powered advanced report...');
-      const response = await axios.get(`/api/admin/advanced-reports?${params}`);
-      const report = response.data;
+      const report = await runReportJob('advanced', { period_type: 'custom', ...params });
       
       // Also get the new AI medical report for enhanced insights
       try {
         console.log('🧠 Fetching AI medical insights...');
-        const aiReportResponse = await axios.get(`/api/admin/ai-medical-report?${params}`);
-        const aiReport = aiReportResponse.data;
+        const aiReport = await runReportJob('ai_medical', params);
         
         // Merge AI insights with advanced reports
         report.ai_medical_insights = aiReport.ai_analysis;
@@ -695,46 +719,24 @@ const Administration = ({ user }) => {
     try {
       setLoading(true);
       
-      // Use the new admin export endpoint
-      const response = await axios.get(`/api/admin/export/${dataType}`);
-      const { data, count, collection } = response.data;
-      
-      if (count === 0) {
-        toast.error('Aucune donnée à exporter');
-        return;
-      }
+      // CSV generated and streamed by the server (UTF-8 BOM included for Excel)
+      const response = await axios.get(`/api/admin/export/${dataType}`, {
+        params: { format: 'csv' },
+        responseType: 'blob'
+      });
       
       // Generate filename
-      const filename = `sauvegarde_${collection}_${new Date().toISOString().split('T')[0]}.csv`;
-      
-      // Convert to CSV with UTF-8 BOM for Excel compatibility
-      const headers = Object.keys(data[0]).join(',');
-      const csvRows = data.map(row => 
-        Object.values(row).map(value => {
-          // Handle commas and quotes in data
-          const stringValue = String(value || '');
-          return stringValue.includes(',') || stringValue.includes('"') 
-            ? `"${stringValue.replace(/"/g, '""')}"` 
-            : stringValue;
-        }).join(',')
-      );
-      
-      const csvContent = [headers, ...csvRows].join('\n');
-      
-      // Add UTF-8 BOM for Excel compatibility
-      const BOM = '\uFEFF';
-      const csvWithBOM = BOM + csvContent;
+      const filename = `sauvegarde_${dataType}_${new Date().toISOString().split('T')[0]}.csv`;
       
       // Download
-      const blob = new Blob([csvWithBOM], { type: 'text/csv;charset=utf-8;' });
-      const url = window.URL.createObjectURL(blob);
+      const url = window.URL.createObjectURL(response.data);
       const a = document.createElement('a');
       a.href = url;
       a.download = filename;
       a.click();
       window.URL.revokeObjectURL(url);
       
-      toast.success(`Sauvegarde ${collection} terminée (${count} éléments)`);
+      toast.success(`Sauvegarde ${dataType} terminée`);
     } catch (error) {
       console.error(`Error exporting ${dataType}:`, error);
       toast.error(`Erreur lors de la sauvegarde ${dataType}: ${error.response?.data?.detail || error.message}`);
@@ -750,26 +752,25 @@ const Administration = ({ user }) => {
       setAdvancedReportLoading(true);
       const period = advancedReportPeriod;
       
-      let params = new URLSearchParams({
+      const params = {
         period_type: advancedReportType
-      });
+      };
       
       // Add period-specific parameters
       if (advancedReportType === 'monthly') {
-        params.append('year', period.year);
-        params.append('month', period.month);
+        params.year = period.year;
+        params.month = period.month;
       } else if (advancedReportType === 'semester') {
-        params.append('year', period.year);
-        params.append('semester', period.semester);
+        params.year = period.year;
+        params.semester = period.semester;
       } else if (advancedReportType === 'annual') {
-        params.append('year', period.year);
+        params.year = period.year;
       } else if (advancedReportType === 'custom') {
-        params.append('start_date', period.startDate);
-        params.append('end_date', period.endDate);
+        params.start_date = period.startDate;
+        params.end_date = period.endDate;
       }
       
-      const response = await axios.get(`/api/admin/advanced-reports?${params}`);
-      const reportData = response.data;
+      const reportData = await runReportJob('advanced', params);
       
       // Traiter les données avec enrichissement Gemini
       setAdvancedReportsData({
@@ -791,7 +792,7 @@ const Administration = ({ user }) => {
         (reportData.gemini_enrichment?.status === "success" ? " (enrichi par IA)" : ""));
     } catch (error) {
       console.error('Error generating advanced report:', error);
-      toast.error('Erreur lors de la génération du rapport avancé');
+      toast.error(`Erreur lors de la génération du rapport avancé: ${error.response?.data?.detail || error.message}`);
     } finally {
       setAdvancedReportLoading(false);
     }
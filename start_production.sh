@@ -16,8 +16,16 @@ pip install emergentintegrations --extra-index-url https://d33sy5i8bnduwe.cloudf
 # Set environment variables (these should be set in deployment config)
 export PYTHONPATH="/app/backend:$PYTHONPATH"
 
+# Workers: more than 1 needs PUBSUB_BACKEND=mongo or redis so WebSocket events
+# and shared settings reach every worker
+WORKERS="${WEB_CONCURRENCY:-1}"
+if [ "$WORKERS" -gt 1 ] && [ "${PUBSUB_BACKEND:-memory}" = "memory" ]; then
+    echo "⚠️  PUBSUB_BACKEND=memory with $WORKERS workers, falling back to 1 worker"
+    WORKERS=1
+fi
+
 # Start the server
-echo "🌐 Starting FastAPI server..."
-python -m uvicorn server:app --host 0.0.0.0 --port 8001 --workers 1
+echo "🌐 Starting FastAPI server ($WORKERS worker(s))..."
+python -m uvicorn server:app --host 0.0.0.0 --port 8001 --workers "$WORKERS"
 
 echo "✅ Server started successfully"